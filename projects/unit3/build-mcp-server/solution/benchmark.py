@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+Benchmark analyze_file_changes on a large synthetic repository
+Generates a monorepo-sized git repository locally and compares the diff profiles
+
+Usage: uv run python benchmark.py [--files 100000] [--changed 2000] [--runs 3] [--repo PATH]
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import statistics
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+
+import server
+from git_analysis import analysis_cache, diff_baselines, diff_snapshots, forget_repo_metadata
+
+COMMITTER = "Benchmark <bench@example.com> 1700000000 +0000"
+
+
+def source_file(rng, index):
+    """A small Python module with content unique to index."""
+    lines = [f"# module {index}", "", f"def handler_{index}(value):"]
+    lines += [f"    value = value * {rng.randint(2, 99)} + {rng.randint(0, 999)}" for _ in range(rng.randint(10, 40))]
+    lines.append("    return value")
+    return ("\n".join(lines) + "\n").encode()
+
+
+def edited(content, rng):
+    """content with a few of its lines changed."""
+    lines = content.split(b"\n")
+    for _ in range(3):
+        line = rng.randrange(3, len(lines) - 2)
+        lines[line] = b"    value = value - %d" % rng.randint(0, 999)
+    return b"\n".join(lines)
+
+
+def build_repo(repo, files, changed, seed=0):
+    """Create a repository with `files` files on main and `changed` of them changed on feature.
+
+    The feature branch edits Python files, moves a few directories with edits (inexact
+    renames), and changes binary and generated files. Only the object database is
+    written; HEAD points at feature without checking it out. A "services" profile
+    scoped to services/ is configured as an example of a pathspec profile.
+    """
+    rng = random.Random(seed)
+    subprocess.run(["git", "init", "-q", "-b", "main", str(repo)], check=True)
+
+    tree = {}
+    for index in range(files):
+        if index % 20 == 0:
+            tree[f"assets/img_{index}.png"] = rng.randbytes(16 * 1024)
+        elif index % 50 == 1:
+            tree[f"dist/bundle_{index}.min.js"] = b"".join(b"var a%d=%d;\n" % (line, index) for line in range(5000))
+        else:
+            tree[f"services/svc_{index % 300:03}/module_{index}.py"] = source_file(rng, index)
+
+    paths = sorted(tree)
+    modified = {}
+    deleted = []
+    for path in rng.sample(paths, changed):
+        content = tree[path]
+        if path.endswith(".py"):
+            modified[path] = edited(content, rng)
+        elif path.endswith(".png"):
+            modified[path] = rng.randbytes(len(content))
+        else:
+            modified[path] = content.replace(b"var a1", b"var b1")
+    # A reorganisation moving some services into a new directory, editing each file
+    moved = [p for p in paths if p.startswith("services/svc_00") and p not in modified]
+    for path in moved[:changed // 2]:
+        deleted.append(path)
+        modified[path.replace("services/", "platform/")] = edited(tree[path], rng)
+
+    importer = subprocess.Popen(["git", "fast-import", "--quiet"], cwd=repo, stdin=subprocess.PIPE)
+    stream = importer.stdin
+    marks = itertools.count(1)
+
+    def blob(content):
+        mark = next(marks)
+        stream.write(b"blob\nmark :%d\ndata %d\n" % (mark, len(content)) + content + b"\n")
+        return mark
+
+    def commit(ref, message, changes, parent=None):
+        # changes are built (and their blobs written) before the commit header
+        message = message.encode()
+        stream.write(f"commit {ref}\ncommitter {COMMITTER}\n".encode())
+        stream.write(b"data %d\n%s\n" % (len(message), message))
+        if parent:
+            stream.write(f"from {parent}\n".encode())
+        stream.write(b"".join(changes))
+
+    commit("refs/heads/main", "initial", [
+        b"M 100644 :%d %s\n" % (blob(tree[p]), p.encode()) for p in paths
+    ])
+    commit("refs/heads/feature", "feat: rework services", [
+        b"M 100644 :%d %s\n" % (blob(content), p.encode()) for p, content in modified.items()
+    ] + [b"D %s\n" % p.encode() for p in deleted], parent="refs/heads/main")
+    stream.close()
+    if importer.wait() != 0:
+        raise SystemExit("git fast-import failed")
+
+    subprocess.run(["git", "symbolic-ref", "HEAD", "refs/heads/feature"], cwd=repo, check=True)
+
+    # A profile for teams that only review the services tree
+    subprocess.run(["git", "config", "pr-agent.services.pathspec", "services/"], cwd=repo, check=True)
+    subprocess.run(["git", "config", "pr-agent.services.renameLimit", "0"], cwd=repo, check=True)
+
+
+async def time_profile(repo, profile, runs):
+    """Cold-cache wall times (ms) of analyze_file_changes, and the last result."""
+    times = []
+    for _ in range(runs):
+        analysis_cache.clear()
+        diff_snapshots.clear()
+        diff_baselines.clear()
+        forget_repo_metadata()
+        started = time.perf_counter()
+        data = json.loads(await server.analyze_file_changes(working_directory=str(repo), profile=profile))
+        times.append((time.perf_counter() - started) * 1000)
+        if "error" in data:
+            raise SystemExit(f"analyze_file_changes failed: {data['error']}")
+    return times, data
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--files", type=int, default=100000, help="files in the repository")
+    parser.add_argument("--changed", type=int, default=2000, help="files changed on the feature branch")
+    parser.add_argument("--runs", type=int, default=3, help="timed runs per profile")
+    parser.add_argument("--repo", type=Path, help="where to create the repository (default: a temporary directory)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        repo = args.repo or Path(tmp) / "monorepo"
+        if not (repo / ".git").exists():
+            started = time.perf_counter()
+            build_repo(repo, args.files, args.changed)
+            print(f"Generated {args.files} files ({args.changed} changed) in {time.perf_counter() - started:.1f}s at {repo}")
+
+        print(f"{'profile':<8} {'median ms':>10} {'min ms':>10} {'files':>7}")
+        for profile in ("full", "fast", "services"):
+            times, data = asyncio.run(time_profile(repo, profile, args.runs))
+            files = len(data["files_changed"].splitlines())
+            print(f"{profile:<8} {statistics.median(times):>10.1f} {min(times):>10.1f} {files:>7}")
+
+
+if __name__ == "__main__":
+    main()
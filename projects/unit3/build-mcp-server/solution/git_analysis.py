@@ -0,0 +1,4086 @@
+#!/usr/bin/env python3
+"""
+Git helpers for the PR agent MCP server.
+Runs git as asyncio subprocesses so long-running commands never block the event loop.
+"""
+
+import ast
+import asyncio
+import bisect
+import contextvars
+import ctypes
+import ctypes.util
+import fnmatch
+import hashlib
+import json
+import math
+import multiprocessing
+import os
+import re
+import struct
+import subprocess
+import sys
+import time
+import weakref
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from dataclasses import dataclass, field, replace
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Deque, Dict, Hashable, List, Optional, Tuple, Union
+
+try:
+    import tomllib
+except ImportError:
+    # Python 3.10: dependency manifests are diffed as plain text
+    tomllib = None
+
+# Width of the --stat output (git's default when stdout is not a terminal)
+STAT_WIDTH = 80
+
+# Kinds of change by `git diff --raw` status letter
+CHANGE_KINDS = {
+    "A": "added",
+    "M": "modified",
+    "D": "deleted",
+    "R": "renamed",
+    "C": "copied",
+    "T": "type_changed"
+}
+
+# Bytes read from a git pipe at a time
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Maximum number of git processes the server runs at the same time, overall and per repository
+GIT_CONCURRENCY = int(os.getenv("PR_AGENT_GIT_CONCURRENCY", "4"))
+GIT_CONCURRENCY_PER_REPO = int(os.getenv("PR_AGENT_GIT_CONCURRENCY_PER_REPO", "2"))
+
+# Memory budget of the analysis cache, and whether entries are also written under .git/
+CACHE_MAX_BYTES = int(os.getenv("PR_AGENT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+PERSIST_CACHE = os.getenv("PR_AGENT_PERSIST_CACHE", "").lower() in ("1", "true", "yes")
+
+# Rough size of a model token, used to turn token budgets into bytes
+BYTES_PER_TOKEN = 4
+
+# Seconds a diff snapshot stays available for paging after it was last used, and the memory
+# budget of the loaded patches (least recently used ones are dropped and re-read when paged)
+SNAPSHOT_TTL = float(os.getenv("PR_AGENT_SNAPSHOT_TTL", "900"))
+SNAPSHOT_MAX_BYTES = int(os.getenv("PR_AGENT_SNAPSHOT_MAX_BYTES", str(128 * 1024 * 1024)))
+
+# `git cat-file` processes kept per working directory, and seconds before an idle one is closed
+CAT_FILE_POOL_SIZE = int(os.getenv("PR_AGENT_CAT_FILE_POOL_SIZE", "2"))
+CAT_FILE_IDLE_TIMEOUT = float(os.getenv("PR_AGENT_CAT_FILE_IDLE_TIMEOUT", "60"))
+
+# Most paths re-diffed to update an analysis after HEAD moved; beyond that the whole diff is rerun
+INCREMENTAL_MAX_PATHS = int(os.getenv("PR_AGENT_INCREMENTAL_MAX_PATHS", "256"))
+
+# Worker processes parsing Python files for semantic summaries, and the largest file parsed
+PARSE_WORKERS = int(os.getenv("PR_AGENT_PARSE_WORKERS", str(min(4, os.cpu_count() or 1))))
+PARSE_MAX_BYTES = 1024 * 1024
+
+# Days of history the code-ownership index covers, and how far the window may slide before it is rebuilt
+OWNERSHIP_DAYS = int(os.getenv("PR_AGENT_OWNERSHIP_DAYS", "365"))
+OWNERSHIP_REBUILD_DAYS = 7
+
+# Warm the analysis cache in the background whenever HEAD moves (see watch_refs())
+WATCH_REFS = os.getenv("PR_AGENT_WATCH_REFS", "").lower() in ("1", "true", "yes")
+WATCH_INTERVAL = float(os.getenv("PR_AGENT_WATCH_INTERVAL", "2"))  # polling, where inotify is unavailable
+
+# Seconds a tool may spend on git work before it returns what it has (PR_AGENT_TIMEOUT_<TOOL> overrides it per tool)
+TOOL_TIMEOUT = float(os.getenv("PR_AGENT_TOOL_TIMEOUT", "30"))
+
+# One governor per event loop (asyncio primitives cannot be shared between loops)
+_governors: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, GitGovernor]" = weakref.WeakKeyDictionary()
+
+
+class GitResult(subprocess.CompletedProcess):
+    """Result of a git command, with the wall time it took in seconds."""
+
+    def __init__(self, args, returncode, stdout, stderr, elapsed: float = 0.0):
+        super().__init__(args, returncode, stdout, stderr)
+        self.elapsed = elapsed
+        self.stopped_early = False
+        self.timed_out = False
+
+
+class DeadlineExceeded(TimeoutError):
+    """A git command was killed because the deadline of the tool running it passed."""
+
+
+# Monotonic time by which git commands started in the current context must finish
+_deadline: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar("git_deadline", default=None)
+
+
+def tool_timeout(tool: str) -> float:
+    """The deadline in seconds for a tool: PR_AGENT_TIMEOUT_<TOOL>, else PR_AGENT_TOOL_TIMEOUT."""
+    return float(os.getenv(f"PR_AGENT_TIMEOUT_{tool.upper()}", TOOL_TIMEOUT))
+
+
+@contextmanager
+def deadline(seconds: Optional[float]):
+    """Kill git commands run inside the block (and tasks it starts) once `seconds` have passed.
+
+    Commands that time out return what they printed so far with timed_out set;
+    run_git() raises DeadlineExceeded unless asked for partial output. None means no deadline.
+    """
+    token = _deadline.set(None if seconds is None else time.monotonic() + seconds)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def time_left() -> Optional[float]:
+    """Seconds until the current deadline, or None if there is none."""
+    at = _deadline.get()
+    return None if at is None else max(at - time.monotonic(), 0.0)
+
+
+async def _before_deadline(awaitable):
+    """Await with the time left; raises asyncio.TimeoutError once the deadline passes."""
+    left = time_left()
+    if left is None:
+        return await awaitable
+    return await asyncio.wait_for(awaitable, left)
+
+
+# Who git work is done for (a client session), so the governor can share slots fairly
+_requester: contextvars.ContextVar[Hashable] = contextvars.ContextVar("git_requester", default="local")
+
+
+@contextmanager
+def on_behalf_of(requester: Hashable):
+    """Queue git commands run inside the block (and tasks it starts) as requester's."""
+    token = _requester.set(requester)
+    try:
+        yield
+    finally:
+        _requester.reset(token)
+
+
+@dataclass(eq=False)
+class _Waiter:
+    requester: Hashable
+    repo: str
+    future: asyncio.Future
+    since: float
+
+
+class GitGovernor:
+    """Decides when git commands may run, and merges identical requests in flight.
+
+    At most `limit` commands run at once, and at most `per_repo` in one repository.
+    Queued commands are started round-robin across requesters, so a burst from one
+    client session can't starve the others; each requester's commands run in order.
+    """
+
+    def __init__(self, limit: int = GIT_CONCURRENCY, per_repo: int = GIT_CONCURRENCY_PER_REPO):
+        self.limit = limit
+        self.per_repo = per_repo
+        self.running = 0
+        self.running_by_repo: Dict[str, int] = {}
+        self.started = 0
+        self.queued = 0  # commands that had to wait
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.recent_waits: Deque[float] = deque(maxlen=512)
+        self.merged = 0  # requests answered by an identical one already in flight
+        self._queues: "OrderedDict[Hashable, Deque[_Waiter]]" = OrderedDict()  # in round-robin order
+        self._in_flight: Dict[Hashable, List] = {}  # key -> [task, callers]
+
+    async def acquire(self, repo: str) -> float:
+        """Wait for a slot to run a command in repo; returns the seconds waited."""
+        if not self._queues and self._has_room(repo):
+            self._start(repo, 0.0)
+            return 0.0
+
+        requester = _requester.get()
+        waiter = _Waiter(requester, repo, asyncio.get_running_loop().create_future(), time.monotonic())
+        self._queues.setdefault(requester, deque()).append(waiter)
+        # Those queued before may all be waiting for busy repositories
+        self._dispatch()
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # Cancelled just after being given the slot
+                self.release(repo)
+            else:
+                self._forget(waiter)
+            raise
+        return time.monotonic() - waiter.since
+
+    def release(self, repo: str) -> None:
+        """Give back a slot taken with acquire()."""
+        self.running -= 1
+        self.running_by_repo[repo] -= 1
+        if not self.running_by_repo[repo]:
+            del self.running_by_repo[repo]
+        self._dispatch()
+
+    async def coalesce(self, key: Hashable, factory: Callable[[], Awaitable[Any]]) -> Any:
+        """Await factory(), or the identical request (same key) that is already running.
+
+        The shared work is cancelled only when every caller waiting for it is.
+        """
+        entry = self._in_flight.get(key)
+        if entry is None:
+            entry = [asyncio.ensure_future(factory()), 0]
+            self._in_flight[key] = entry
+            entry[0].add_done_callback(lambda _: self._drop_in_flight(key, entry))
+        else:
+            self.merged += 1
+        entry[1] += 1
+        try:
+            return await asyncio.shield(entry[0])
+        except asyncio.CancelledError:
+            entry[1] -= 1
+            if not entry[1]:
+                self._drop_in_flight(key, entry)
+                entry[0].cancel()
+            raise
+
+    def metrics(self) -> Dict[str, Any]:
+        """Queue depth, wait times and limits."""
+        waits = sorted(self.recent_waits)
+
+        def percentile(p: float) -> float:
+            return round(waits[min(int(len(waits) * p), len(waits) - 1)] * 1000, 2) if waits else 0.0
+
+        return {
+            "limits": {"global": self.limit, "per_repository": self.per_repo},
+            "running": self.running,
+            "running_by_repository": dict(self.running_by_repo),
+            "queue_depth": sum(len(queue) for queue in self._queues.values()),
+            "queue_depth_by_requester": {str(r): len(queue) for r, queue in self._queues.items()},
+            "commands_started": self.started,
+            "commands_queued": self.queued,
+            "wait_ms": {
+                "mean": round(self.wait_total / self.started * 1000, 2) if self.started else 0.0,
+                "p50": percentile(0.5),
+                "p95": percentile(0.95),
+                "max": round(self.wait_max * 1000, 2)
+            },
+            "requests_in_flight": len(self._in_flight),
+            "requests_merged": self.merged
+        }
+
+    def _has_room(self, repo: str) -> bool:
+        return self.running < self.limit and self.running_by_repo.get(repo, 0) < self.per_repo
+
+    def _start(self, repo: str, waited: float) -> None:
+        self.running += 1
+        self.running_by_repo[repo] = self.running_by_repo.get(repo, 0) + 1
+        self.started += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+        self.recent_waits.append(waited)
+        if waited:
+            self.queued += 1
+
+    def _dispatch(self) -> None:
+        """Start queued commands while there is room, taking requesters in turn."""
+        while self.running < self.limit:
+            for requester, queue in self._queues.items():
+                waiter = next((w for w in queue if self._has_room(w.repo)), None)
+                if waiter is not None:
+                    break
+            else:
+                return
+            queue.remove(waiter)
+            # This requester goes to the back of the rotation
+            del self._queues[requester]
+            if queue:
+                self._queues[requester] = queue
+            self._start(waiter.repo, time.monotonic() - waiter.since)
+            waiter.future.set_result(None)
+
+    def _drop_in_flight(self, key: Hashable, entry: List) -> None:
+        if self._in_flight.get(key) is entry:
+            del self._in_flight[key]
+
+    def _forget(self, waiter: _Waiter) -> None:
+        queue = self._queues.get(waiter.requester)
+        if queue is not None and waiter in queue:
+            queue.remove(waiter)
+            if not queue:
+                del self._queues[waiter.requester]
+
+
+def governor() -> GitGovernor:
+    """The governor of the running event loop."""
+    loop = asyncio.get_running_loop()
+    if loop not in _governors:
+        _governors[loop] = GitGovernor()
+    return _governors[loop]
+
+
+def _repo_key(cwd: str) -> str:
+    # Working directories in one repository share its per-repository limit once it is known
+    metadata = _repo_metadata.get(cwd)
+    return metadata.toplevel if metadata is not None else cwd
+
+
+async def stream_git(
+    args: List[str],
+    cwd: str,
+    consume: Callable[[bytes], bool],
+    check: bool = False
+) -> GitResult:
+    """Run a git command and hand its stdout to `consume` chunk by chunk.
+
+    Args:
+        args: Arguments passed to git (without the leading "git")
+        cwd: Directory to run the command in
+        consume: Called with each chunk of stdout; returning True stops reading and kills git
+        check: Raise subprocess.CalledProcessError on a non-zero exit status
+
+    Returns:
+        The result without stdout; `stopped_early` tells whether git was killed by `consume`,
+        `timed_out` whether it was killed at the deadline (see deadline())
+    """
+    command = ["git", *args]
+    started = time.perf_counter()
+    slots, repo = governor(), _repo_key(cwd)
+    try:
+        await _before_deadline(slots.acquire(repo))
+    except asyncio.TimeoutError:
+        # Never started: the deadline passed while waiting for a free slot
+        result = GitResult(command, None, "", "", time.perf_counter() - started)
+        result.timed_out = True
+        return result
+
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *command,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            cwd=cwd
+        )
+        stderr_task = asyncio.ensure_future(process.stderr.read())
+        stopped_early = timed_out = False
+        try:
+            while True:
+                try:
+                    chunk = await _before_deadline(process.stdout.read(STREAM_CHUNK_SIZE))
+                except asyncio.TimeoutError:
+                    timed_out = True
+                    chunk = None
+                if timed_out or (chunk and consume(chunk)):
+                    stopped_early = not timed_out
+                    _kill(process)
+                    # Drain what is left: with its buffer full the pipe stops being read,
+                    # never reports EOF, and wait() would block forever
+                    while await process.stdout.read(STREAM_CHUNK_SIZE):
+                        pass
+                    break
+                if not chunk:
+                    break
+            await process.wait()
+            stderr = await stderr_task
+        except asyncio.CancelledError:
+            # Don't leave orphaned git processes behind (the client cancelled the request)
+            _kill(process)
+            stderr_task.cancel()
+            raise
+    finally:
+        slots.release(repo)
+    elapsed = time.perf_counter() - started
+
+    result = GitResult(command, process.returncode, "", stderr.decode("utf-8", errors="replace"), elapsed)
+    result.stopped_early = stopped_early
+    result.timed_out = timed_out
+    if check and not stopped_early and not timed_out:
+        result.check_returncode()
+    return result
+
+
+async def run_git(args: List[str], cwd: str, check: bool = False, partial: bool = False) -> GitResult:
+    """Run a git command without blocking the event loop.
+
+    Args:
+        args: Arguments passed to git (without the leading "git")
+        cwd: Directory to run the command in
+        check: Raise subprocess.CalledProcessError on a non-zero exit status
+        partial: At the deadline, return the output so far (with timed_out set)
+            instead of raising DeadlineExceeded
+    """
+    chunks = []
+
+    def collect(chunk: bytes) -> bool:
+        chunks.append(chunk)
+        return False
+
+    result = await stream_git(args, cwd, collect, check=check)
+    if result.timed_out and not partial:
+        raise DeadlineExceeded(f"git {args[0]} did not finish before the deadline")
+    result.stdout = b"".join(chunks).decode("utf-8", errors="replace")
+    return result
+
+
+def _kill(process) -> None:
+    try:
+        process.kill()
+    except ProcessLookupError:
+        # Already exited
+        pass
+
+
+def timings_ms(results: Dict[str, Any]) -> Dict[str, float]:
+    """Wall time of each command (a result with .elapsed, or seconds) in milliseconds."""
+    return {name: round(getattr(result, "elapsed", result) * 1000, 2) for name, result in results.items()}
+
+
+# ===== Single-pass diff model =====
+
+@dataclass
+class FileChange:
+    """One file of a diff, as reported by `git diff --raw --numstat`."""
+    status: str
+    path: str
+    old_path: Optional[str] = None
+    old_mode: str = ""
+    new_mode: str = ""
+    old_sha: str = ""
+    new_sha: str = ""
+    added: Optional[int] = None  # None for binary files
+    deleted: Optional[int] = None
+
+    @property
+    def binary(self) -> bool:
+        return self.added is None
+
+    @property
+    def changed_lines(self) -> int:
+        return (self.added or 0) + (self.deleted or 0)
+
+    @property
+    def display_path(self) -> str:
+        """Path as shown by `git diff --stat` (renames use git's {old => new} form)."""
+        if self.old_path is None:
+            return self.path
+        return _pretty_rename(self.old_path, self.path)
+
+
+@dataclass
+class DiffModel:
+    """Structured result of one `git diff --raw --numstat [-p] -z` run."""
+    files: List[FileChange] = field(default_factory=list)
+    patch: str = ""
+    truncated: bool = False  # patch holds only the first max_patch_lines lines
+    total_lines: int = 0  # lines in the full patch (estimated from numstat when truncated)
+    total_lines_exact: bool = True
+    timed_out: bool = False  # git was killed at the deadline; everything above may be partial
+    elapsed: float = 0.0
+
+    def name_status(self) -> str:
+        """Render the files like `git diff --name-status`."""
+        lines = []
+        for change in self.files:
+            if change.old_path is not None:
+                lines.append(f"{change.status}\t{change.old_path}\t{change.path}\n")
+            else:
+                lines.append(f"{change.status}\t{change.path}\n")
+        return "".join(lines)
+
+    def stat(self, width: int = STAT_WIDTH) -> str:
+        """Render the files like `git diff --stat` (binary files show "Bin" without byte sizes)."""
+        if not self.files:
+            return ""
+
+        names = [change.display_path for change in self.files]
+        max_len = max(len(name) for name in names)
+        max_change = max(change.changed_lines for change in self.files)
+        number_width = max(len(str(max_change)), 3 if any(c.binary for c in self.files) else 0)
+
+        graph_width = max_change
+        name_width = max_len
+        if name_width + number_width + 6 + graph_width > width:
+            if graph_width > width * 3 // 8 - number_width - 6:
+                graph_width = max(width * 3 // 8 - number_width - 6, 6)
+            if name_width > width - number_width - 6 - graph_width:
+                name_width = width - number_width - 6 - graph_width
+            else:
+                graph_width = width - number_width - 6 - name_width
+
+        lines = []
+        for change, name in zip(self.files, names):
+            if len(name) > name_width:
+                name = "..." + name[len(name) - name_width + 3:]
+            if change.binary:
+                lines.append(f" {name:<{name_width}} | {'Bin':>{number_width}}")
+                continue
+            added, deleted = change.added, change.deleted
+            if graph_width < max_change:
+                added = _scale_linear(added, graph_width, max_change)
+                deleted = _scale_linear(deleted, graph_width, max_change)
+            graph = ("+" * added) + ("-" * deleted)
+            lines.append(f" {name:<{name_width}} | {change.changed_lines:>{number_width}}{' ' if graph else ''}{graph}")
+
+        lines.append(_stat_summary(self.files))
+        return "\n".join(lines) + "\n"
+
+    def composition(self) -> Dict[str, Any]:
+        """File and line counts by extension, top-level directory and kind of change, in one pass over the files."""
+        groups: Dict[str, Dict[str, Dict[str, int]]] = {"by_extension": {}, "by_directory": {}, "by_change": {}}
+        for change in self.files:
+            name = change.path.rsplit("/", 1)[-1]
+            extension = name[name.rfind("."):].lower() if name.rfind(".") > 0 else "(none)"
+            directory = change.path.split("/", 1)[0] if "/" in change.path else "(root)"
+            kind = CHANGE_KINDS.get(change.status[:1], "other")
+            for group, label in (("by_extension", extension), ("by_directory", directory), ("by_change", kind)):
+                counts = groups[group].setdefault(label, {"files": 0, "added": 0, "deleted": 0, "binary": 0})
+                counts["files"] += 1
+                counts["added"] += change.added or 0
+                counts["deleted"] += change.deleted or 0
+                counts["binary"] += change.binary
+        composition: Dict[str, Any] = {
+            "files": len(self.files),
+            "added": sum(change.added or 0 for change in self.files),
+            "deleted": sum(change.deleted or 0 for change in self.files)
+        }
+        for group, counts in groups.items():
+            # Largest first
+            composition[group] = dict(sorted(
+                counts.items(), key=lambda item: (-item[1]["files"], -item[1]["added"] - item[1]["deleted"], item[0])
+            ))
+        return composition
+
+
+def _scale_linear(value: int, width: int, max_change: int) -> int:
+    if not value:
+        return 0
+    return 1 + (value * (width - 1) // max_change)
+
+
+def _stat_summary(files: List[FileChange]) -> str:
+    insertions = sum(change.added or 0 for change in files)
+    deletions = sum(change.deleted or 0 for change in files)
+    summary = f" {len(files)} file{'' if len(files) == 1 else 's'} changed"
+    if insertions or not deletions:
+        summary += f", {insertions} insertion{'' if insertions == 1 else 's'}(+)"
+    if deletions or not insertions:
+        summary += f", {deletions} deletion{'' if deletions == 1 else 's'}(-)"
+    return summary
+
+
+def _pretty_rename(old: str, new: str) -> str:
+    """Compress a rename the way git does, e.g. "src/{a.py => b.py}"."""
+    # Common prefix, up to and including the last shared "/"
+    prefix = 0
+    i = 0
+    while i < min(len(old), len(new)) and old[i] == new[i]:
+        if old[i] == "/":
+            prefix = i + 1
+        i += 1
+
+    # Common suffix, starting at a shared "/"
+    suffix = 0
+    i, j = len(old) - 1, len(new) - 1
+    while i >= prefix and j >= prefix and old[i] == new[j]:
+        if old[i] == "/":
+            suffix = len(old) - i
+        i -= 1
+        j -= 1
+
+    if not prefix and not suffix:
+        return f"{old} => {new}"
+    old_mid = old[prefix:len(old) - suffix]
+    new_mid = new[prefix:len(new) - suffix]
+    return f"{old[:prefix]}{{{old_mid} => {new_mid}}}{old[len(old) - suffix:]}"
+
+
+# Binary and generated files the fast profile never reads or diffs, unless configured otherwise
+FAST_BINARY_GLOBS = (
+    "*.png", "*.jpg", "*.jpeg", "*.gif", "*.ico", "*.webp", "*.pdf",
+    "*.zip", "*.gz", "*.tgz", "*.jar", "*.whl", "*.so", "*.dylib", "*.dll", "*.exe",
+    "*.woff", "*.woff2", "*.ttf", "*.min.js", "*.min.css", "*.map"
+)
+
+
+@dataclass(frozen=True)
+class DiffProfile:
+    """How much work git does for a diff.
+
+    The "full" profile is git's default behaviour. The "fast" profile, meant for large
+    monorepos, turns rename detection off and treats FAST_BINARY_GLOBS as binary by
+    attribute, so their contents are never read. See load_profile() for configuring them.
+    """
+    name: str = "full"
+    pathspec: Tuple[str, ...] = ()  # limit the diff to these pathspecs
+    rename_limit: Optional[int] = None  # None: git's default, 0: no rename detection
+    diff_filter: Optional[str] = None  # git's --diff-filter, e.g. "AMD"
+    binary: Tuple[str, ...] = ()  # globs diffed as binary without looking at their contents
+    attributes_file: Optional[str] = None  # marks the binary globs "-diff"; set by load_profile()
+    exclude: Tuple[str, ...] = ()  # globs left out of the diff entirely (reported elsewhere, e.g. lockfiles)
+    render: str = "default"  # how the patch is rendered, one of RENDER_MODES
+
+    def pathspecs(self) -> List[str]:
+        """The pathspec arguments (after "--") for this profile."""
+        return [*self.pathspec, *(f":(exclude,glob){glob}" for glob in self.exclude)]
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "pathspec": list(self.pathspec),
+            "rename_limit": self.rename_limit,
+            "diff_filter": self.diff_filter,
+            "binary": list(self.binary),
+            "exclude": list(self.exclude),
+            "render": self.render
+        }
+
+
+def diff_args(
+    base_branch: str,
+    include_patch: bool = True,
+    head: str = "HEAD",
+    profile: Optional[DiffProfile] = None,
+    header: bool = True
+) -> List[str]:
+    """Arguments for the single git invocation that parse_diff() understands.
+
+    Without header, the raw and numstat records are left out and git prints just the patch.
+    """
+    profile = profile or DiffProfile()
+    args = []
+    if profile.attributes_file:
+        # Replaces the user's global attributes file for this command only
+        args += ["-c", f"core.attributesFile={profile.attributes_file}"]
+    args += ["diff", "--raw", "--numstat", "-z"] if header else ["diff"]
+    if include_patch:
+        args.append("-p")
+        if profile.render == "zero_context":
+            args.append("-U0")
+        elif profile.render == "function_context":
+            args.append("--function-context")
+    if profile.rename_limit == 0:
+        args.append("--no-renames")
+    elif profile.rename_limit is not None:
+        args.append(f"-l{profile.rename_limit}")
+    if profile.diff_filter:
+        args.append(f"--diff-filter={profile.diff_filter}")
+    args.append(f"{base_branch}...{head}")
+    if profile.pathspec or profile.exclude:
+        args += ["--", *profile.pathspecs()]
+    return args
+
+
+class DiffStreamParser:
+    """Incremental parser for the output of `git diff --raw --numstat [-p] -z`.
+
+    The raw records come first, then one numstat record per file in the same
+    order, then (with -p) an empty record followed by the patch text. Only the
+    patch lines within the budget are kept, and they are decoded once at the end.
+    """
+
+    def __init__(self, max_patch_lines: Optional[int] = None):
+        self.model = DiffModel()
+        self.max_patch_lines = max_patch_lines
+        self.done = False  # the line budget is spent; the rest of the output is not needed
+        self._state = "raw"
+        self._buffer = bytearray()
+        self._numstat_index = 0
+        self._patch = bytearray()
+        self._patch_newlines = 0
+
+    @classmethod
+    def for_patch(cls, files: List[FileChange], max_patch_lines: Optional[int] = None) -> "DiffStreamParser":
+        """A parser that already has the header records (files) and is fed only patch text."""
+        parser = cls(max_patch_lines)
+        parser.model.files = files
+        parser._numstat_index = len(files)
+        parser._state = "patch"
+        return parser
+
+    def feed(self, chunk: bytes) -> bool:
+        """Consume a chunk of output; returns True once no more output is needed."""
+        if self.done:
+            return True
+        if self._state == "patch":
+            self._feed_patch(chunk)
+            return self.done
+
+        self._buffer += chunk
+        pos = self._parse_header()
+        if self._state == "patch":
+            rest = bytes(self._buffer[pos:])
+            self._buffer.clear()
+            self._feed_patch(rest)
+        else:
+            del self._buffer[:pos]
+        return self.done
+
+    def close(self, timed_out: bool = False) -> DiffModel:
+        """Finish parsing and return the model.
+
+        With timed_out, the output ended part way through and a trailing
+        incomplete header record is dropped.
+        """
+        if timed_out:
+            self.model.timed_out = True
+            self.done = True
+            # Keep whole lines only
+            del self._patch[self._patch.rfind(b"\n") + 1:]
+        elif self._state != "patch" and self._buffer:
+            # Output that doesn't look like header records is kept as patch text
+            self._feed_patch(bytes(self._buffer))
+        self._buffer.clear()
+
+        model = self.model
+        patch = self._patch.decode("utf-8", errors="replace")
+        if self.done:
+            model.truncated = True
+            model.patch = patch[:-1] if patch.endswith("\n") else patch
+            model.total_lines = self._estimate_total_lines()
+            model.total_lines_exact = False
+        else:
+            model.patch = patch
+            model.total_lines = self._patch_newlines + 1
+        return model
+
+    def _fields(self, pos: int, count: int) -> Optional[List[bytes]]:
+        """The next `count` NUL-terminated fields at pos, or None if not all have arrived."""
+        values = []
+        for _ in range(count):
+            end = self._buffer.find(b"\0", pos)
+            if end == -1:
+                return None
+            values.append(bytes(self._buffer[pos:end]))
+            pos = end + 1
+        return values
+
+    def _parse_header(self) -> int:
+        """Parse every complete header record in the buffer; returns the position after them."""
+        buffer = self._buffer
+        files = self.model.files
+        pos = 0
+        while self._state != "patch":
+            if self._state == "raw":
+                # ":<old mode> <new mode> <old sha> <new sha> <status>\0<path>\0[<new path>\0]"
+                if pos >= len(buffer):
+                    break
+                if buffer[pos] != ord(":"):
+                    self._state = "numstat"
+                    continue
+                fields = self._fields(pos, 2)
+                if fields is None:
+                    break
+                old_mode, new_mode, old_sha, new_sha, status = fields[0][1:].decode().split(" ")
+                if status[0] in "RC":
+                    fields = self._fields(pos, 3)
+                    if fields is None:
+                        break
+                change = FileChange(status, _path(fields[-1]), None, old_mode, new_mode, old_sha, new_sha)
+                if len(fields) == 3:
+                    change.old_path = _path(fields[1])
+                files.append(change)
+                pos += sum(len(value) + 1 for value in fields)
+
+            elif self._state == "numstat":
+                # "<added>\t<deleted>\t<path>\0" or "<added>\t<deleted>\t\0<old>\0<new>\0"
+                if self._numstat_index == len(files):
+                    self._state = "separator"
+                    continue
+                fields = self._fields(pos, 1)
+                if fields is None:
+                    break
+                parts = fields[0].split(b"\t", 2)
+                if len(parts) != 3:
+                    self._state = "patch"
+                    break
+                if not parts[2]:
+                    fields = self._fields(pos, 3)
+                    if fields is None:
+                        break
+                change = files[self._numstat_index]
+                if parts[0] != b"-":
+                    change.added, change.deleted = int(parts[0]), int(parts[1])
+                self._numstat_index += 1
+                pos += sum(len(value) + 1 for value in fields)
+
+            else:
+                # The patch (if any) follows an empty record
+                if pos >= len(buffer):
+                    break
+                if buffer[pos] == 0:
+                    pos += 1
+                self._state = "patch"
+        return pos
+
+    def _feed_patch(self, chunk: bytes) -> None:
+        if self.max_patch_lines is None:
+            self._patch += chunk
+            self._patch_newlines += chunk.count(b"\n")
+            return
+
+        limit = self.max_patch_lines - self._patch_newlines
+        newlines = chunk.count(b"\n")
+        if newlines < limit:
+            self._patch += chunk
+            self._patch_newlines += newlines
+            return
+
+        # The budget ends inside this chunk: keep up to the limit-th newline
+        cut = -1
+        for _ in range(limit):
+            cut = chunk.find(b"\n", cut + 1)
+        self._patch += chunk[:cut + 1]
+        self._patch_newlines += limit
+        if cut + 1 < len(chunk):
+            # There is more patch beyond the budget
+            self.done = True
+
+    def _estimate_total_lines(self) -> int:
+        """Estimate the full patch length from numstat for the files not streamed yet."""
+        files = self.model.files
+        seen = self._patch.count(b"\ndiff --git ") + self._patch.startswith(b"diff --git ")
+        estimate = self._patch_newlines + sum(_estimated_patch_lines(change) for change in files[seen:]) + 1
+        if 0 < seen <= len(files):
+            # The file that was cut off part way through
+            start = self._patch.rfind(b"diff --git ")
+            estimate += max(_estimated_patch_lines(files[seen - 1]) - self._patch.count(b"\n", start), 0)
+        return estimate
+
+
+def _path(value: bytes) -> str:
+    return value.decode("utf-8", errors="replace")
+
+
+def _estimated_patch_lines(change: FileChange) -> int:
+    """Rough number of patch lines git prints for a file."""
+    if change.binary:
+        return 3
+    lines = 4 if change.changed_lines else 1  # "diff --git", "index", "---", "+++"
+    if change.status[0] in "AD":
+        lines += 1  # new/deleted file mode
+    if change.status[0] in "RC":
+        lines += 3  # similarity index, rename from, rename to
+    if change.changed_lines:
+        lines += change.changed_lines + 7  # a hunk header and ~6 lines of context
+    return lines
+
+
+def parse_diff(output: Union[str, bytes], max_patch_lines: Optional[int] = None) -> DiffModel:
+    """Parse the complete output of `git diff --raw --numstat [-p] -z`."""
+    parser = DiffStreamParser(max_patch_lines)
+    parser.feed(output.encode("utf-8", errors="surrogateescape") if isinstance(output, str) else output)
+    return parser.close()
+
+
+async def read_diff(
+    base_branch: str,
+    cwd: str,
+    include_patch: bool = True,
+    max_lines: Optional[int] = None,
+    head: str = "HEAD",
+    profile: Optional[DiffProfile] = None
+) -> DiffModel:
+    """Stream the diff against base_branch, stopping git once max_lines patch lines are read.
+
+    Raises:
+        subprocess.CalledProcessError: If git fails
+    """
+    parser = DiffStreamParser(max_lines if include_patch else None)
+    result = await stream_git(diff_args(base_branch, include_patch, head, profile), cwd, parser.feed, check=True)
+    diff = parser.close(result.timed_out)
+    diff.elapsed = result.elapsed
+    return diff
+
+
+# ===== Repository metadata =====
+
+# Branches tried, in order, when the repository doesn't name its default branch
+DEFAULT_BRANCH_CANDIDATES = ("main", "master", "develop", "trunk")
+
+
+@dataclass
+class RepoRefs:
+    """The commits an analysis depends on."""
+    toplevel: str
+    git_dir: str
+    base_branch: str
+    head: str
+    merge_base: str
+    base_branch_detected: bool = False
+    elapsed: float = 0.0
+
+
+@dataclass
+class RepoMetadata:
+    """What the server knows about the repository at a working directory.
+
+    Cached values are checked against a stat fingerprint of the files that would
+    change with them (HEAD, packed-refs and the loose refs involved), so they are
+    reused until a commit, checkout or fetch touches those files.
+    """
+    toplevel: str
+    git_dir: str
+    common_dir: str
+    default_branch: Optional[str] = None
+    default_branch_signature: Optional[Tuple] = None
+    refs: Dict[str, Tuple[Tuple, RepoRefs]] = field(default_factory=dict)  # by base branch
+    config: Optional[Dict[str, List[str]]] = None  # pr-agent.* settings
+    config_signature: Optional[Tuple] = None
+
+    def head_ref(self) -> Optional[str]:
+        """The ref HEAD points to (e.g. "refs/heads/feature"), or None when detached."""
+        try:
+            head = Path(self.git_dir, "HEAD").read_text().strip()
+        except OSError:
+            return None
+        return head[5:] if head.startswith("ref: ") else None
+
+    def refs_signature(self, base_branch: str) -> Tuple:
+        """Fingerprint of everything HEAD and the merge-base with base_branch depend on."""
+        paths = [Path(self.git_dir, "HEAD"), Path(self.common_dir, "packed-refs")]
+        head_ref = self.head_ref()
+        if head_ref:
+            paths.append(Path(self.common_dir, head_ref))
+        for namespace in ("refs/heads", "refs/remotes", "refs/tags"):
+            paths.append(Path(self.common_dir, namespace, base_branch))
+        return _stat_signature(paths)
+
+    def default_branch_signature_now(self) -> Tuple:
+        """Fingerprint of what default-branch detection depends on."""
+        return _stat_signature([
+            Path(self.common_dir, "config"),
+            Path(self.common_dir, "packed-refs"),
+            Path(self.common_dir, "refs", "heads"),
+            Path(self.common_dir, "refs", "remotes", "origin", "HEAD")
+        ])
+
+
+def _stat_signature(paths: List[Path]) -> Tuple:
+    signature = []
+    for path in paths:
+        try:
+            stat = path.stat()
+            signature.append((stat.st_mtime_ns, stat.st_size, stat.st_ino))
+        except OSError:
+            signature.append(None)
+    return tuple(signature)
+
+
+_repo_metadata: Dict[str, RepoMetadata] = {}
+
+
+async def repo_metadata(cwd: str) -> RepoMetadata:
+    """The (cached) repository metadata for a working directory.
+
+    Raises:
+        subprocess.CalledProcessError: If cwd is not inside a git repository
+    """
+    metadata = _repo_metadata.get(cwd)
+    if metadata is None or not Path(metadata.git_dir, "HEAD").exists():
+        result = await run_git(["rev-parse", "--show-toplevel", "--absolute-git-dir", "--git-common-dir"], cwd, check=True)
+        toplevel, git_dir, common_dir = result.stdout.split("\n")[:3]
+        metadata = RepoMetadata(toplevel, git_dir, os.path.normpath(os.path.join(cwd, common_dir)))
+        _repo_metadata[cwd] = metadata
+    return metadata
+
+
+async def detect_default_branch(metadata: RepoMetadata, cwd: str) -> str:
+    """The branch changes should be compared against when none is given.
+
+    Tries the branch refs/remotes/origin/HEAD points to, then init.defaultBranch,
+    then DEFAULT_BRANCH_CANDIDATES, preferring a local branch over origin's.
+    """
+    signature = metadata.default_branch_signature_now()
+    if metadata.default_branch and metadata.default_branch_signature == signature:
+        return metadata.default_branch
+
+    origin_head, configured, refs = await asyncio.gather(
+        run_git(["symbolic-ref", "--quiet", "refs/remotes/origin/HEAD"], cwd),
+        run_git(["config", "--get", "init.defaultBranch"], cwd),
+        run_git(["for-each-ref", "--format=%(refname)", "refs/heads", "refs/remotes/origin"], cwd)
+    )
+    existing = set(refs.stdout.split())
+    candidates = []
+    if origin_head.returncode == 0 and origin_head.stdout.startswith("refs/remotes/origin/"):
+        candidates.append(origin_head.stdout.strip()[len("refs/remotes/origin/"):])
+    if configured.returncode == 0 and configured.stdout.strip():
+        candidates.append(configured.stdout.strip())
+    candidates.extend(DEFAULT_BRANCH_CANDIDATES)
+
+    branch = "main"
+    for name in candidates:
+        if f"refs/heads/{name}" in existing:
+            branch = name
+            break
+        if f"refs/remotes/origin/{name}" in existing:
+            branch = f"origin/{name}"
+            break
+
+    metadata.default_branch, metadata.default_branch_signature = branch, signature
+    return branch
+
+
+async def resolve_refs(base_branch: Optional[str], cwd: str) -> RepoRefs:
+    """Resolve the repository, the base branch, HEAD and their merge-base.
+
+    Args:
+        base_branch: Branch to compare against, or None to detect the default branch
+        cwd: Working directory inside the repository
+
+    Raises:
+        subprocess.CalledProcessError: If cwd is not a repository or base_branch doesn't exist
+    """
+    started = time.perf_counter()
+    metadata = await repo_metadata(cwd)
+    detected = base_branch is None
+    if detected:
+        base_branch = await detect_default_branch(metadata, cwd)
+
+    signature = metadata.refs_signature(base_branch)
+    cached = metadata.refs.get(base_branch)
+    if cached is not None and cached[0] == signature:
+        refs = cached[1]
+    else:
+        head, merge_base = await asyncio.gather(
+            run_git(["rev-parse", "HEAD"], cwd, check=True),
+            run_git(["merge-base", base_branch, "HEAD"], cwd, check=True)
+        )
+        refs = RepoRefs(metadata.toplevel, metadata.git_dir, base_branch, head.stdout.strip(), merge_base.stdout.strip())
+        metadata.refs[base_branch] = (signature, refs)
+
+    return RepoRefs(
+        refs.toplevel, refs.git_dir, refs.base_branch, refs.head, refs.merge_base,
+        detected, time.perf_counter() - started
+    )
+
+
+# Profiles that exist without any configuration
+BUILTIN_PROFILES = {
+    "full": DiffProfile(),
+    "fast": DiffProfile("fast", rename_limit=0, binary=FAST_BINARY_GLOBS)
+}
+
+
+async def repo_config(metadata: RepoMetadata, cwd: str) -> Dict[str, List[str]]:
+    """The pr-agent.* git config values, reread when the repository's config file changes."""
+    signature = _stat_signature([Path(metadata.common_dir, "config")])
+    if metadata.config is None or metadata.config_signature != signature:
+        result = await run_git(["config", "-z", "--get-regexp", r"^pr-agent\."], cwd)
+        config: Dict[str, List[str]] = {}
+        for record in result.stdout.split("\0"):
+            if record:
+                key, _, value = record.partition("\n")
+                config.setdefault(key, []).append(value)
+        metadata.config, metadata.config_signature = config, signature
+    return metadata.config
+
+
+async def load_profile(name: Optional[str], cwd: str) -> DiffProfile:
+    """The diff profile called name, as configured for the repository at cwd.
+
+    Settings in a [pr-agent "<name>"] git config section override the built-in profile
+    of that name, or define a new one:
+
+        pathspec     limit the diff to these pathspecs (repeatable, e.g. ":(exclude)vendor/")
+        renameLimit  rename detection candidates, 0 to turn rename detection off
+        diffFilter   git's --diff-filter, e.g. "AMD"
+        binary       globs diffed as binary without reading them (repeatable, replaces the
+                     defaults; an empty value clears them)
+        render       how the patch is rendered (see RENDER_MODES), e.g. "condensed"
+
+    Args:
+        name: Profile name, or None for the pr-agent.profile setting (default "full")
+        cwd: Working directory inside the repository
+
+    Raises:
+        ValueError: If the profile is neither built in nor configured, or a setting is invalid
+    """
+    metadata = await repo_metadata(cwd)
+    config = await repo_config(metadata, cwd)
+    if name is None:
+        name = config.get("pr-agent.profile", ["full"])[-1]
+
+    # git lower-cases section and key names but not the subsection (the profile name)
+    prefix = f"pr-agent.{name}."
+    settings = {key[len(prefix):]: values for key, values in config.items() if key.startswith(prefix)}
+    if name not in BUILTIN_PROFILES and not settings:
+        raise ValueError(f"Unknown diff profile '{name}'. Use 'full', 'fast' or configure [pr-agent \"{name}\"] in git config.")
+
+    changes: Dict[str, Any] = {}
+    if "pathspec" in settings:
+        changes["pathspec"] = tuple(p for p in settings["pathspec"] if p)
+    if "renamelimit" in settings:
+        try:
+            changes["rename_limit"] = int(settings["renamelimit"][-1])
+        except ValueError:
+            raise ValueError(f"pr-agent.{name}.renameLimit must be a number, not '{settings['renamelimit'][-1]}'")
+    if "difffilter" in settings:
+        changes["diff_filter"] = settings["difffilter"][-1] or None
+    if "binary" in settings:
+        changes["binary"] = tuple(glob for glob in settings["binary"] if glob)
+    if "render" in settings:
+        changes["render"] = check_render(settings["render"][-1], f"pr-agent.{name}.render")
+
+    profile = replace(BUILTIN_PROFILES.get(name, DiffProfile(name)), **changes)
+    if profile.binary:
+        profile = replace(profile, attributes_file=_write_attributes(metadata.git_dir, profile.binary))
+    return profile
+
+
+def _write_attributes(git_dir: str, globs: Tuple[str, ...]) -> str:
+    """Write (if it changed) an attributes file marking globs as binary; returns its path."""
+    path = Path(git_dir, "pr-agent-attributes")
+    content = "".join(f"{glob} -diff\n" for glob in globs)
+    try:
+        current = path.read_text()
+    except OSError:
+        current = None
+    if current != content:
+        path.write_text(content)
+    return str(path)
+
+
+def forget_repo_metadata() -> None:
+    """Drop all cached repository metadata."""
+    _repo_metadata.clear()
+
+
+# ===== Object access through persistent `git cat-file` processes =====
+
+@dataclass
+class GitObject:
+    """An object read with `git cat-file --batch` (data is None for --batch-check)."""
+    name: str
+    sha: str
+    type: str
+    size: int
+    data: Optional[bytes] = None
+
+
+class CatFileProcess:
+    """One long-lived `git cat-file --batch` (or --batch-check) process.
+
+    Requests are answered one at a time over its pipes. If the process has died or
+    its pipes break, it is restarted and the request retried once.
+    """
+
+    def __init__(self, cwd: str, check_only: bool = False):
+        self.cwd = cwd
+        self.check_only = check_only
+        self.restarts = 0
+        self.last_used = time.monotonic()
+        self.waiting = 0
+        self._process = None
+        self._lock = asyncio.Lock()
+
+    @property
+    def alive(self) -> bool:
+        return self._process is not None and self._process.returncode is None
+
+    @property
+    def busy(self) -> bool:
+        return self._lock.locked()
+
+    async def request(self, name: str) -> Optional[GitObject]:
+        """Look up an object by name (e.g. "HEAD:src/app.py"); None if it doesn't exist.
+
+        Raises:
+            DeadlineExceeded: If git doesn't answer before the deadline (the process is restarted)
+        """
+        self.waiting += 1
+        try:
+            async with self._lock:
+                for attempt in range(2):
+                    if not self.alive:
+                        if self._process is not None:
+                            self.restarts += 1
+                        await self._start()
+                    try:
+                        return await _before_deadline(self._roundtrip(name))
+                    except (BrokenPipeError, ConnectionResetError, asyncio.IncompleteReadError):
+                        self.kill()
+                        if attempt:
+                            raise
+                        # Until it is reaped, the dead process still looks alive
+                        await self._process.wait()
+                    except asyncio.TimeoutError:
+                        self.kill()
+                        raise DeadlineExceeded(f"git cat-file did not answer for {name} before the deadline")
+                    except BaseException:
+                        # A half-read answer would put the protocol out of step
+                        self.kill()
+                        raise
+        finally:
+            self.waiting -= 1
+            self.last_used = time.monotonic()
+
+    def kill(self) -> None:
+        if self.alive:
+            _kill(self._process)
+
+    async def close(self) -> None:
+        """Stop the process and wait for it to exit."""
+        if self._process is not None:
+            self.kill()
+            await self._process.wait()
+
+    async def _start(self) -> None:
+        self._process = await asyncio.create_subprocess_exec(
+            "git", "cat-file", "--batch-check" if self.check_only else "--batch",
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+            cwd=self.cwd
+        )
+
+    async def _roundtrip(self, name: str) -> Optional[GitObject]:
+        process = self._process
+        process.stdin.write(name.encode("utf-8") + b"\n")
+        await process.stdin.drain()
+
+        # "<sha> <type> <size>" or "<name> missing" / "<name> ambiguous"
+        header = await process.stdout.readline()
+        if not header:
+            raise asyncio.IncompleteReadError(header, None)
+        header = header.decode("utf-8", errors="replace").rstrip("\n")
+        if header.endswith((" missing", " ambiguous")):
+            return None
+
+        sha, object_type, size = header.split(" ")[:3]
+        obj = GitObject(name, sha, object_type, int(size))
+        if not self.check_only:
+            obj.data = (await process.stdout.readexactly(obj.size + 1))[:-1]
+        return obj
+
+
+class CatFilePool:
+    """Up to `size` cat-file processes of each kind for one working directory.
+
+    Processes are started on demand and closed after idle_timeout seconds without use.
+    """
+
+    def __init__(self, cwd: str, size: int = CAT_FILE_POOL_SIZE, idle_timeout: float = CAT_FILE_IDLE_TIMEOUT):
+        self.cwd = cwd
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self._processes: Dict[bool, List[CatFileProcess]] = {False: [], True: []}
+        self._reaper: Optional[asyncio.Task] = None
+
+    @property
+    def processes(self) -> List[CatFileProcess]:
+        return self._processes[False] + self._processes[True]
+
+    async def read(self, name: str) -> Optional[GitObject]:
+        """The object's type, size and contents, or None if it doesn't exist."""
+        return await self._pick(check_only=False).request(name)
+
+    async def info(self, name: str) -> Optional[GitObject]:
+        """The object's type and size, or None if it doesn't exist."""
+        return await self._pick(check_only=True).request(name)
+
+    async def reap_idle(self) -> int:
+        """Close processes idle for longer than idle_timeout; returns how many were closed."""
+        deadline = time.monotonic() - self.idle_timeout
+        idle = []
+        for kind, processes in self._processes.items():
+            keep = []
+            for process in processes:
+                if not process.busy and not process.waiting and process.last_used <= deadline:
+                    idle.append(process)
+                else:
+                    keep.append(process)
+            self._processes[kind] = keep
+        await asyncio.gather(*(process.close() for process in idle))
+        return len(idle)
+
+    async def close(self) -> None:
+        """Stop all processes and the idle reaper."""
+        if self._reaper is not None:
+            self._reaper.cancel()
+            self._reaper = None
+        processes = self.processes
+        self._processes = {False: [], True: []}
+        await asyncio.gather(*(process.close() for process in processes))
+
+    def _pick(self, check_only: bool) -> CatFileProcess:
+        processes = self._processes[check_only]
+        idle = next((p for p in processes if not p.busy), None)
+        if idle is not None:
+            return idle
+        if len(processes) < self.size:
+            process = CatFileProcess(self.cwd, check_only)
+            processes.append(process)
+            self._start_reaper()
+            return process
+        return min(processes, key=lambda p: p.waiting)
+
+    def _start_reaper(self) -> None:
+        if self._reaper is None or self._reaper.done():
+            self._reaper = asyncio.ensure_future(self._reap_periodically())
+
+    async def _reap_periodically(self) -> None:
+        while self.processes:
+            await asyncio.sleep(self.idle_timeout / 2)
+            await self.reap_idle()
+
+
+# Pools by working directory, one set per event loop (their pipes belong to that loop)
+_cat_file_pools: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[str, CatFilePool]]" = weakref.WeakKeyDictionary()
+
+
+def cat_file_pool(cwd: str) -> CatFilePool:
+    """The cat-file pool for a working directory."""
+    pools = _cat_file_pools.setdefault(asyncio.get_running_loop(), {})
+    if cwd not in pools:
+        pools[cwd] = CatFilePool(cwd)
+    return pools[cwd]
+
+
+def _describe_blob(obj: Optional[GitObject], max_bytes: int) -> Dict[str, Any]:
+    if obj is None:
+        return {"exists": False}
+    info = {"exists": True, "sha": obj.sha, "size": obj.size}
+    if b"\0" in obj.data[:8000]:
+        info["binary"] = True
+        return info
+    info["content"] = obj.data[:max_bytes].decode("utf-8", errors="replace")
+    info["truncated"] = obj.size > max_bytes
+    return info
+
+
+async def read_file_versions(
+    base_branch: Optional[str],
+    cwd: str,
+    path: str,
+    max_bytes: int = 20000
+) -> Dict[str, Any]:
+    """A file's contents at the merge-base with base_branch and at HEAD.
+
+    Raises:
+        subprocess.CalledProcessError: If the refs can't be resolved
+    """
+    refs = await resolve_refs(base_branch, cwd)
+    pool = cat_file_pool(cwd)
+    base, head = await asyncio.gather(
+        pool.read(f"{refs.merge_base}:{path}"),
+        pool.read(f"{refs.head}:{path}")
+    )
+    return {
+        "path": path,
+        "base_branch": refs.base_branch,
+        "base": {"commit": refs.merge_base, **_describe_blob(base, max_bytes)},
+        "head": {"commit": refs.head, **_describe_blob(head, max_bytes)}
+    }
+
+
+# ===== Semantic summary of Python changes =====
+
+# The error SymbolParser.symbols() reports when a worker died instead of answering
+PARSER_FAILED = "the parser process failed"
+
+
+def python_symbols(source: bytes) -> Dict[str, Any]:
+    """The classes and functions defined in a Python module, by qualified name, and what it imports.
+
+    Each symbol has its kind, first line and a digest of its definition that ignores
+    positions and comments; a class's digest leaves out the functions and classes nested
+    in it, which are symbols of their own. Imports are module names as written (relative
+    ones keep their leading dots); `from m import n` gives both m and m.n, since n may
+    be a submodule. Runs in the parse worker processes.
+    """
+    try:
+        tree = ast.parse(source)
+    except (SyntaxError, ValueError) as e:
+        return {"error": f"{type(e).__name__}: {e}"}
+
+    symbols = {}
+    definitions = (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)
+
+    def visit(body: List[ast.stmt], prefix: str, in_class: bool) -> None:
+        for node in body:
+            if not isinstance(node, definitions):
+                continue
+            name = prefix + node.name
+            nested = [child for child in node.body if isinstance(child, definitions)]
+            # The definition without its nested ones
+            own = type(node)(**{field_name: getattr(node, field_name, None) for field_name in node._fields})
+            own.body = [child for child in node.body if not isinstance(child, definitions)]
+            if isinstance(node, ast.ClassDef):
+                kind = "class"
+            else:
+                kind = "method" if in_class else "function"
+            digest = hashlib.sha1(ast.dump(own, include_attributes=False).encode()).hexdigest()[:16]
+            symbols[name] = {"kind": kind, "line": node.lineno, "digest": digest}
+            visit(nested, name + ".", isinstance(node, ast.ClassDef))
+
+    visit(tree.body, "", False)
+
+    imports = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            imports += [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom):
+            module = "." * node.level + (node.module or "")
+            separator = "." if node.module else ""
+            imports += [module] + [module + separator + alias.name for alias in node.names if alias.name != "*"]
+    return {"symbols": symbols, "imports": list(dict.fromkeys(imports))}
+
+
+def _compare_symbols(base: Dict[str, Any], head: Dict[str, Any]) -> Dict[str, List[str]]:
+    return {
+        "added": [name for name in head if name not in base],
+        "removed": [name for name in base if name not in head],
+        "modified": [name for name in head if name in base and head[name]["digest"] != base[name]["digest"]]
+    }
+
+
+class SymbolParser:
+    """Parses Python blobs in a process pool, memoizing the symbols of each blob by its SHA."""
+
+    def __init__(self, workers: int = PARSE_WORKERS, max_entries: int = 4096):
+        self.workers = workers
+        self.max_entries = max_entries
+        self.parsed = 0
+        self._cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    def cached(self, sha: str) -> Optional[Dict[str, Any]]:
+        symbols = self._cache.get(sha)
+        if symbols is not None:
+            self._cache.move_to_end(sha)
+        return symbols
+
+    async def symbols(self, obj: GitObject) -> Dict[str, Any]:
+        """python_symbols() of a blob."""
+        symbols = self.cached(obj.sha)
+        if symbols is not None:
+            return symbols
+        if self._executor is None:
+            # spawn: forking a process that runs an event loop and threads isn't safe
+            self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+        try:
+            symbols = await governor().coalesce(
+                ("symbols", obj.sha),
+                lambda: asyncio.get_running_loop().run_in_executor(self._executor, python_symbols, obj.data)
+            )
+        except BrokenProcessPool:
+            # A worker died (killed, out of memory...); the next parse starts a new pool
+            self.shutdown()
+            return {"error": PARSER_FAILED}
+        self.parsed += 1
+        self._cache[obj.sha] = symbols
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+        return symbols
+
+    def clear(self) -> None:
+        self._cache.clear()
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+            self._executor = None
+
+
+symbol_parser = SymbolParser()
+
+
+async def semantic_summary(files: List[FileChange], cwd: str) -> Dict[str, Any]:
+    """Which classes and functions the changes to Python files added, removed, modified or moved.
+
+    Both versions of each .py file are read by blob SHA and parsed (see SymbolParser). A
+    definition removed in one place and added unchanged under the same name in another
+    (another file, or into or out of a class) is reported once, as moved.
+    """
+    pool = cat_file_pool(cwd)
+    changes = [c for c in files if c.path.endswith(".py") or (c.old_path or "").endswith(".py")]
+    counts = {"parsed": 0, "memoized": 0}
+
+    async def load(sha: str) -> Dict[str, Any]:
+        if not sha.strip("0"):
+            # The file doesn't exist on this side
+            return {"symbols": {}}
+        info = await pool.info(sha)
+        if info is None or info.size > PARSE_MAX_BYTES:
+            return {"error": f"blob {sha} is missing or too large to parse"}
+        known = symbol_parser.cached(info.sha)
+        if known is not None:
+            counts["memoized"] += 1
+            return known
+        obj = await pool.read(info.sha)
+        if obj is None:
+            return {"error": f"blob {sha} is missing"}
+        counts["parsed"] += 1
+        return await symbol_parser.symbols(obj)
+
+    versions = await asyncio.gather(*(
+        asyncio.gather(load(change.old_sha), load(change.new_sha)) for change in changes
+    ))
+
+    compared: Dict[str, Dict[str, List[str]]] = {}
+    head_symbols: Dict[str, Dict[str, Any]] = {}
+    errors = {}
+    removed: Dict[Tuple[str, str], List[Tuple[str, str]]] = {}  # (name, digest) -> [(path, qualified name)]
+    for change, (base, head) in zip(changes, versions):
+        if "error" in base or "error" in head:
+            errors[change.path] = base.get("error") or head.get("error")
+            continue
+        compared[change.path] = _compare_symbols(base["symbols"], head["symbols"])
+        head_symbols[change.path] = head["symbols"]
+        for name in compared[change.path]["removed"]:
+            removed.setdefault((name.rsplit(".", 1)[-1], base["symbols"][name]["digest"]), []).append((change.path, name))
+
+    moved = []
+    for path, symbols in compared.items():
+        for name in list(symbols["added"]):
+            candidates = removed.get((name.rsplit(".", 1)[-1], head_symbols[path][name]["digest"]))
+            if not candidates:
+                continue
+            source_path, source_name = candidates.pop(0)
+            compared[source_path]["removed"].remove(source_name)
+            symbols["added"].remove(name)
+            moved.append({"symbol": name, "from": {"path": source_path, "symbol": source_name}, "to": {"path": path, "symbol": name}})
+
+    return {
+        "files": {path: symbols for path, symbols in compared.items() if any(symbols.values())},
+        "moved": moved,
+        "errors": errors,
+        "blobs_parsed": counts["parsed"],
+        "blobs_memoized": counts["memoized"]
+    }
+
+
+# ===== Dependency manifests and lockfiles =====
+
+# Lockfiles whose changes are summarized as package versions instead of diffed line by line
+LOCKFILES = ("uv.lock", "poetry.lock")
+MANIFESTS = ("pyproject.toml",)
+LOCKFILE_GLOBS = tuple(f"**/{name}" for name in LOCKFILES)
+
+
+def _package_name(requirement: str) -> Optional[str]:
+    """The normalized project name of a PEP 508 requirement ("Foo_Bar[x]>=1" -> "foo-bar")."""
+    name = requirement.strip()
+    end = next((i for i, char in enumerate(name) if not (char.isalnum() or char in "-_.")), len(name))
+    if not end:
+        return None
+    return "-".join(name[:end].lower().replace("_", "-").replace(".", "-").split("-"))
+
+
+def _version_key(version: str) -> Tuple[int, ...]:
+    key = []
+    for part in version.replace("-", ".").split("."):
+        digits = "".join(char for char in part if char.isdigit())
+        key.append(int(digits) if digits else 0)
+    return tuple(key)
+
+
+def _lockfile_packages(document: Dict[str, Any]) -> Dict[str, str]:
+    """{package: version} of a uv.lock or poetry.lock; several locked versions are joined with ", "."""
+    versions: Dict[str, List[str]] = {}
+    for package in document.get("package", []):
+        name = _package_name(str(package.get("name", "")))
+        if name:
+            versions.setdefault(name, []).append(str(package.get("version", "")))
+    return {name: ", ".join(sorted(set(found), key=_version_key)) for name, found in versions.items()}
+
+
+def _manifest_requirements(document: Dict[str, Any]) -> Dict[str, str]:
+    """{"<group>:<package>": requirement} of a pyproject.toml, over every dependency list it declares."""
+    project = document.get("project", {})
+    groups = {"project": project.get("dependencies", [])}
+    for extra, requirements in project.get("optional-dependencies", {}).items():
+        groups[f"optional:{extra}"] = requirements
+    for group, requirements in document.get("dependency-groups", {}).items():
+        groups[f"group:{group}"] = requirements
+    groups["dev"] = document.get("tool", {}).get("uv", {}).get("dev-dependencies", [])
+
+    requirements = {}
+    for group, entries in groups.items():
+        for entry in entries:
+            # Skips {include-group = ...} tables
+            name = _package_name(entry) if isinstance(entry, str) else None
+            if name:
+                requirements[f"{group}:{name}"] = entry.strip()
+    return requirements
+
+
+# Parsed manifests and lockfiles by (kind, blob SHA); lockfiles rarely change between analyses
+_dependency_versions: "OrderedDict[Tuple[bool, str], Dict[str, str]]" = OrderedDict()
+DEPENDENCY_CACHE_SIZE = 64
+
+
+def _dependency_version(lockfile: bool, obj: Optional[GitObject]) -> Dict[str, str]:
+    if obj is None:
+        return {}
+    key = (lockfile, obj.sha)
+    if key in _dependency_versions:
+        _dependency_versions.move_to_end(key)
+        return _dependency_versions[key]
+    document = tomllib.loads(obj.data.decode("utf-8"))
+    versions = _lockfile_packages(document) if lockfile else _manifest_requirements(document)
+    _dependency_versions[key] = versions
+    if len(_dependency_versions) > DEPENDENCY_CACHE_SIZE:
+        _dependency_versions.popitem(last=False)
+    return versions
+
+
+def compare_dependencies(path: str, before: Dict[str, str], after: Dict[str, str]) -> Dict[str, Any]:
+    """The packages added, removed and changed between two versions of a lockfile or pyproject.toml.
+
+    Lockfiles compare locked versions (with the direction of each change); pyproject.toml
+    compares the declared requirements, keyed by "<group>:<package>".
+    """
+    lockfile = os.path.basename(path) in LOCKFILES
+    changed = []
+    for name in sorted(before.keys() & after.keys()):
+        if before[name] == after[name]:
+            continue
+        change = {"name": name, "from": before[name], "to": after[name]}
+        if lockfile and ", " not in before[name] + after[name]:
+            change["direction"] = "upgrade" if _version_key(after[name]) > _version_key(before[name]) else "downgrade"
+        changed.append(change)
+    return {
+        "path": path,
+        "kind": "lockfile" if lockfile else "manifest",
+        "added": [{"name": name, "version": after[name]} for name in sorted(after.keys() - before.keys())],
+        "removed": [{"name": name, "version": before[name]} for name in sorted(before.keys() - after.keys())],
+        "changed": changed
+    }
+
+
+async def dependency_changes(
+    refs: RepoRefs, cwd: str, profile: DiffProfile
+) -> Tuple[List[Dict[str, Any]], List[FileChange]]:
+    """compare_dependencies() for every lockfile and pyproject.toml changed between the merge-base and HEAD.
+
+    Only files within the profile's pathspec are digested. Lockfile entries also carry
+    their added and deleted line counts, since their patches are left out of the diff;
+    the lockfiles' own FileChanges are returned alongside for the analysis' file list.
+    """
+    scope = profile.pathspec or tuple(f":(glob)**/{name}" for name in LOCKFILES + MANIFESTS)
+    scope_profile = DiffProfile("dependencies", pathspec=scope, exclude=profile.exclude, rename_limit=0)
+    diff = await read_diff(refs.merge_base, cwd, include_patch=False, head=refs.head, profile=scope_profile)
+    if diff.timed_out:
+        raise DeadlineExceeded("The dependency files could not be listed before the deadline")
+    pool = cat_file_pool(cwd)
+
+    async def compare(change: FileChange) -> Dict[str, Any]:
+        lockfile = os.path.basename(change.path) in LOCKFILES
+        base, head = await asyncio.gather(*(
+            pool.read(sha) if sha.strip("0") else asyncio.sleep(0) for sha in (change.old_sha, change.new_sha)
+        ))
+        try:
+            entry = compare_dependencies(
+                change.path, _dependency_version(lockfile, base), _dependency_version(lockfile, head)
+            )
+        except (ValueError, UnicodeDecodeError) as e:
+            entry = {"path": change.path, "error": f"Could not parse: {e}"}
+        if lockfile:
+            entry.update({"added_lines": change.added, "deleted_lines": change.deleted})
+        return entry
+
+    changes = [change for change in diff.files if os.path.basename(change.path) in LOCKFILES + MANIFESTS]
+    entries = list(await asyncio.gather(*(compare(change) for change in changes)))
+    return entries, [change for change in changes if os.path.basename(change.path) in LOCKFILES]
+
+
+# ===== Ignored paths (.pr-agent-ignore) =====
+
+# gitignore-syntax file at the top of the working tree listing paths left out of the diff
+IGNORE_FILE = ".pr-agent-ignore"
+# How many omitted files are listed by name; the totals cover all of them
+OMITTED_MAX_FILES = 100
+# How many paths git is given to exclude one by one (see without_ignored())
+IGNORE_MAX_PATHS = 256
+
+
+def _ignore_regex(pattern: str) -> str:
+    """A regular expression for one gitignore pattern (without "!" or a trailing "/")."""
+    anchored = "/" in pattern
+    pattern = pattern.lstrip("/")
+    out = []
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if pattern.startswith("**", i) and (i == 0 or pattern[i - 1] == "/") and pattern[i + 2:i + 3] in ("", "/"):
+            # "**/" is any number of directories; a trailing "/**" is everything inside
+            out.append(".*" if i + 2 == len(pattern) else "(?:.*/)?")
+            i += 3
+            continue
+        if char == "*":
+            out.append("[^/]*")
+        elif char == "?":
+            out.append("[^/]")
+        elif char == "[" and pattern.find("]", i + 2) != -1:
+            end = pattern.find("]", i + 2)
+            body = pattern[i + 1:end].replace("\\", "\\\\").replace("[", "\\[")
+            out.append("[" + ("^" + body[1:] if body[0] in "!^" else body) + "]")
+            i = end
+        elif char == "\\" and i + 1 < len(pattern):
+            i += 1
+            out.append(re.escape(pattern[i]))
+        else:
+            out.append(re.escape(char))
+        i += 1
+    return "".join(out) if anchored else "(?:.*/)?" + "".join(out)
+
+
+class IgnoreRules:
+    """The patterns of a .pr-agent-ignore file, compiled into two regular expressions.
+
+    Matching follows gitignore: the last matching pattern wins, "!" re-includes, a
+    trailing "/" only matches directories, and a file inside an ignored directory stays
+    ignored. The patterns are joined last-first into one alternation per kind of path
+    (directories, files), so one match finds the deciding pattern.
+    """
+
+    def __init__(self, text: str):
+        rules = []  # (negate, directories only, regex, pathspec globs)
+        patterns = []
+        for line in text.splitlines():
+            if not line.strip() or line.startswith("#"):
+                continue
+            pattern = line.rstrip()
+            if pattern.endswith("\\"):
+                # An escaped trailing space
+                pattern += " "
+            negate = pattern.startswith("!")
+            pattern = pattern[1:] if negate else pattern
+            directory = pattern.endswith("/")
+            pattern = pattern.rstrip("/")
+            if not pattern:
+                continue
+            glob = pattern.lstrip("/") if "/" in pattern else f"**/{pattern}"
+            globs = (f"{glob}/**",) if directory else (glob, f"{glob}/**")
+            rules.append((negate, directory, _ignore_regex(pattern), globs))
+            patterns.append(line.rstrip())
+
+        self.patterns = tuple(patterns)
+        # Every ignored file is within these globs (re-included ones may be too)
+        self.scope = tuple(f":(glob){glob}" for negate, _, _, globs in rules if not negate for glob in globs)
+        last_first = rules[::-1]
+        files = [rule for rule in last_first if not rule[1]]
+        self._directories = re.compile("|".join(f"({regex})" for _, _, regex, _ in last_first) or "(?!)")
+        self._directories_negated = [negate for negate, _, _, _ in last_first]
+        self._files = re.compile("|".join(f"({regex})" for _, _, regex, _ in files) or "(?!)")
+        self._files_negated = [negate for negate, _, _, _ in files]
+        self._directory_cache: Dict[str, bool] = {}
+
+        # Nothing can re-include what a pattern after the last "!" ignores, so git can
+        # exclude those with their globs; the rest have to be excluded file by file
+        last_negation = max((i for i, rule in enumerate(rules) if rule[0]), default=-1)
+        self.exclude_globs = tuple(glob for _, _, _, globs in rules[last_negation + 1:] for glob in globs)
+        self._final = self if last_negation == -1 else IgnoreRules("\n".join(patterns[last_negation + 1:]))
+
+    def __bool__(self) -> bool:
+        return bool(self.patterns)
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, IgnoreRules) and other.patterns == self.patterns
+
+    def __hash__(self) -> int:
+        return hash(self.patterns)
+
+    def _directory_ignored(self, path: str) -> bool:
+        ignored = self._directory_cache.get(path)
+        if ignored is None:
+            match = self._directories.fullmatch(path)
+            ignored = bool(match) and not self._directories_negated[match.lastindex - 1]
+            self._directory_cache[path] = ignored
+        return ignored
+
+    def ignored(self, path: str) -> bool:
+        """Whether the file at path (relative to the top of the repository) is ignored."""
+        end = path.find("/")
+        while end != -1:
+            if self._directory_ignored(path[:end]):
+                return True
+            end = path.find("/", end + 1)
+        match = self._files.fullmatch(path)
+        return bool(match) and not self._files_negated[match.lastindex - 1]
+
+    def excluded_by_globs(self, path: str) -> bool:
+        """Whether exclude_globs leave path out of git's diffs."""
+        return self._final.ignored(path)
+
+
+# Compiled rules by ignore file path, with the (mtime, size) they were read at
+_ignore_rules: Dict[str, Tuple[Tuple[int, int], IgnoreRules]] = {}
+
+
+def ignore_rules(toplevel: str) -> Optional[IgnoreRules]:
+    """The repository's .pr-agent-ignore rules, recompiled only when the file changes; None without any."""
+    path = os.path.join(toplevel, IGNORE_FILE)
+    try:
+        stat = os.stat(path)
+    except OSError:
+        _ignore_rules.pop(path, None)
+        return None
+    fingerprint = (stat.st_mtime_ns, stat.st_size)
+    cached = _ignore_rules.get(path)
+    if cached is None or cached[0] != fingerprint:
+        with open(path, encoding="utf-8", errors="replace") as f:
+            cached = (fingerprint, IgnoreRules(f.read()))
+        _ignore_rules[path] = cached
+    return cached[1] or None
+
+
+def _glob_escape(path: str) -> str:
+    return "".join(f"\\{char}" if char in "\\*?[" else char for char in path)
+
+
+# Ignored files by (repository, merge-base, HEAD, profile, rules)
+_ignored: "OrderedDict[Tuple, List[FileChange]]" = OrderedDict()
+IGNORED_CACHE_SIZE = 32
+
+
+async def ignored_changes(refs: RepoRefs, cwd: str, profile: DiffProfile, rules: IgnoreRules) -> List[FileChange]:
+    """The changed files (with line counts) that rules ignore.
+
+    Only the files within the rules' globs (or the profile's pathspec) are listed, and
+    without their patches; the result is kept for the same refs, profile and rules.
+
+    Raises:
+        DeadlineExceeded: If the files can't be listed before the deadline
+    """
+    key = (refs.toplevel, refs.merge_base, refs.head, profile, rules)
+    if key in _ignored:
+        _ignored.move_to_end(key)
+        return _ignored[key]
+
+    async def list_ignored() -> List[FileChange]:
+        scope = replace(profile, pathspec=profile.pathspec or rules.scope)
+        listing = await read_diff(refs.merge_base, cwd, include_patch=False, head=refs.head, profile=scope)
+        if listing.timed_out:
+            raise DeadlineExceeded(f"The files matching {IGNORE_FILE} could not be listed before the deadline")
+        return [change for change in listing.files if rules.ignored(change.path)]
+
+    ignored = await governor().coalesce(("ignored", key), list_ignored)
+    _ignored[key] = ignored
+    if len(_ignored) > IGNORED_CACHE_SIZE:
+        _ignored.popitem(last=False)
+    return ignored
+
+
+def without_ignored(profile: DiffProfile, rules: IgnoreRules, ignored: List[FileChange]) -> Tuple[DiffProfile, int]:
+    """profile with the ignored files excluded; returns (profile, ignored files git still diffs).
+
+    The rules' exclude_globs are passed to git as they are. Only the paths they don't
+    cover (files re-included by a "!" and ignored again, or the old side of a rename)
+    are excluded one by one, up to IGNORE_MAX_PATHS so the command line stays short.
+    """
+    paths = list(dict.fromkeys(
+        path for change in ignored for path in (change.old_path, change.path)
+        if path and not rules.excluded_by_globs(path)
+    ))
+    exclude = rules.exclude_globs + tuple(_glob_escape(path) for path in paths[:IGNORE_MAX_PATHS])
+    return replace(profile, exclude=profile.exclude + exclude), max(len(paths) - IGNORE_MAX_PATHS, 0)
+
+
+def omitted_summary(ignored: List[FileChange], not_excluded: int = 0) -> Dict[str, Any]:
+    """A compact summary of the files left out by .pr-agent-ignore, with their line counts.
+
+    not_excluded counts the paths that were past IGNORE_MAX_PATHS and are still in the diff.
+    """
+    summary = {
+        "rules": IGNORE_FILE,
+        "files": [
+            {"path": change.path, "added": change.added, "deleted": change.deleted}
+            for change in ignored[:OMITTED_MAX_FILES]
+        ],
+        "total_files": len(ignored),
+        "total_added": sum(change.added or 0 for change in ignored),
+        "total_deleted": sum(change.deleted or 0 for change in ignored)
+    }
+    if not_excluded:
+        summary["not_excluded"] = not_excluded
+    return summary
+
+
+# ===== Structured commit history =====
+
+# One header record per commit; fields are separated by \x1f so subjects may contain anything else
+LOG_FORMAT = "%x1e%H%x1f%P%x1f%an%x1f%ae%x1f%aI%x1f%s"
+
+
+@dataclass
+class Commit:
+    """One commit of `git log --numstat`, with the lines each file gained and lost."""
+    sha: str
+    parents: List[str]
+    author: str
+    email: str
+    date: str  # ISO 8601 author date
+    subject: str
+    files: List[FileChange] = field(default_factory=list)
+
+    def to_dict(self) -> Dict[str, Any]:
+        files = []
+        for change in self.files:
+            entry = {"path": change.path, "added": change.added, "deleted": change.deleted}
+            if change.old_path is not None:
+                entry["old_path"] = change.old_path
+            files.append(entry)
+        return {
+            "sha": self.sha,
+            "parents": self.parents,
+            "author": self.author,
+            "email": self.email,
+            "date": self.date,
+            "subject": self.subject,
+            "files": files,
+            "added": sum(change.added or 0 for change in self.files),
+            "deleted": sum(change.deleted or 0 for change in self.files)
+        }
+
+
+class CommitLogParser:
+    """Incremental parser for `git log -z --numstat --format=LOG_FORMAT`.
+
+    Every record is NUL-terminated: a commit header starting with \x1e, then one
+    numstat record per file ("<added>\t<deleted>\t<path>", or "<added>\t<deleted>\t"
+    followed by the old and new path for a rename). Once max_commits commits are
+    complete and the next one starts, the rest of the output is not needed.
+    """
+
+    def __init__(self, max_commits: Optional[int] = None):
+        self.max_commits = max_commits
+        self.commits: List[Commit] = []
+        self.has_more = False
+        self._buffer = bytearray()
+
+    def feed(self, chunk: bytes) -> bool:
+        """Consume a chunk of output; returns True once no more output is needed."""
+        if self.has_more:
+            return True
+        self._buffer += chunk
+        pos = 0
+        buffer = self._buffer
+        while not self.has_more:
+            end = buffer.find(b"\0", pos)
+            if end == -1:
+                break
+            record = bytes(buffer[pos:end]).lstrip(b"\n")
+            if record.startswith(b"\x1e"):
+                if self.max_commits is not None and len(self.commits) == self.max_commits:
+                    self.has_more = True
+                    break
+                sha, parents, author, email, date, subject = _path(record[1:]).split("\x1f", 5)
+                self.commits.append(Commit(sha, parents.split(), author, email, date, subject))
+                pos = end + 1
+                continue
+
+            parts = record.split(b"\t", 2)
+            if len(parts) != 3 or not self.commits:
+                pos = end + 1
+                continue
+            # numstat doesn't say how a file changed, so status is left empty
+            change = FileChange("", _path(parts[2]))
+            if not parts[2]:
+                # A rename: the old and new paths follow as records of their own
+                old_end = buffer.find(b"\0", end + 1)
+                new_end = buffer.find(b"\0", old_end + 1) if old_end != -1 else -1
+                if new_end == -1:
+                    break
+                change.old_path = _path(bytes(buffer[end + 1:old_end]))
+                change.path = _path(bytes(buffer[old_end + 1:new_end]))
+                end = new_end
+            if parts[0] != b"-":
+                change.added, change.deleted = int(parts[0]), int(parts[1])
+            self.commits[-1].files.append(change)
+            pos = end + 1
+        del buffer[:pos]
+        return self.has_more
+
+
+def _commit_cursor(head: str, offset: int) -> str:
+    return f"{head}:{offset}"
+
+
+def _parse_commit_cursor(cursor: str) -> Tuple[str, int]:
+    head, _, offset = cursor.rpartition(":")
+    if len(head) < 40 or any(char not in "0123456789abcdef" for char in head) or not offset.isdigit():
+        raise ValueError(f"Invalid cursor '{cursor}'. Pass the next_cursor of a previous page.")
+    return head, int(offset)
+
+
+async def read_commit_history(
+    base_branch: Optional[str],
+    cwd: str,
+    cursor: Optional[str] = None,
+    max_commits: int = 50
+) -> Dict[str, Any]:
+    """The commits on HEAD that aren't on base_branch, newest first, with their files.
+
+    One `git log --numstat -z` is streamed and stopped once max_commits commits are
+    read. next_cursor continues from there; it is pinned to the HEAD of the first
+    page, so commits made in between don't shift the pages. If the deadline passes,
+    the commits read so far are returned with timed_out set.
+
+    Raises:
+        subprocess.CalledProcessError: If git fails
+        ValueError: If the cursor is invalid
+    """
+    if max_commits < 1:
+        raise ValueError("max_commits must be at least 1")
+    refs = await resolve_refs(base_branch, cwd)
+    head, offset = _parse_commit_cursor(cursor) if cursor else (refs.head, 0)
+
+    parser = CommitLogParser(max_commits)
+    args = ["log", "-z", "--numstat", f"--format={LOG_FORMAT}", f"--skip={offset}", f"{refs.base_branch}..{head}"]
+    result = await stream_git(args, cwd, parser.feed, check=True)
+    if result.timed_out and parser.commits:
+        # The last commit's file list may be incomplete
+        parser.commits.pop()
+    has_more = parser.has_more or result.timed_out
+    end = offset + len(parser.commits)
+    return {
+        "base_branch": refs.base_branch,
+        "head": head,
+        "commits": [commit.to_dict() for commit in parser.commits],
+        "offset": offset,
+        "has_more": has_more,
+        "next_cursor": _commit_cursor(head, end) if has_more else None,
+        "timed_out": result.timed_out,
+        "git_timings_ms": timings_ms({"refs": refs, "log": result})
+    }
+
+
+# ===== Change-type classification =====
+
+# Conventional-commit types ("fix: ...", "feat(api)!: ...") and the change type each implies
+COMMIT_PREFIXES = {
+    "fix": "bug",
+    "bugfix": "bug",
+    "hotfix": "bug",
+    "feat": "feature",
+    "feature": "feature",
+    "docs": "docs",
+    "doc": "docs",
+    "refactor": "refactor",
+    "style": "refactor",
+    "chore": "refactor",
+    "test": "test",
+    "tests": "test",
+    "perf": "performance",
+    "security": "security",
+    "sec": "security"
+}
+
+# Word stems in commit subjects and the summary that hint at a change type
+CHANGE_KEYWORDS = {
+    "bug": ("fix", "bug", "crash", "error", "broken", "regression", "wrong", "incorrect", "fail"),
+    "feature": ("add", "new", "support", "implement", "introduc", "allow", "enable"),
+    "docs": ("doc", "readme", "typo", "guide", "changelog", "tutorial"),
+    "refactor": ("refactor", "clean", "rename", "move", "simplif", "extract", "reorganiz", "restructur", "tidy"),
+    "test": ("test", "coverage", "fixture", "mock"),
+    "performance": ("perf", "fast", "speed", "slow", "optimi", "cache", "latency", "memory", "throughput"),
+    "security": ("secur", "vulnerab", "cve", "xss", "csrf", "inject", "sanitiz", "escap", "permission", "secret", "credential")
+}
+
+DOC_EXTENSIONS = (".md", ".rst", ".txt", ".adoc")
+
+# Whole words (of a path split at punctuation and camelCase) that mark security-related files
+SECURITY_PATH_WORDS = (
+    "security", "auth", "authn", "authz", "authentication", "authorization",
+    "crypto", "cryptography", "permission", "permissions", "secret", "secrets"
+)
+
+
+def path_change_type(path: str) -> Optional[str]:
+    """The change type a file's path alone suggests (docs, test, security, performance), or None for code."""
+    lower = path.lower()
+    parts = lower.split("/")
+    name = parts[-1]
+    if (
+        any(part in ("test", "tests", "__tests__", "spec", "specs") for part in parts[:-1])
+        or name.startswith("test_") or name == "conftest.py"
+        or any(marker in name for marker in ("_test.", ".test.", ".spec."))
+    ):
+        return "test"
+    if (
+        any(part in ("docs", "doc") for part in parts[:-1])
+        or name.endswith(DOC_EXTENSIONS) or name.startswith(("readme", "changelog"))
+    ):
+        return "docs"
+    words = {word.lower() for word in re.findall(r"[A-Z]+(?![a-z])|[A-Z]?[a-z]+", path)}
+    if words.intersection(SECURITY_PATH_WORDS):
+        return "security"
+    if any(part.startswith(("bench", "perf")) for part in parts):
+        return "performance"
+    return None
+
+
+def classify_changes(files: List[FileChange], subjects: List[str], summary: str = "") -> List[Dict[str, Any]]:
+    """Rank the change types by how well files, commit subjects and summary fit them.
+
+    Each signal adds to a type's score: the share of changed lines in documentation,
+    test, security or benchmark paths (up to 3), the shape of the code changes from
+    numstat (new files, renames, deletions, small edits; up to 2), conventional-commit
+    prefixes (up to 3, shared between the commits) and keywords (up to 2). Confidence
+    is a type's share of all the points. The result is ordered best first.
+    """
+    scores: Dict[str, float] = {change_type: 0.0 for change_type in CHANGE_KEYWORDS}
+    reasons: Dict[str, List[str]] = {change_type: [] for change_type in CHANGE_KEYWORDS}
+
+    def add(change_type: str, points: float, reason: str) -> None:
+        if points > 0:
+            scores[change_type] += points
+            reasons[change_type].append(reason)
+
+    # Paths, weighted by changed lines so a one-line README touch doesn't outvote the code
+    def weight(change: FileChange) -> int:
+        return 1 + change.changed_lines
+
+    total = sum(weight(change) for change in files)
+    by_type: Dict[Optional[str], List[FileChange]] = {}
+    for change in files:
+        by_type.setdefault(path_change_type(change.path), []).append(change)
+    for change_type, changes in by_type.items():
+        if change_type is not None:
+            share = sum(weight(change) for change in changes) / total
+            add(change_type, 3 * share, f"{len(changes)} of {len(files)} files are {change_type} files")
+
+    # The shape of the code changes
+    code = by_type.get(None, [])
+    if code:
+        code_weight = sum(weight(change) for change in code)
+        share = code_weight / total
+        added = [change for change in code if change.status.startswith("A")]
+        renamed = [change for change in code if change.status.startswith("R")]
+        inserted = sum(change.added or 0 for change in code)
+        removed = sum(change.deleted or 0 for change in code)
+        if added:
+            add("feature", 2 * share * sum(weight(c) for c in added) / code_weight, f"{len(added)} new code files")
+        if renamed:
+            add("refactor", 2 * share * len(renamed) / len(code), f"{len(renamed)} code files moved or renamed")
+        if removed > inserted:
+            add("refactor", share, f"more code deleted ({removed}) than added ({inserted})")
+        if not added and not renamed and inserted + removed <= 20:
+            add("bug", share, f"small edit ({inserted + removed} lines) to existing code")
+
+    # Conventional-commit prefixes
+    prefixed: Dict[str, List[str]] = {}
+    for subject in subjects:
+        prefix = subject.split(":", 1)[0].split("(", 1)[0].rstrip("!").strip().lower() if ":" in subject else ""
+        if prefix in COMMIT_PREFIXES:
+            prefixed.setdefault(COMMIT_PREFIXES[prefix], []).append(prefix)
+    for change_type, prefixes in prefixed.items():
+        add(
+            change_type, 3 * len(prefixes) / len(subjects),
+            f"{len(prefixes)} of {len(subjects)} commits start with {prefixes[0]}:"
+        )
+
+    # Keywords, at the start of words
+    words = [word for text in [*subjects, summary] for word in "".join(
+        char if char.isalnum() else " " for char in text.lower()
+    ).split()]
+    for change_type, stems in CHANGE_KEYWORDS.items():
+        hits = sorted({word for word in words for stem in stems if word.startswith(stem)})
+        add(change_type, min(0.5 * len(hits), 2), f"keywords: {', '.join(hits)}")
+
+    points = sum(scores.values())
+    ranking = [
+        {
+            "type": change_type,
+            "score": round(score, 2),
+            "confidence": round(score / points, 2) if points else 0.0,
+            "reasons": reasons[change_type]
+        }
+        for change_type, score in scores.items()
+    ]
+    # Without any signal, a feature is the safest guess
+    ranking.sort(key=lambda entry: (-entry["score"], entry["type"] != "feature"))
+    return ranking
+
+
+async def classify_branch(base_branch: Optional[str], cwd: str, summary: str = "") -> Dict[str, Any]:
+    """classify_changes() for the branch's changes against base_branch, read from numstat and the commit subjects.
+
+    Raises:
+        subprocess.CalledProcessError: If git fails
+    """
+    refs = await resolve_refs(base_branch, cwd)
+    diff, log = await asyncio.gather(
+        read_diff(refs.merge_base, cwd, include_patch=False, head=refs.head),
+        run_git(["log", "--format=%s", f"{refs.base_branch}..{refs.head}"], cwd, check=True)
+    )
+    return {
+        "base_branch": refs.base_branch,
+        "ranking": classify_changes(diff.files, log.stdout.splitlines(), summary)
+    }
+
+
+# ===== Code ownership =====
+
+@dataclass
+class OwnershipIndex:
+    """Weighted authors of every path and directory, from the history of a ref over a window of days.
+
+    Each commit touching a file adds 1 + log2(1 + changed lines) to its author's weight for
+    the file and for every directory above it (directories are keyed with a trailing "/").
+    """
+    ref: str
+    window_days: int
+    since: float  # epoch seconds; commits before it are not included
+    tip: Optional[str] = None  # the last commit indexed
+    commits: int = 0
+    authors: Dict[str, str] = field(default_factory=dict)  # email -> name
+    weights: Dict[str, Dict[str, float]] = field(default_factory=dict)  # path -> email -> weight
+
+    def add(self, commit: Commit) -> None:
+        self.commits += 1
+        self.authors[commit.email] = commit.author
+        for change in commit.files:
+            weight = 1 + math.log2(1 + change.changed_lines)
+            parts = change.path.split("/")
+            keys = [change.path] + ["/".join(parts[:depth]) + "/" for depth in range(1, len(parts))]
+            for key in keys:
+                owners = self.weights.setdefault(key, {})
+                owners[commit.email] = owners.get(commit.email, 0.0) + weight
+
+    def owners(self, path: str) -> Tuple[Optional[str], Dict[str, float]]:
+        """The weighted authors of path, or of its nearest directory with history; returns (key, weights)."""
+        if path in self.weights:
+            return path, self.weights[path]
+        parts = path.split("/")[:-1]
+        while parts:
+            key = "/".join(parts) + "/"
+            if key in self.weights:
+                return key, self.weights[key]
+            parts.pop()
+        return None, {}
+
+    def summary(self) -> Dict[str, Any]:
+        return {"ref": self.ref, "tip": self.tip, "window_days": self.window_days, "commits": self.commits}
+
+
+def _ownership_path(common_dir: str, ref: str, window_days: int) -> Path:
+    digest = hashlib.sha256(f"{ref}\0{window_days}".encode()).hexdigest()[:16]
+    return _index_path(common_dir, f"ownership-{digest}.json")
+
+
+def _load_ownership(path: Path) -> Optional[OwnershipIndex]:
+    try:
+        return OwnershipIndex(**json.loads(path.read_text()))
+    except (OSError, ValueError, TypeError):
+        return None
+
+
+def _save_ownership(path: Path, index: OwnershipIndex) -> None:
+    _write_json_atomically(path, index.__dict__)
+
+
+# Ownership indexes by (common git dir, ref, window), loaded from disk on first use
+_ownership: Dict[Tuple[str, str, int], OwnershipIndex] = {}
+
+
+async def ownership_index(cwd: str, ref: str, window_days: int = OWNERSHIP_DAYS) -> Tuple[OwnershipIndex, str]:
+    """The ownership index of ref, brought up to date; returns (index, "unchanged", "incremental" or "full").
+
+    The index is kept under <git dir>/pr-agent-cache so it survives restarts. When ref
+    has moved forward, only the new commits are read. It is rebuilt when ref was rewritten
+    or the window has slid by more than OWNERSHIP_REBUILD_DAYS since it was built.
+
+    Raises:
+        subprocess.CalledProcessError: If ref can't be resolved
+        DeadlineExceeded: If the history couldn't be read before the deadline
+    """
+    metadata = await repo_metadata(cwd)
+    key = (metadata.common_dir, ref, window_days)
+    return await governor().coalesce(("ownership", key), lambda: _update_ownership(key, cwd))
+
+
+async def _update_ownership(key: Tuple[str, str, int], cwd: str) -> Tuple[OwnershipIndex, str]:
+    common_dir, ref, window_days = key
+    path = _ownership_path(common_dir, ref, window_days)
+    tip = (await run_git(["rev-parse", "--verify", f"{ref}^{{commit}}"], cwd, check=True)).stdout.strip()
+    index = _ownership.get(key) or _load_ownership(path)
+    since = time.time() - window_days * 86400
+
+    how = "incremental"
+    if index is not None and since - index.since > OWNERSHIP_REBUILD_DAYS * 86400:
+        index = None
+    if index is not None and index.tip == tip:
+        _ownership[key] = index
+        return index, "unchanged"
+    if index is not None and index.tip:
+        ancestor = await run_git(["merge-base", "--is-ancestor", index.tip, tip], cwd)
+        if ancestor.returncode != 0:
+            # Rewritten history
+            index = None
+    if index is None:
+        index = OwnershipIndex(ref, window_days, since)
+        how = "full"
+
+    parser = CommitLogParser()
+
+    def consume(chunk: bytes) -> bool:
+        parser.feed(chunk)
+        # Every commit but the last is complete; index them as they arrive
+        for commit in parser.commits[:-1]:
+            index.add(commit)
+        del parser.commits[:-1]
+        return False
+
+    revisions = [tip, f"--since=@{int(index.since)}"] if how == "full" else [f"{index.tip}..{tip}"]
+    result = await stream_git(
+        ["log", "-z", "--numstat", "--no-merges", f"--format={LOG_FORMAT}", *revisions], cwd, consume, check=True
+    )
+    if result.timed_out:
+        # Half an update isn't kept; the next call starts over
+        _ownership.pop(key, None)
+        raise DeadlineExceeded("The history for the ownership index could not be read before the deadline")
+    for commit in parser.commits:
+        index.add(commit)
+    index.tip = tip
+    _ownership[key] = index
+    _save_ownership(path, index)
+    return index, how
+
+
+async def rank_reviewers(
+    base_branch: Optional[str],
+    cwd: str,
+    max_reviewers: int = 5,
+    window_days: int = OWNERSHIP_DAYS
+) -> Dict[str, Any]:
+    """Rank the people who own the files changed against base_branch, from the ownership index of base_branch.
+
+    Every changed file (its old path when renamed) shares one point between its owners
+    in proportion to their weights, falling back to its nearest directory with history.
+    The branch's own authors are left out.
+
+    Raises:
+        subprocess.CalledProcessError: If git fails
+        DeadlineExceeded: If the ownership index couldn't be updated before the deadline
+    """
+    refs = await resolve_refs(base_branch, cwd)
+    (index, how), diff, authors = await asyncio.gather(
+        ownership_index(cwd, refs.base_branch, window_days),
+        read_diff(refs.merge_base, cwd, include_patch=False, head=refs.head),
+        run_git(["log", "--format=%ae", f"{refs.base_branch}..{refs.head}"], cwd, check=True)
+    )
+    branch_authors = set(authors.stdout.split())
+
+    scores: Dict[str, float] = {}
+    owned: Dict[str, List[str]] = {}
+    unowned = []
+    for change in diff.files:
+        _, weights = index.owners(change.old_path or change.path)
+        candidates = {email: weight for email, weight in weights.items() if email not in branch_authors}
+        total = sum(candidates.values())
+        if not total:
+            unowned.append(change.path)
+            continue
+        for email, weight in candidates.items():
+            scores[email] = scores.get(email, 0.0) + weight / total
+            owned.setdefault(email, []).append(change.path)
+
+    ranked = sorted(scores, key=lambda email: -scores[email])[:max_reviewers]
+    return {
+        "base_branch": refs.base_branch,
+        "reviewers": [
+            {
+                "name": index.authors.get(email, email),
+                "email": email,
+                "score": round(scores[email], 2),
+                "files": owned[email][:10],
+                "file_count": len(owned[email])
+            }
+            for email in ranked
+        ],
+        "branch_authors": sorted(branch_authors),
+        "files_without_owners": unowned,
+        "index": {**index.summary(), "update": how}
+    }
+
+
+def forget_ownership() -> None:
+    """Drop the in-memory ownership indexes (the copies on disk stay)."""
+    _ownership.clear()
+
+
+# ===== Test impact =====
+
+def is_test_file(path: str) -> bool:
+    name = os.path.basename(path)
+    return name.endswith(".py") and (name.startswith("test_") or name.endswith("_test.py"))
+
+
+def _shared_components(path: str, other: str) -> int:
+    """How many leading path components path and other have in common."""
+    common = os.path.commonpath([path, other])
+    return common.count("/") + 1 if common else 0
+
+
+class ModuleTable:
+    """Which Python files an import can refer to.
+
+    A file can be imported under any suffix of its path ("src/pkg/mod.py" as mod,
+    pkg.mod or src.pkg.mod), since which directories are on sys.path isn't known. When
+    several files match, the ones sharing the most directories with the importer win.
+    """
+
+    def __init__(self, paths: List[str]):
+        self._modules: Dict[str, List[str]] = {}
+        for path in paths:
+            parts = path[:-len(".py")].split("/")
+            if parts[-1] == "__init__":
+                parts.pop()
+            for start in range(len(parts)):
+                self._modules.setdefault(".".join(parts[start:]), []).append(path)
+
+    def resolve(self, importer: str, name: str) -> List[str]:
+        """The files import name (and the packages above it) in importer refers to."""
+        if name.startswith("."):
+            relative = name.lstrip(".")
+            package = importer.split("/")[:-1]
+            package = package[:len(package) - (len(name) - len(relative) - 1)]
+            name = ".".join(package + ([relative] if relative else []))
+        parts = name.split(".")
+        found = []
+        for depth in range(1, len(parts) + 1):
+            candidates = self._modules.get(".".join(parts[:depth]), [])
+            if len(candidates) > 1:
+                shared = {path: _shared_components(path, importer) for path in candidates}
+                nearest = max(shared.values())
+                candidates = [path for path in candidates if shared[path] == nearest]
+            found += candidates
+        return found
+
+
+@dataclass
+class ImportIndex:
+    """The imports of every Python file at a commit, kept up to date from the files that change.
+
+    The dependency graph between the files is resolved from them on demand (see
+    ModuleTable) and kept until the files change.
+    """
+    tip: Optional[str] = None  # the commit indexed; None until a build has finished
+    files: Dict[str, Dict[str, Any]] = field(default_factory=dict)  # path -> {"sha": blob, "imports": [names]}
+    _importers: Optional[Tuple[Tuple, Dict[str, List[str]]]] = field(default=None, repr=False)
+
+    def importers(self, extra: Tuple[str, ...] = ()) -> Dict[str, List[str]]:
+        """The files importing each file; extra are paths (such as deleted modules) imports may also refer to."""
+        key = (self.tip, extra)
+        if self._importers is None or self._importers[0] != key:
+            table = ModuleTable(list(self.files) + list(extra))
+            importers: Dict[str, List[str]] = {}
+            for path, entry in self.files.items():
+                for target in {t for name in entry["imports"] for t in table.resolve(path, name)} - {path}:
+                    importers.setdefault(target, []).append(path)
+            self._importers = (key, importers)
+        return self._importers[1]
+
+
+def _load_imports(path: Path) -> Optional[ImportIndex]:
+    try:
+        data = json.loads(path.read_text())
+        return ImportIndex(data["tip"], data["files"])
+    except (OSError, ValueError, TypeError, KeyError):
+        return None
+
+
+def _save_imports(path: Path, index: ImportIndex) -> None:
+    _write_json_atomically(path, {"tip": index.tip, "files": index.files})
+
+
+# Import indexes by common git dir, loaded from disk on first use
+_imports: Dict[str, ImportIndex] = {}
+
+
+async def import_index(cwd: str, head: str) -> Tuple[ImportIndex, str, int]:
+    """The import index of the repository brought up to commit head; returns (index, update, files parsed).
+
+    update is "unchanged", "incremental" (only the Python files that differ between the
+    indexed commit and head were parsed) or "full". The index is kept under
+    <git dir>/pr-agent-cache/indexes so it survives restarts; files are parsed in the
+    symbol parser's process pool. If the deadline passes part way, what was parsed is
+    kept and the next call carries on from it.
+
+    Raises:
+        subprocess.CalledProcessError: If head can't be read
+        DeadlineExceeded: If the index couldn't be brought up to date before the deadline
+        RuntimeError: If a parser process failed; the files it didn't parse are tried again next time
+    """
+    metadata = await repo_metadata(cwd)
+    while True:
+        # One update at a time per repository; a caller that shared one for another commit goes again
+        index, how, parsed = await governor().coalesce(
+            ("imports", metadata.common_dir), lambda: _update_imports(metadata.common_dir, cwd, head)
+        )
+        if index.tip == head:
+            return index, how, parsed
+
+
+async def _update_imports(common_dir: str, cwd: str, head: str) -> Tuple[ImportIndex, str, int]:
+    path = _index_path(common_dir, "imports.json")
+    index = _imports.get(common_dir) or _load_imports(path) or ImportIndex()
+    _imports[common_dir] = index
+    if index.tip == head:
+        return index, "unchanged", 0
+
+    changes: Dict[str, Optional[str]] = {}  # path -> blob, None when it's gone
+    how = "incremental"
+    if index.tip:
+        result = await run_git(
+            ["diff", "--raw", "-z", "--no-renames", "--no-abbrev", index.tip, head, "--", ":(glob)**/*.py"], cwd
+        )
+        if result.timed_out:
+            raise DeadlineExceeded("The changes since the import index was built could not be listed before the deadline")
+        fields = result.stdout.split("\0")
+        for record, changed in zip(fields[0::2], fields[1::2]):
+            _, mode, _, blob, status = record[1:].split(" ")
+            changes[changed] = None if status == "D" or mode == "120000" else blob
+        # A commit that no longer exists (e.g. after gc) means starting over
+        how = "incremental" if result.returncode == 0 else "full"
+    else:
+        how = "full"
+    if how == "full":
+        listing = await run_git(["ls-tree", "-r", "-z", "--full-tree", head], cwd, check=True)
+        if listing.timed_out:
+            raise DeadlineExceeded("The files for the import index could not be listed before the deadline")
+        changes = {}
+        for record in listing.stdout.split("\0"):
+            info, _, listed = record.partition("\t")
+            mode, kind, blob = info.split(" ") if info else ("", "", "")
+            if kind == "blob" and mode != "120000" and listed.endswith(".py"):
+                changes[listed] = blob
+        for gone in set(index.files) - set(changes):
+            del index.files[gone]
+
+    pool = cat_file_pool(cwd)
+    parsed = 0
+    failed = []
+
+    async def parse(changed: str, blob: Optional[str]) -> None:
+        nonlocal parsed
+        if blob is None:
+            index.files.pop(changed, None)
+            return
+        if index.files.get(changed, {}).get("sha") == blob:
+            # Parsed by an unfinished build
+            return
+        info = await pool.info(blob)
+        imports = []
+        if info is not None and info.size <= PARSE_MAX_BYTES:
+            obj = await pool.read(blob)
+            if obj is not None:
+                symbols = await symbol_parser.symbols(obj)
+                if symbols.get("error") == PARSER_FAILED:
+                    # Not a file without imports: it is left out, to be parsed again next time
+                    failed.append(changed)
+                    return
+                imports = symbols.get("imports", [])
+        index.files[changed] = {"sha": blob, "imports": imports}
+        parsed += 1
+
+    # Until every change is in, the index doesn't describe any one commit
+    index.tip = None
+    try:
+        await asyncio.gather(*(parse(changed, blob) for changed, blob in changes.items()))
+    except DeadlineExceeded:
+        _save_imports(path, index)
+        raise DeadlineExceeded(
+            f"The import index could not be brought up to date before the deadline ({parsed} files parsed "
+            "are kept; call again to carry on)"
+        )
+    if failed:
+        _save_imports(path, index)
+        raise RuntimeError(
+            f"The import index is incomplete: {PARSER_FAILED} on {len(failed)} files ({', '.join(sorted(failed)[:5])}"
+            f"{', ...' if len(failed) > 5 else ''}); call again to retry them"
+        )
+    index.tip = head
+    _save_imports(path, index)
+    return index, how, parsed
+
+
+async def affected_tests(base_branch: Optional[str], cwd: str) -> Dict[str, Any]:
+    """The test files that import a Python file changed against base_branch, directly or transitively.
+
+    Test files are test_*.py and *_test.py. A changed test file selects itself, and a
+    conftest.py that is changed (or imports a changed file) selects every test below its
+    directory. Each test lists the changed files it depends on and its distance in imports
+    from the nearest one.
+
+    Raises:
+        subprocess.CalledProcessError: If git fails
+        DeadlineExceeded: If the import index couldn't be updated before the deadline
+    """
+    refs = await resolve_refs(base_branch, cwd)
+    (index, how, parsed), diff = await asyncio.gather(
+        import_index(cwd, refs.head),
+        read_diff(refs.merge_base, cwd, include_patch=False, head=refs.head)
+    )
+
+    changed = []
+    not_python = []
+    for change in diff.files:
+        paths = [change.path] + ([change.old_path] if change.old_path else [])
+        python = [path for path in paths if path.endswith(".py")]
+        changed += python
+        if not python:
+            not_python.append(change.path)
+    # Modules that are gone are still imported by the files that haven't caught up
+    importers = index.importers(tuple(sorted(path for path in changed if path not in index.files)))
+    test_files = [path for path in index.files if is_test_file(path)]
+
+    selected: Dict[str, Dict[str, Any]] = {}
+    untested = []
+
+    def select(test: str, source: str, depth: int) -> None:
+        entry = selected.setdefault(test, {"path": test, "depth": depth, "changed": []})
+        entry["depth"] = min(entry["depth"], depth)
+        if source not in entry["changed"]:
+            entry["changed"].append(source)
+
+    for source in changed:
+        depths = {source: 0}
+        queue = deque([source])
+        found = False
+        while queue:
+            current = queue.popleft()
+            if is_test_file(current) and current in index.files:
+                select(current, source, depths[current])
+                found = True
+            elif os.path.basename(current) == "conftest.py":
+                directory = os.path.dirname(current)
+                for test in test_files:
+                    if not directory or test.startswith(directory + "/"):
+                        select(test, source, depths[current] + 1)
+                        found = True
+            for importer in importers.get(current, []):
+                if importer not in depths:
+                    depths[importer] = depths[current] + 1
+                    queue.append(importer)
+        if not found:
+            untested.append(source)
+
+    tests = sorted(selected.values(), key=lambda entry: (entry["depth"], entry["path"]))
+    return {
+        "base_branch": refs.base_branch,
+        "tests": tests,
+        "pytest_args": sorted(os.path.relpath(os.path.join(refs.toplevel, entry["path"]), cwd) for entry in tests),
+        "untested": untested,
+        "not_python": not_python,
+        "index": {"tip": index.tip, "files": len(index.files), "update": how, "parsed": parsed}
+    }
+
+
+def forget_imports() -> None:
+    """Drop the in-memory import indexes (the copies on disk stay)."""
+    _imports.clear()
+
+
+# ===== Analysis cache =====
+
+def _index_path(common_dir: str, name: str) -> Path:
+    """Where a repository-wide index is kept: beside the cached analyses, but out of reach of their pruning."""
+    return Path(common_dir) / AnalysisCache.DIRECTORY / AnalysisCache.INDEX_DIRECTORY / name
+
+
+def _write_json_atomically(path: Path, data: Any) -> bool:
+    """Write data to path as JSON through a temporary file, so readers never see half of it.
+
+    Returns whether it was written; the on-disk copies are best effort, so errors are ignored.
+    """
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(data))
+        tmp.replace(path)
+        return True
+    except OSError:
+        return False
+
+
+class AnalysisCache:
+    """LRU cache of diff analyses, keyed by the commits they were computed from.
+
+    Entries are evicted least recently used first once their JSON size exceeds
+    max_bytes. With persist=True entries are also written under <git dir>/pr-agent-cache
+    so they survive server restarts.
+    """
+
+    DIRECTORY = "pr-agent-cache"
+    # Subdirectory for the indexes of the whole repository (see _index_path()), which _prune() leaves alone
+    INDEX_DIRECTORY = "indexes"
+
+    def __init__(self, max_bytes: int = CACHE_MAX_BYTES, persist: bool = PERSIST_CACHE):
+        self.max_bytes = max_bytes
+        self.persist = persist
+        self._entries: "OrderedDict[Tuple, Tuple[Dict[str, Any], int]]" = OrderedDict()
+        self._size = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def get(self, key: Tuple, git_dir: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            return dict(entry[0])
+
+        if self.persist and git_dir:
+            try:
+                value = json.loads(self._path(key, git_dir).read_text())
+            except (OSError, ValueError):
+                return None
+            self._store(key, value)
+            return dict(value)
+        return None
+
+    def put(self, key: Tuple, value: Dict[str, Any], git_dir: Optional[str] = None) -> None:
+        self._store(key, value)
+        if self.persist and git_dir:
+            path = self._path(key, git_dir)
+            if _write_json_atomically(path, value):
+                self._prune(path.parent)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._size = 0
+
+    def _store(self, key: Tuple, value: Dict[str, Any], size: Optional[int] = None) -> None:
+        if size is None:
+            size = len(json.dumps(value))
+        if key in self._entries:
+            self._size -= self._entries.pop(key)[1]
+        if size > self.max_bytes:
+            return
+        self._entries[key] = (value, size)
+        self._size += size
+        while self._size > self.max_bytes:
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self._size -= evicted
+
+    def _path(self, key: Tuple, git_dir: str) -> Path:
+        digest = hashlib.sha256(repr(key).encode()).hexdigest()
+        return Path(git_dir) / self.DIRECTORY / f"{digest}.json"
+
+    def _prune(self, directory: Path) -> None:
+        """Keep the on-disk cache within max_bytes, removing the oldest files first."""
+        try:
+            files = sorted(directory.glob("*.json"), key=lambda path: path.stat().st_mtime)
+            total = sum(path.stat().st_size for path in files)
+            for path in files:
+                if total <= self.max_bytes:
+                    break
+                total -= path.stat().st_size
+                path.unlink()
+        except OSError:
+            # Another server pruned the same files
+            pass
+
+
+analysis_cache = AnalysisCache()
+
+
+# ===== Diff snapshots for paging and filtering =====
+
+@dataclass
+class FilePatch:
+    """Where one file's patch sits in a snapshot."""
+    path: str
+    old_path: Optional[str]
+    start: int  # byte offset of its "diff --git" line
+    end: int  # byte offset just past its last line
+    hunks: List[int] = field(default_factory=list)  # byte offsets of its "@@" lines
+
+
+@dataclass
+class DiffSnapshot:
+    """A diff between two commits that can be read page by page or file by file.
+
+    The patch is only produced the first time it is needed; because the commits
+    are immutable, that is the same diff the analysis was computed from.
+    """
+    cwd: str
+    merge_base: str
+    head: str
+    expires_at: float
+    profile: Optional[DiffProfile] = None
+    patch: Optional[bytes] = None
+    line_starts: Optional[array] = None  # byte offset of the start of every line
+    files: Dict[str, FilePatch] = field(default_factory=dict)  # by path, in diff order
+    oversized: bool = False  # the diff is larger than the store's budget and is never kept
+    estimated_lines: int = 0  # patch lines estimated from numstat, when oversized
+
+    @property
+    def size(self) -> int:
+        """Bytes held by the loaded patch and its line index."""
+        if self.patch is None:
+            return 0
+        return len(self.patch) + len(self.line_starts) * self.line_starts.itemsize
+
+    def unload(self) -> None:
+        self.patch = self.line_starts = None
+        self.files = {}
+
+    def select(self, paths: Optional[List[str]] = None, exclude: Optional[List[str]] = None) -> List[FilePatch]:
+        """The files matching any of paths (all files if None) and none of exclude.
+
+        Patterns are globs or directory prefixes, matched against the old and new path.
+        """
+        if paths and not any(_is_glob(pattern) for pattern in paths) and all(p in self.files for p in paths):
+            # Exact paths are looked up directly
+            candidates = [self.files[p] for p in dict.fromkeys(paths)]
+        else:
+            candidates = [f for f in self.files.values() if not paths or _matches(f, paths)]
+        return [f for f in candidates if not exclude or not _matches(f, exclude)]
+
+
+def _is_glob(pattern: str) -> bool:
+    return any(char in pattern for char in "*?[")
+
+
+def _matches(patch: FilePatch, patterns: List[str]) -> bool:
+    for pattern in patterns:
+        for path in (patch.path, patch.old_path):
+            if path is None:
+                continue
+            if fnmatch.fnmatchcase(path, pattern) or path.startswith(pattern.rstrip("/") + "/"):
+                return True
+    return False
+
+
+def _line_starts(patch: bytes) -> array:
+    starts = array("Q", [0])
+    newline = patch.find(b"\n")
+    while newline != -1:
+        starts.append(newline + 1)
+        newline = patch.find(b"\n", newline + 1)
+    return starts
+
+
+def _index_files(patch: bytes, files: List[FileChange]) -> Dict[str, FilePatch]:
+    """Map each file to the byte range of its patch and its hunks."""
+    headers = []
+    pos = patch.find(b"diff --git ")
+    while pos != -1:
+        if pos == 0 or patch[pos - 1] == ord("\n"):
+            headers.append(pos)
+        pos = patch.find(b"diff --git ", pos + 1)
+
+    index = {}
+    for i, (change, start) in enumerate(zip(files, headers)):
+        end = headers[i + 1] if i + 1 < len(headers) else len(patch)
+        entry = FilePatch(change.path, change.old_path, start, end)
+        hunk = patch.find(b"\n@@ ", start, end)
+        while hunk != -1:
+            entry.hunks.append(hunk + 1)
+            hunk = patch.find(b"\n@@ ", hunk + 1, end)
+        index[change.path] = entry
+    return index
+
+
+class DiffSnapshotStore:
+    """Diff snapshots addressed by handle, each expiring ttl seconds after it was last used.
+
+    Once the loaded patches exceed max_bytes, the least recently used ones are unloaded.
+    Their handles stay valid, and the patch is read again when one is next paged. A diff
+    larger than max_bytes on its own is never kept: git is stopped once the budget is
+    read, and read_diff_page() streams the pages of such a diff instead.
+    """
+
+    def __init__(self, ttl: float = SNAPSHOT_TTL, max_bytes: int = SNAPSHOT_MAX_BYTES):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._snapshots: "OrderedDict[str, DiffSnapshot]" = OrderedDict()
+        self._size = 0
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def register(self, refs: RepoRefs, cwd: str, profile: Optional[DiffProfile] = None) -> str:
+        """Return the handle for the diff between refs.merge_base and refs.head."""
+        self._purge()
+        key = f"{refs.toplevel}\0{refs.merge_base}\0{refs.head}"
+        if profile is not None and profile != DiffProfile():
+            key += f"\0{profile!r}"
+        handle = "diff-" + hashlib.sha256(key.encode()).hexdigest()[:16]
+        snapshot = self._snapshots.get(handle)
+        if snapshot is None:
+            snapshot = self._snapshots[handle] = DiffSnapshot(cwd, refs.merge_base, refs.head, 0.0, profile)
+        snapshot.expires_at = time.monotonic() + self.ttl
+        self._snapshots.move_to_end(handle)
+        return handle
+
+    async def load(self, handle: str, allow_oversized: bool = False) -> DiffSnapshot:
+        """Return the snapshot with its patch and file index loaded.
+
+        With allow_oversized, a snapshot whose diff is larger than max_bytes is returned
+        with oversized set and nothing loaded.
+
+        Raises:
+            ValueError: If the handle is unknown or has expired, or the diff is larger than
+                max_bytes and allow_oversized is false
+            DeadlineExceeded: If the diff couldn't be read before the deadline
+        """
+        self._purge()
+        snapshot = self._snapshots.get(handle)
+        if snapshot is None:
+            raise ValueError(f"Unknown or expired diff handle '{handle}'. Call analyze_file_changes again to get a new one.")
+        snapshot.expires_at = time.monotonic() + self.ttl
+        self._snapshots.move_to_end(handle)
+
+        if snapshot.patch is None and not snapshot.oversized:
+            await governor().coalesce(("snapshot", handle), lambda: self._read(handle, snapshot))
+            self._evict(snapshot)
+        if snapshot.oversized and not allow_oversized:
+            raise ValueError(
+                f"The diff is larger than the snapshot budget of {self.max_bytes} bytes (PR_AGENT_SNAPSHOT_MAX_BYTES), "
+                "so it can only be paged in order with get_diff_page, without paths or exclude"
+            )
+        return snapshot
+
+    async def _read(self, handle: str, snapshot: DiffSnapshot) -> None:
+        parser = DiffStreamParser()
+        received = 0
+
+        def consume(chunk: bytes) -> bool:
+            nonlocal received
+            received += len(chunk)
+            return parser.feed(chunk) or received > self.max_bytes
+
+        args = diff_args(snapshot.merge_base, True, snapshot.head, snapshot.profile)
+        result = await stream_git(args, snapshot.cwd, consume, check=True)
+        if result.timed_out:
+            raise DeadlineExceeded("The diff could not be read before the deadline")
+        if result.stopped_early:
+            snapshot.oversized = True
+            snapshot.estimated_lines = sum(_estimated_patch_lines(change) for change in parser.model.files) + 1
+            return
+        diff = parser.close()
+        patch = diff.patch.encode("utf-8")
+        snapshot.line_starts = _line_starts(patch)
+        snapshot.files = _index_files(patch, diff.files)
+        snapshot.patch = patch
+        if self._snapshots.get(handle) is snapshot:
+            # Not counted if it expired or was cleared while being read
+            self._size += snapshot.size
+
+    def clear(self) -> None:
+        self._snapshots.clear()
+        self._size = 0
+
+    def _evict(self, keep: DiffSnapshot) -> None:
+        """Unload the least recently used patches other than keep's until within max_bytes."""
+        for snapshot in list(self._snapshots.values()):
+            if self._size <= self.max_bytes:
+                break
+            if snapshot is not keep:
+                self._size -= snapshot.size
+                snapshot.unload()
+
+    def _purge(self) -> None:
+        now = time.monotonic()
+        for handle in [h for h, snapshot in self._snapshots.items() if snapshot.expires_at <= now]:
+            self._size -= self._snapshots.pop(handle).size
+
+
+diff_snapshots = DiffSnapshotStore()
+
+
+async def _page_window(snapshot: DiffSnapshot, offset: int, limit: int, unit: str) -> Tuple[bytes, int, int, bool]:
+    """Whole lines of snapshot's patch from the page at offset on, streamed from git.
+
+    The lines before the page are dropped as they arrive, and git is stopped once the
+    page and the line after it are read. Returns the lines, the number of lines and
+    bytes dropped before them, and whether the patch ends within them.
+    """
+    window = bytearray()
+    skipped_lines = skipped_bytes = 0
+
+    def collect(chunk: bytes) -> bool:
+        nonlocal skipped_lines, skipped_bytes
+        window.extend(chunk)
+        drop = 0
+        while unit == "bytes" or skipped_lines < offset:
+            newline = window.find(b"\n", drop)
+            # A byte page starts with the line holding the byte at offset
+            if newline == -1 or (unit == "bytes" and skipped_bytes + newline + 1 - drop > offset):
+                break
+            skipped_lines += 1
+            skipped_bytes += newline + 1 - drop
+            drop = newline + 1
+        del window[:drop]
+        if unit == "bytes" and skipped_bytes + len(window) <= offset:
+            return False
+        if unit == "lines":
+            return window.count(b"\n") > limit
+        first = window.find(b"\n")
+        return first != -1 and window.find(b"\n", max(limit + 1, first + 1)) != -1
+
+    args = diff_args(snapshot.merge_base, True, snapshot.head, snapshot.profile, header=False)
+    result = await stream_git(args, snapshot.cwd, collect, check=True)
+    if result.timed_out:
+        raise DeadlineExceeded("The diff could not be read before the deadline")
+    if result.stopped_early:
+        del window[window.rfind(b"\n") + 1:]
+    return bytes(window), skipped_lines, skipped_bytes, not result.stopped_early
+
+
+async def read_diff_page(
+    handle: str,
+    offset: int = 0,
+    limit: int = 500,
+    unit: str = "lines",
+    paths: Optional[List[str]] = None,
+    exclude: Optional[List[str]] = None
+) -> Dict[str, Any]:
+    """Read part of a diff snapshot.
+
+    Args:
+        handle: Handle returned as diff_handle by analyze_changes()
+        offset: First line to return, or with unit="bytes" the byte offset (rounded down to a line start)
+        limit: Number of lines, or with unit="bytes" the maximum bytes (at least one line is returned)
+        unit: "lines" or "bytes"
+        paths: Only include files matching these globs or directories
+        exclude: Leave out files matching these globs or directories
+
+    Raises:
+        ValueError: If the handle is unknown or expired, or unit is invalid
+        DeadlineExceeded: If the diff couldn't be read before the deadline
+    """
+    if unit not in ("lines", "bytes"):
+        raise ValueError(f"unit must be 'lines' or 'bytes', not '{unit}'")
+    snapshot = await diff_snapshots.load(handle, allow_oversized=not (paths or exclude))
+
+    selected = None
+    skipped_lines = skipped_bytes = 0
+    complete = True
+    if snapshot.oversized:
+        # Too large to keep: stream just this page
+        patch, skipped_lines, skipped_bytes, complete = await _page_window(snapshot, max(offset, 0), limit, unit)
+        starts = _line_starts(patch)
+        offset -= skipped_lines if unit == "lines" else skipped_bytes
+    elif paths or exclude:
+        # Page through just the matching files' sections of the patch
+        selected = snapshot.select(paths, exclude)
+        patch = b"".join(snapshot.patch[f.start:f.end] for f in selected)
+        starts = _line_starts(patch)
+    else:
+        patch, starts = snapshot.patch, snapshot.line_starts
+    # An incomplete window ends with a newline, so its last start is that of the first unread line
+    total = len(starts) - (not complete)
+
+    def line_end(index: int) -> int:
+        # Byte offset just before the newline that ends the line before `index`
+        return starts[index] - 1 if index < len(starts) else len(patch)
+
+    if unit == "lines":
+        first = min(max(offset, 0), total)
+        last = min(first + max(limit, 0), total)
+    else:
+        first = max(bisect.bisect_right(starts, max(offset, 0)) - 1, 0)
+        last = first + 1 if first < total else total
+        while last < total and line_end(last + 1) - starts[first] <= limit:
+            last += 1
+
+    content = patch[starts[first]:line_end(last)].decode("utf-8", errors="replace") if last > first else ""
+    if snapshot.profile is not None and snapshot.profile.render == "condensed":
+        content = condense_patch(content)
+    has_more = last < total or not complete
+    page = {
+        "handle": handle,
+        "unit": unit,
+        "first_line": skipped_lines + first,
+        "line_count": last - first,
+        "total_lines": skipped_lines + total if complete else max(snapshot.estimated_lines, skipped_lines + total + 1),
+        "total_lines_exact": complete,
+        "total_bytes": skipped_bytes + len(patch) if complete else None,
+        "content": content,
+        "has_more": has_more,
+        "next_offset": (skipped_lines + last if unit == "lines" else skipped_bytes + starts[last]) if has_more else None
+    }
+    if selected is not None:
+        page["files"] = [f.path for f in selected]
+    return page
+
+
+# ===== Diff renderings =====
+
+RENDER_MODES = {
+    "default": "git's default patch with 3 lines of context",
+    "zero_context": "hunks without context lines (-U0)",
+    "function_context": "hunks widened to the whole enclosing function (--function-context)",
+    "stat": "no patch; the statistics and file list only",
+    "condensed": "default hunks with one \"diff <path>\" line per file instead of the a/b and index headers"
+}
+
+# Extended header lines the condensed rendering drops; the "diff" line says the same
+_CONDENSED_DROPS = (
+    b"index ", b"--- ", b"+++ ", b"similarity index ", b"dissimilarity index ",
+    b"rename from ", b"rename to ", b"copy from ", b"copy to "
+)
+
+
+def check_render(mode: str, setting: str = "render") -> str:
+    """mode, if it is one of RENDER_MODES.
+
+    Raises:
+        ValueError: If it isn't
+    """
+    if mode not in RENDER_MODES:
+        raise ValueError(f"{setting} must be one of {', '.join(RENDER_MODES)}, not '{mode}'")
+    return mode
+
+
+class PatchCondenser:
+    """Rewrites patch text, fed in chunks, into the condensed rendering.
+
+    "diff --git a/<path> b/<path>" becomes "diff <path>" (or "diff <old> => <new>" for
+    renames and copies), and the index, ---/+++ and rename lines after it are dropped.
+    Mode and binary lines are kept, and hunks are left as they are.
+    """
+
+    def __init__(self):
+        self._in_header = False
+        self._partial = b""
+
+    def feed(self, chunk: bytes) -> bytes:
+        lines = (self._partial + chunk).split(b"\n")
+        self._partial = lines.pop()
+        return b"".join(line + b"\n" for line in map(self._line, lines) if line is not None)
+
+    def close(self) -> bytes:
+        line = self._line(self._partial) if self._partial else None
+        self._partial = b""
+        return line or b""
+
+    def _line(self, line: bytes) -> Optional[bytes]:
+        if line.startswith(b"diff --git a/"):
+            self._in_header = True
+            paths = line[len(b"diff --git a/"):]
+            split = paths.rfind(b" b/")
+            old, new = paths[:split], paths[split + 3:]
+            return b"diff " + (new if old == new else old + b" => " + new)
+        if self._in_header:
+            if line.startswith(b"@@"):
+                self._in_header = False
+            elif line.startswith(_CONDENSED_DROPS):
+                return None
+        return line
+
+
+def condense_patch(text: str) -> str:
+    """text (patch text) in the condensed rendering."""
+    condenser = PatchCondenser()
+    condensed = condenser.feed(text.encode("utf-8")) + condenser.close()
+    if not text.endswith("\n"):
+        # A dropped last line leaves the newline before it
+        condensed = condensed[:-1] if condensed.endswith(b"\n") else condensed
+    return condensed.decode("utf-8", errors="replace")
+
+
+async def _patch_window(args: List[str], cwd: str, max_lines: int) -> Tuple[bytes, bool]:
+    """The first max_lines lines of the patch `git <args>` prints, and whether that is all of it.
+
+    git is stopped once they are read.
+    """
+    chunks = []
+    lines = 0
+
+    def collect(chunk: bytes) -> bool:
+        nonlocal lines
+        chunks.append(chunk)
+        lines += chunk.count(b"\n")
+        return lines > max_lines
+
+    result = await stream_git(args, cwd, collect, check=True)
+    if result.timed_out:
+        raise DeadlineExceeded("The patch could not be measured before the deadline")
+    window = b"".join(chunks)
+    if not result.stopped_early:
+        return window, True
+    end = -1
+    for _ in range(max_lines):
+        end = window.index(b"\n", end + 1)
+    return window[:end + 1], False
+
+
+def _extrapolated_size(window: bytes, complete: bool, files: List[FileChange], condense: bool = False) -> int:
+    """Bytes of a whole patch (condensed, with condense) from its first lines.
+
+    Unless the window is complete, the size of the files it holds in full is scaled up by
+    the estimated patch lines (see _estimated_patch_lines()) of all the files.
+    """
+    def size(text: bytes) -> int:
+        if not condense:
+            return len(text)
+        condenser = PatchCondenser()
+        return len(condenser.feed(text) + condenser.close())
+
+    if complete:
+        return size(window)
+    # The last file the window reaches may be cut off; the ones before it are whole
+    starts = [match.start() for match in re.finditer(rb"^diff --git ", window, re.MULTILINE)]
+    if len(starts) > 1:
+        measured = window[:starts[-1]]
+        estimated = sum(_estimated_patch_lines(change) for change in files[:len(starts) - 1])
+    else:
+        measured, estimated = window, window.count(b"\n")
+    total = sum(_estimated_patch_lines(change) for change in files)
+    return size(measured) * max(total, estimated) // max(estimated, 1)
+
+
+async def measure_rendering(
+    refs: RepoRefs, cwd: str, profile: DiffProfile, diff: DiffModel, include_diff: bool, max_lines: int, stat: str
+) -> Dict[str, Any]:
+    """The size of profile's rendering of the whole diff, and what it saves over the default one.
+
+    diff is the analysis' diff, read with profile (with its patch, if include_diff). Only
+    the first max_lines lines of each patch are read, or taken from diff when they were
+    read with the same arguments; the sizes of longer patches are extrapolated from the
+    files' line counts and "exact" is false. stat is the text the "stat" rendering returns.
+    """
+    async def window(rendering: DiffProfile) -> Tuple[bytes, bool]:
+        args = diff_args(refs.merge_base, True, refs.head, rendering, header=False)
+        if include_diff and args == diff_args(refs.merge_base, True, refs.head, profile, header=False):
+            return diff.patch.encode("utf-8"), not (diff.truncated or diff.timed_out)
+        return await _patch_window(args, cwd, max_lines)
+
+    default = replace(profile, render="default")
+    rendered_complete = True
+    if profile.render in ("zero_context", "function_context"):
+        (default_window, default_complete), (rendered_window, rendered_complete) = await asyncio.gather(
+            window(default), window(profile)
+        )
+    else:
+        default_window, default_complete = await window(default)
+    default_bytes = _extrapolated_size(default_window, default_complete, diff.files)
+    if profile.render in ("zero_context", "function_context"):
+        rendered = _extrapolated_size(rendered_window, rendered_complete, diff.files)
+    elif profile.render == "condensed":
+        rendered = _extrapolated_size(default_window, default_complete, diff.files, condense=True)
+    elif profile.render == "stat":
+        rendered = len(stat.encode("utf-8"))
+    else:
+        rendered = default_bytes
+    return {
+        "mode": profile.render,
+        "bytes": rendered,
+        "tokens": estimate_tokens(rendered),
+        "default_bytes": default_bytes,
+        "default_tokens": estimate_tokens(default_bytes),
+        "saved_bytes": default_bytes - rendered,
+        "saved_tokens": estimate_tokens(default_bytes) - estimate_tokens(rendered),
+        "exact": default_complete and rendered_complete
+    }
+
+
+# ===== Token-budgeted packing =====
+
+def estimate_tokens(size: int) -> int:
+    """Approximate number of tokens in size bytes of diff text."""
+    return -(-size // BYTES_PER_TOKEN)
+
+
+def _pack_file(patch: bytes, entry: FilePatch, budget: int) -> Tuple[bytes, int, bool]:
+    """The file's header plus as many whole hunks as fit in budget bytes.
+
+    Returns (text, whole hunks included, whether a first hunk was cut part way).
+    """
+    if entry.end - entry.start <= budget:
+        return patch[entry.start:entry.end], len(entry.hunks), False
+
+    body = entry.hunks[0] if entry.hunks else entry.end
+    if body - entry.start > budget:
+        return b"", 0, False
+
+    included = 0
+    while included < len(entry.hunks):
+        hunk_end = entry.hunks[included + 1] if included + 1 < len(entry.hunks) else entry.end
+        if hunk_end - entry.start > budget:
+            break
+        included += 1
+    cut = entry.hunks[included] if included < len(entry.hunks) else entry.end
+
+    if included == 0 and entry.hunks:
+        # Not even the first hunk fits: keep its first lines
+        partial = patch.rfind(b"\n", body, entry.start + budget) + 1
+        if partial > body:
+            return patch[entry.start:partial], 0, True
+    return patch[entry.start:cut], included, False
+
+
+def pack_diff(snapshot: DiffSnapshot, files: List[FilePatch], max_tokens: int, handle: str) -> Dict[str, Any]:
+    """Fit the diff of files into max_tokens, sharing the budget fairly between files.
+
+    Files are visited smallest first and each is offered an equal share of what is
+    left, so small files are included in full and whatever they don't use is shared
+    among the larger ones (water-filling over patch sizes). A large file keeps its
+    headers and first hunks, and everything left out is listed in an "elided" manifest.
+    """
+    patch = snapshot.patch
+    costs = [entry.end - entry.start for entry in files]
+    remaining = max_tokens * BYTES_PER_TOKEN
+    packed: List[Tuple[bytes, int, bool]] = [(b"", 0, False)] * len(files)
+
+    order = sorted(range(len(files)), key=lambda i: costs[i])
+    for position, i in enumerate(order):
+        entry = files[i]
+        share = remaining // (len(order) - position)
+        note = f"... rest of {entry.path} elided ...\n".encode()
+        if costs[i] > share:
+            # Leave room for the note that marks the cut
+            share -= len(note)
+        text, hunks, partial = _pack_file(patch, entry, share)
+        if text and len(text) < costs[i]:
+            text += note
+        packed[i] = (text, hunks, partial)
+        remaining -= len(text)
+
+    sections = []
+    elided = []
+    for entry, cost, (text, hunks, partial) in zip(files, costs, packed):
+        sections.append(text)
+        if len(text) < cost:
+            elided.append({
+                "path": entry.path,
+                "hunks": len(entry.hunks),
+                "hunks_included": hunks,
+                "partial_hunk": partial,
+                "omitted_tokens": estimate_tokens(cost - len(text)),
+                "fetch": f'get_diff_page(handle="{handle}", paths={json.dumps([entry.path])})'
+            })
+
+    content = b"".join(sections).decode("utf-8", errors="replace")
+    starts = snapshot.line_starts
+    total_lines = sum(bisect.bisect_left(starts, e.end) - bisect.bisect_left(starts, e.start) for e in files) + 1
+    return {
+        "diff": content,
+        "diff_files": [entry.path for entry in files],
+        "total_diff_lines": total_lines,
+        "elided": elided,
+        "token_budget": {
+            "max_tokens": max_tokens,
+            "used_tokens": estimate_tokens(len(content.encode("utf-8"))),
+            "full_tokens": estimate_tokens(sum(costs))
+        }
+    }
+
+
+# ===== Incremental analysis =====
+
+@dataclass
+class DiffBaseline:
+    """The last diff computed against a merge-base, kept so it can be updated when HEAD moves."""
+    head: str
+    files: List[FileChange]
+    patches: Dict[str, bytes]  # complete patches by path; files past a truncation point are missing
+
+
+class DiffBaselines:
+    """The latest diff for each (repository, merge-base, diff options), least recently used evicted first."""
+
+    def __init__(self, max_entries: int = 32):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Tuple, DiffBaseline]" = OrderedDict()
+
+    def get(self, key: Tuple) -> Optional[DiffBaseline]:
+        baseline = self._entries.get(key)
+        if baseline is not None:
+            self._entries.move_to_end(key)
+        return baseline
+
+    def put(self, key: Tuple, baseline: DiffBaseline) -> None:
+        self._entries[key] = baseline
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+
+diff_baselines = DiffBaselines()
+
+
+def _file_patches(diff: DiffModel) -> Dict[str, bytes]:
+    """Each file's complete patch by path (the file a truncated patch ends in is left out)."""
+    patch = diff.patch.encode("utf-8")
+    patches = {}
+    for path, entry in _index_files(patch, diff.files).items():
+        if not (diff.truncated and entry.end == len(patch)):
+            patches[path] = patch[entry.start:entry.end]
+    return patches
+
+
+async def _incremental_diff(
+    baseline: DiffBaseline,
+    refs: RepoRefs,
+    cwd: str,
+    include_patch: bool,
+    max_lines: Optional[int],
+    profile: DiffProfile
+) -> Optional[DiffModel]:
+    """Update baseline's diff against refs.merge_base to refs.head by re-diffing only the
+    paths that differ between the two heads.
+
+    Returns None when that isn't possible or not worth it, and the whole diff has to be read.
+    """
+    if profile.diff_filter and profile.rename_limit != 0:
+        # Renames could pair with files the filter left out of the baseline
+        return None
+    touched = await run_git(
+        ["diff", "--name-only", "--no-renames", "-z", baseline.head, refs.head, "--", *profile.pathspecs()], cwd
+    )
+    if touched.returncode != 0:
+        # The old HEAD is gone (e.g. garbage collected after an amend)
+        return None
+    paths = set(filter(None, touched.stdout.split("\0")))
+    if profile.rename_limit != 0:
+        # A file added by the new commits can be a rename of any file added or deleted before
+        for change in baseline.files:
+            if change.status[0] in "ADR":
+                paths.update(path for path in (change.path, change.old_path) if path)
+    if len(paths) > INCREMENTAL_MAX_PATHS or (profile.rename_limit and len(paths) > profile.rename_limit):
+        # Too many to list, or more rename candidates than the full diff would pair up
+        return None
+
+    elapsed = touched.elapsed
+    files = [c for c in baseline.files if c.path not in paths and c.old_path not in paths]
+    patches: Dict[str, bytes] = {}
+    if paths:
+        scoped = replace(profile, pathspec=tuple(f":(literal){path}" for path in sorted(paths)))
+        rediff = await read_diff(refs.merge_base, cwd, include_patch, head=refs.head, profile=scoped)
+        if rediff.timed_out:
+            return None
+        elapsed += rediff.elapsed
+        files += rediff.files
+        patches = _file_patches(rediff)
+    # git lists files in path order, renames at their new path
+    files.sort(key=lambda change: change.path.encode("utf-8"))
+
+    parser = DiffStreamParser.for_patch(files, max_lines if include_patch else None)
+    if include_patch:
+        for change in files:
+            patch = patches[change.path] if change.path in patches else baseline.patches.get(change.path)
+            if patch is None:
+                # Past where the baseline's patch was cut off
+                return None
+            if parser.feed(patch):
+                break
+    diff = parser.close()
+    diff.elapsed = elapsed
+    return diff
+
+
+async def _read_analysis_diff(
+    refs: RepoRefs,
+    cwd: str,
+    include_diff: bool,
+    max_diff_lines: int,
+    profile: DiffProfile
+) -> Tuple[DiffModel, Optional[str]]:
+    """The diff for an analysis, updated from the last one against the same merge-base when
+    HEAD has moved since; returns (diff, the HEAD it was updated from or None)."""
+    key = (refs.toplevel, refs.merge_base, include_diff, max_diff_lines, profile)
+    baseline = diff_baselines.get(key)
+    diff = None
+    if baseline is not None and baseline.head != refs.head:
+        diff = await _incremental_diff(baseline, refs, cwd, include_diff, max_diff_lines, profile)
+    updated_from = baseline.head if diff is not None else None
+    if diff is None:
+        diff = await read_diff(
+            refs.merge_base, cwd, include_patch=include_diff, max_lines=max_diff_lines,
+            head=refs.head, profile=profile
+        )
+    if not diff.timed_out:
+        diff_baselines.put(key, DiffBaseline(refs.head, diff.files, _file_patches(diff) if include_diff else {}))
+    return diff, updated_from
+
+
+async def analyze_changes(
+    base_branch: Optional[str],
+    cwd: str,
+    include_diff: bool = True,
+    max_diff_lines: int = 500,
+    paths: Optional[List[str]] = None,
+    exclude: Optional[List[str]] = None,
+    max_tokens: Optional[int] = None,
+    profile: Optional[str] = None,
+    semantic: bool = False,
+    digest_dependencies: bool = True,
+    render: Optional[str] = None
+) -> Dict[str, Any]:
+    """Analyze the changes between base_branch and HEAD.
+
+    Results are cached by (repository, merge-base, HEAD, include_diff, max_diff_lines,
+    profile), so repeated calls with unchanged refs skip the diff and log entirely. When
+    HEAD has moved since the last analysis against the same merge-base, only the files the
+    new commits touched are diffed again ("computation" says "incremental" or "full"). With
+    paths or exclude, the diff only holds the matching files, read from the diff snapshot.
+    With max_tokens, the diff is packed into that budget instead of cut at max_diff_lines.
+    With semantic, the classes and functions changed in Python files are summarized too
+    (see semantic_summary()). With digest_dependencies, changed lockfiles and pyproject.toml
+    files are summarized as package changes (see dependency_changes()) and the lockfiles'
+    hunks are left out of the diff. Files matching the repository's .pr-agent-ignore are
+    never diffed; they are listed under "omitted" with their line counts (see
+    ignored_changes()). render picks how the patch is rendered (see RENDER_MODES, default:
+    the profile's); any but "default" adds a "rendering" report of the whole diff's size
+    and what the rendering saves (see measure_rendering()).
+    The diff profile (see load_profile()) decides how much work git does for the diff.
+
+    If the deadline (see deadline()) passes while the diff or log is read, what was
+    read so far is returned with timed_out set, and nothing is cached.
+
+    Raises:
+        subprocess.CalledProcessError: If git fails
+        ValueError: If the profile is unknown or misconfigured, or render is unknown
+        DeadlineExceeded: If the deadline passes before the commits are resolved or the
+            ignored files are listed
+    """
+    refs = await resolve_refs(base_branch, cwd)
+    base_branch = refs.base_branch
+    diff_profile = await load_profile(profile, cwd)
+    if render is not None:
+        diff_profile = replace(diff_profile, render=check_render(render))
+    # The stat rendering has no patch to page through
+    include_diff = include_diff and diff_profile.render != "stat"
+    rules = ignore_rules(refs.toplevel)
+    ignored = None
+    not_excluded = 0
+    if rules is not None:
+        # The ignored files are listed without patches, then excluded from every diff below
+        started = time.perf_counter()
+        ignored = await ignored_changes(refs, cwd, diff_profile, rules)
+        ignore_elapsed = time.perf_counter() - started
+        diff_profile, not_excluded = without_ignored(diff_profile, rules, ignored)
+    dependencies = None
+    if digest_dependencies and tomllib is not None:
+        # The lockfiles are digested from the unfiltered profile and left out of the diff
+        dependencies = diff_profile
+        diff_profile = replace(diff_profile, exclude=diff_profile.exclude + LOCKFILE_GLOBS)
+    handle = diff_snapshots.register(refs, cwd, diff_profile) if include_diff else None
+    filtered = include_diff and bool(paths or exclude or max_tokens)
+
+    analysis, cached, timings = await _analysis(
+        refs, base_branch, cwd, include_diff and not filtered, max_diff_lines, handle, diff_profile, dependencies
+    )
+    timings = {"refs": refs, **timings}
+    if ignored:
+        analysis["omitted"] = omitted_summary(ignored, not_excluded)
+    if rules is not None:
+        timings["ignore"] = ignore_elapsed
+
+    if filtered and analysis.get("timed_out"):
+        analysis.update({"diff": "", "truncated": True})
+    elif filtered:
+        started = time.perf_counter()
+        try:
+            await diff_snapshots.load(handle)
+        except DeadlineExceeded:
+            analysis.update({"diff": "", "truncated": True, "timed_out": True})
+            filtered = False
+        timings["snapshot"] = time.perf_counter() - started
+
+    if filtered and max_tokens:
+        snapshot = await diff_snapshots.load(handle)
+        packed = pack_diff(snapshot, snapshot.select(paths, exclude), max_tokens, handle)
+        if diff_profile.render == "condensed":
+            packed["diff"] = condense_patch(packed["diff"])
+        analysis.update(packed)
+        analysis.update({"truncated": bool(packed["elided"]), "total_diff_lines_exact": True})
+    elif filtered:
+        # Only the matching files' sections of the snapshot are read
+        page = await read_diff_page(handle, 0, max_diff_lines, paths=paths, exclude=exclude)
+        diff_content = page["content"]
+        if page["has_more"]:
+            diff_content += f"\n\n... Output truncated. Showing {max_diff_lines} of {page['total_lines']} lines ..."
+            diff_content += (
+                f"\n... Use get_diff_page(handle=\"{handle}\", offset={max_diff_lines}, "
+                f"paths={json.dumps(paths)}, exclude={json.dumps(exclude)}) to see more ..."
+            )
+        analysis.update({
+            "diff": diff_content,
+            "diff_files": page["files"],
+            "truncated": page["has_more"],
+            "total_diff_lines": page["total_lines"],
+            "total_diff_lines_exact": True
+        })
+
+    if semantic:
+        started = time.perf_counter()
+        try:
+            files = await read_diff(refs.merge_base, cwd, include_patch=False, head=refs.head, profile=diff_profile)
+            if files.timed_out:
+                raise DeadlineExceeded("The file list could not be read before the deadline")
+            analysis["semantic"] = await semantic_summary(files.files, cwd)
+        except DeadlineExceeded as e:
+            analysis["semantic"] = {"error": str(e), "timed_out": True}
+            analysis["timed_out"] = True
+        timings["semantic"] = time.perf_counter() - started
+
+    return {
+        "base_branch": base_branch,
+        "base_branch_detected": refs.base_branch_detected,
+        "profile": diff_profile.summary(),
+        **analysis,
+        "diff_handle": handle,
+        "cached": cached,
+        "git_timings_ms": timings_ms(timings)
+    }
+
+
+async def _analysis(
+    refs: RepoRefs,
+    base_branch: str,
+    cwd: str,
+    include_diff: bool,
+    max_diff_lines: int,
+    handle: Optional[str],
+    profile: DiffProfile,
+    dependencies: Optional[DiffProfile] = None
+) -> Tuple[Dict[str, Any], bool, Dict[str, Any]]:
+    """The analysis for refs from the cache or from git; returns (analysis, cached, timed commands)."""
+    key = (refs.toplevel, refs.merge_base, refs.head, include_diff, max_diff_lines, profile, dependencies)
+    cached = analysis_cache.get(key, refs.git_dir)
+    if cached is not None:
+        return cached, True, {}
+
+    # Concurrent identical requests share one run of git
+    analysis, timings = await governor().coalesce(
+        ("analysis", key),
+        lambda: _compute_analysis(refs, key, base_branch, cwd, include_diff, max_diff_lines, handle, profile, dependencies)
+    )
+    return dict(analysis), False, timings
+
+
+def _listed(diff: DiffModel, lockfiles: List[FileChange]) -> DiffModel:
+    """diff with the digested lockfiles put back in its file list.
+
+    Only the lockfiles' patches are left out of the diff; they are still listed and counted.
+    """
+    if not lockfiles:
+        return diff
+    return replace(diff, files=sorted(diff.files + lockfiles, key=lambda change: change.path.encode()))
+
+
+async def _compute_analysis(
+    refs: RepoRefs,
+    key: Tuple,
+    base_branch: str,
+    cwd: str,
+    include_diff: bool,
+    max_diff_lines: int,
+    handle: Optional[str],
+    profile: DiffProfile,
+    dependencies: Optional[DiffProfile] = None
+) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """Run git for an analysis and cache it unless it timed out; returns (analysis, timed commands)."""
+    async def digest() -> Tuple[Optional[Dict[str, Any]], List[FileChange], float]:
+        if dependencies is None:
+            return None, [], 0.0
+        started = time.perf_counter()
+        try:
+            files, lockfiles = await dependency_changes(refs, cwd, dependencies)
+        except DeadlineExceeded as e:
+            return {"error": str(e), "timed_out": True}, [], time.perf_counter() - started
+        if not files:
+            return None, [], time.perf_counter() - started
+        omitted = [change.path for change in lockfiles]
+        return {"files": files, "omitted_from_diff": omitted}, lockfiles, time.perf_counter() - started
+
+    async def measure() -> Tuple[Optional[Dict[str, Any]], float]:
+        if profile.render == "default":
+            return None, 0.0
+        started = time.perf_counter()
+        try:
+            diff = (await read)[0]
+            # The stat rendering is the statistics the analysis returns
+            stat = _listed(diff, (await digesting)[1]).stat() if profile.render == "stat" else ""
+            rendering = await measure_rendering(refs, cwd, profile, diff, include_diff, max_diff_lines, stat)
+            return rendering, time.perf_counter() - started
+        except DeadlineExceeded as e:
+            return {"mode": profile.render, "error": str(e), "timed_out": True}, time.perf_counter() - started
+
+    # One streamed git diff gives the file list, statistics and patch (or the previous diff
+    # is updated with just the files the new commits touched); the log, the dependency
+    # digest and the measurement of a non-default rendering run alongside it
+    read = asyncio.ensure_future(_read_analysis_diff(refs, cwd, include_diff, max_diff_lines, profile))
+    digesting = asyncio.ensure_future(digest())
+    (diff, updated_from), commits_result, (digested, lockfiles, digest_elapsed), (rendering, render_elapsed) = await asyncio.gather(
+        read,
+        run_git(["log", "--oneline", f"{base_branch}..{refs.head}"], cwd, partial=True),
+        digesting,
+        measure()
+    )
+
+    # Get the actual diff if requested (git is stopped once max_diff_lines are read). A
+    # rendering that couldn't be measured is reported in "rendering" alone.
+    timed_out = diff.timed_out or commits_result.timed_out or bool(digested and digested.get("timed_out"))
+    diff_content = ""
+    if include_diff:
+        diff_content = condense_patch(diff.patch) if profile.render == "condensed" else diff.patch
+        if diff.timed_out:
+            diff_content += "\n\n... Timed out reading the diff; the file list and statistics may be incomplete ..."
+            diff_content += f"\n... Use get_diff_page(handle=\"{handle}\", offset=0) with a longer timeout to see more ..."
+        elif diff.truncated:
+            total = diff.total_lines if diff.total_lines_exact else f"~{diff.total_lines}"
+            diff_content += f"\n\n... Output truncated. Showing {max_diff_lines} of {total} lines ..."
+            diff_content += f"\n... Use get_diff_page(handle=\"{handle}\", offset={max_diff_lines}) to see more ..."
+
+    listed = _listed(diff, lockfiles)
+    analysis = {
+        "files_changed": listed.name_status(),
+        "statistics": listed.stat(),
+        "composition": listed.composition(),
+        "commits": commits_result.stdout,
+        "diff": diff_content if include_diff else (
+            "Diff not included (stat rendering; see statistics)" if profile.render == "stat"
+            else "Diff not included (set include_diff=true to see full diff)"
+        ),
+        "truncated": diff.truncated,
+        "total_diff_lines": diff.total_lines if include_diff else 0,
+        "total_diff_lines_exact": diff.total_lines_exact,
+        "timed_out": timed_out,
+        "computation": "incremental" if updated_from else "full"
+    }
+    if updated_from:
+        analysis["incremental_from"] = updated_from
+    if digested:
+        analysis["dependencies"] = digested
+    if rendering:
+        analysis["rendering"] = rendering
+    if not timed_out:
+        # A rendering that timed out is left out of the cached analysis rather than keeping it out
+        cached = analysis
+        if rendering and rendering.get("timed_out"):
+            cached = {name: value for name, value in analysis.items() if name != "rendering"}
+        analysis_cache.put(key, cached, refs.git_dir)
+    timings = {"diff": diff, "commits": commits_result}
+    if dependencies is not None:
+        timings["dependencies"] = digest_elapsed
+    if rendering:
+        timings["rendering"] = render_elapsed
+    return analysis, timings
+
+
+# ===== Batch analysis of several repositories =====
+
+# Fields trimmed, in order, when a repository's analysis doesn't fit its share of a batch
+_SHRINKABLE_FIELDS = ("diff", "statistics", "commits", "files_changed")
+# Then the lists inside structured fields, cut from the end (each is ordered most important first)
+_SHRINKABLE_LISTS = (
+    ("omitted", "files"), ("composition", "by_directory"), ("composition", "by_extension"), ("dependencies", "files")
+)
+# Then whole fields, until only the summary flags and counts are left
+_DROPPABLE_FIELDS = (
+    "diff_files", "omitted", "dependencies", "rendering", "composition", "profile", "git_timings_ms", "incremental_from"
+)
+
+
+def _json_size(value: Any) -> int:
+    return len(json.dumps(value).encode("utf-8"))
+
+
+def _shrink(result: Dict[str, Any], budget: int) -> None:
+    """Cut an analysis down until it fits in budget bytes, or nothing but its summary is left.
+
+    The bulkiest text fields are cut at line ends first, then the lists inside the
+    structured fields, then whole fields are dropped (listed in dropped_to_fit), and
+    last an error message is cut. The fields are replaced rather than changed in place,
+    since they are shared with the analysis cache.
+    """
+    def overflow() -> int:
+        return _json_size(result) - budget
+
+    for name in _SHRINKABLE_FIELDS:
+        if overflow() <= 0:
+            return
+        value = result.get(name)
+        if not isinstance(value, str) or not value:
+            continue
+        note = f"\n... {name} cut to fit the batch's max_bytes ..."
+        # Escaped characters take more bytes than characters, so the cut is repeated until it fits
+        while value and overflow() > 0:
+            value = value[:value.rfind("\n", 0, max(len(value) - overflow() - len(note), 0)) + 1]
+            result[name] = value + note if value else note.lstrip("\n")
+        result["truncated_to_fit"] = True
+
+    for name, key in _SHRINKABLE_LISTS:
+        holder = result.get(name)
+        if overflow() <= 0:
+            return
+        if not isinstance(holder, dict) or not holder.get(key):
+            continue
+        # A copy is cut: the fields are shared with the cached analysis
+        holder = result[name] = {**holder, "cut_to_fit": True}
+        kind = type(holder[key])
+        items = list(holder[key].items()) if kind is dict else list(holder[key])
+        while items and overflow() > 0:
+            # Items are dropped by their estimated size, then the real size is checked
+            excess = overflow()
+            while items and excess > 0:
+                excess -= _json_size(items.pop())
+            holder[key] = kind(items)
+        result["truncated_to_fit"] = True
+
+    for name in _DROPPABLE_FIELDS:
+        if overflow() <= 0:
+            return
+        if name in result:
+            del result[name]
+            result.setdefault("dropped_to_fit", []).append(name)
+            result["truncated_to_fit"] = True
+
+    error = result.get("error")
+    if overflow() > 0 and isinstance(error, str) and error:
+        note = "... (cut to fit the batch's max_bytes)"
+        result["error"] = error[:max(len(error) - overflow() - len(note), 0)] + note
+        result["truncated_to_fit"] = True
+
+
+async def analyze_batch(
+    targets: List[Tuple[str, Optional[str]]],
+    include_diff: bool = False,
+    max_diff_lines: int = 500,
+    max_bytes: int = 200000,
+    profile: Optional[str] = None
+) -> Dict[str, Any]:
+    """Analyze several repositories at once; targets are (working directory, base branch or None).
+
+    The analyses run concurrently, with their git commands queued by the governor like any
+    others. A failure is reported in that repository's entry and doesn't affect the rest.
+    The whole payload is kept within max_bytes: repositories are visited smallest first and
+    each is offered an equal share of what is left, and one that doesn't fit is cut down
+    by _shrink() and has truncated_to_fit set. If the payload is still too large, the
+    largest entries are cut to their summaries until it fits.
+    """
+    async def analyze(cwd: str, base_branch: Optional[str]) -> Dict[str, Any]:
+        entry: Dict[str, Any] = {"working_directory": cwd}
+        try:
+            analysis = await analyze_changes(base_branch, cwd, include_diff, max_diff_lines, profile=profile)
+        except DeadlineExceeded as e:
+            return {**entry, "base_branch": base_branch, "error": str(e), "timed_out": True}
+        except subprocess.CalledProcessError as e:
+            return {**entry, "base_branch": base_branch, "error": f"Git error: {e.stderr}"}
+        except Exception as e:
+            return {**entry, "base_branch": base_branch, "error": str(e)}
+        return {**entry, **analysis}
+
+    results = list(await asyncio.gather(*(analyze(cwd, base_branch) for cwd, base_branch in targets)))
+
+    # Water-filling over the entries' sizes, like pack_diff()
+    envelope = 200  # the keys around the entries
+    remaining = max_bytes - envelope
+    sizes = [_json_size(result) for result in results]
+    order = sorted(range(len(results)), key=lambda i: sizes[i])
+    for position, i in enumerate(order):
+        share = remaining // (len(order) - position)
+        if sizes[i] > share:
+            _shrink(results[i], share)
+        remaining -= _json_size(results[i])
+
+    failed = sum("error" in result for result in results)
+
+    def payload() -> Dict[str, Any]:
+        return {
+            "repositories": results,
+            "succeeded": len(results) - failed,
+            "failed": failed,
+            "truncated_to_fit": any(result.get("truncated_to_fit") for result in results),
+            "max_bytes": max_bytes
+        }
+
+    # The shares are estimates; the final size is what counts
+    batch = payload()
+    for i in sorted(range(len(results)), key=lambda i: -_json_size(results[i])):
+        overflow = _json_size(batch) - max_bytes
+        if overflow <= 0:
+            break
+        _shrink(results[i], max(_json_size(results[i]) - overflow, 0))
+        batch = payload()
+    return batch
+
+
+# ===== Background ref watcher =====
+
+# inotify(7) event masks
+_IN_MODIFY, _IN_CLOSE_WRITE, _IN_MOVED_TO, _IN_CREATE, _IN_DELETE = 0x2, 0x8, 0x80, 0x100, 0x200
+_IN_ISDIR = 0x40000000
+_IN_EVENT = struct.Struct("iIII")  # wd, mask, cookie, len (followed by len bytes of name)
+
+
+def _libc_inotify():
+    """libc with inotify, or None where it isn't available."""
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        libc.inotify_init1, libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+class RefWatcher:
+    """Warms the analysis cache when HEAD or the base branch of a repository moves.
+
+    Watches HEAD, packed-refs and the refs/ tree with inotify where available and
+    otherwise polls their stat fingerprint every `interval` seconds. Once changes
+    have settled for `debounce` seconds, it runs the default analysis (the one
+    analyze_file_changes does without options), so the next call is a cache hit.
+    """
+
+    def __init__(
+        self,
+        cwd: str,
+        base_branch: Optional[str] = None,
+        interval: float = WATCH_INTERVAL,
+        debounce: float = 0.2,
+        use_inotify: bool = True
+    ):
+        self.cwd = cwd
+        self.base_branch = base_branch
+        self.interval = interval
+        self.debounce = debounce
+        self.use_inotify = use_inotify
+        self.events = 0
+        self.warmed = 0
+        self.last_warm_ms: Optional[float] = None
+        self.last_error: Optional[str] = None
+        self._metadata: Optional[RepoMetadata] = None
+        self._last_refs: Optional[Tuple[str, str]] = None
+        self._changed = asyncio.Event()
+        self._tasks: List[asyncio.Task] = []
+        self._libc = None
+        self._fd: Optional[int] = None
+        self._watches: Dict[int, str] = {}  # inotify watch descriptor -> directory
+
+    @property
+    def mode(self) -> str:
+        return "inotify" if self._fd is not None else "polling"
+
+    async def start(self) -> None:
+        """Start watching; the current state is warmed right away.
+
+        Raises:
+            subprocess.CalledProcessError: If cwd is not inside a git repository
+        """
+        self._metadata = await repo_metadata(self.cwd)
+        libc = _libc_inotify() if self.use_inotify else None
+        if libc is not None:
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd >= 0:
+                self._fd = fd
+                self._libc = libc
+                for directory in self._directories():
+                    self._add_watch(directory)
+                asyncio.get_running_loop().add_reader(fd, self._read_events)
+        if self._fd is None:
+            self._tasks.append(asyncio.ensure_future(self._poll()))
+        self._tasks.append(asyncio.ensure_future(self._run()))
+        self._changed.set()
+
+    def stop(self) -> None:
+        """Stop watching and cancel a warm-up in progress."""
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        if self._fd is not None:
+            asyncio.get_running_loop().remove_reader(self._fd)
+            os.close(self._fd)
+            self._fd = None
+            self._watches = {}
+
+    def _directories(self) -> List[str]:
+        """Where HEAD, packed-refs and the loose refs live (ref updates rename a .lock file into place)."""
+        directories = {self._metadata.git_dir, self._metadata.common_dir}
+        for root, _, _ in os.walk(os.path.join(self._metadata.common_dir, "refs")):
+            directories.add(root)
+        return sorted(directories)
+
+    def _add_watch(self, directory: str) -> None:
+        mask = _IN_MODIFY | _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), mask)
+        if wd >= 0:
+            self._watches[wd] = directory
+
+    def _read_events(self) -> None:
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        pos = 0
+        while pos + _IN_EVENT.size <= len(data):
+            wd, mask, _, length = _IN_EVENT.unpack_from(data, pos)
+            name = data[pos + _IN_EVENT.size:pos + _IN_EVENT.size + length].rstrip(b"\0")
+            pos += _IN_EVENT.size + length
+            if mask & _IN_ISDIR and mask & _IN_CREATE and wd in self._watches:
+                # A new namespace such as refs/heads/feature/
+                self._add_watch(os.path.join(self._watches[wd], os.fsdecode(name)))
+        self.events += 1
+        self._changed.set()
+
+    async def _poll(self) -> None:
+        signature = None
+        while True:
+            current = self._metadata.refs_signature(self.base_branch or self._metadata.default_branch or "main")
+            if signature is not None and current != signature:
+                self.events += 1
+                self._changed.set()
+            signature = current
+            await asyncio.sleep(self.interval)
+
+    async def _run(self) -> None:
+        while True:
+            await self._changed.wait()
+            self._changed.clear()
+            # Wait until a commit or checkout has finished writing its files
+            await asyncio.sleep(self.debounce)
+            if self._changed.is_set():
+                continue
+            await self._warm()
+
+    async def _warm(self) -> None:
+        started = time.perf_counter()
+        try:
+            with deadline(tool_timeout("ref_watcher")), on_behalf_of("ref-watcher"):
+                refs = await resolve_refs(self.base_branch, self.cwd)
+                if (refs.merge_base, refs.head) == self._last_refs:
+                    return
+                await analyze_changes(self.base_branch, self.cwd)
+        except Exception as e:
+            # Detached or unborn HEAD, a missing base branch, a timeout: try again on the next change
+            self.last_error = str(e)
+            return
+        self._last_refs = (refs.merge_base, refs.head)
+        self.warmed += 1
+        self.last_warm_ms = round((time.perf_counter() - started) * 1000, 2)
+        self.last_error = None
+
+
+# Watchers by (working directory, base branch), one set per event loop
+_ref_watchers: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[Tuple[str, Optional[str]], RefWatcher]]" = weakref.WeakKeyDictionary()
+
+
+async def watch_refs(cwd: str, base_branch: Optional[str] = None, **options) -> RefWatcher:
+    """Start (once) a RefWatcher for cwd and base_branch; options are passed to RefWatcher.
+
+    Raises:
+        subprocess.CalledProcessError: If cwd is not inside a git repository
+    """
+    watchers = _ref_watchers.setdefault(asyncio.get_running_loop(), {})
+    watcher = watchers.get((cwd, base_branch))
+    if watcher is None:
+        watcher = RefWatcher(cwd, base_branch, **options)
+        await watcher.start()
+        watchers[(cwd, base_branch)] = watcher
+    return watcher
+
+
+def stop_ref_watchers() -> None:
+    """Stop every watcher of the running event loop."""
+    for watcher in _ref_watchers.pop(asyncio.get_running_loop(), {}).values():
+        watcher.stop()
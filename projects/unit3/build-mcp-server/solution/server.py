@@ -7,10 +7,33 @@ A minimal MCP server that provides tools for analyzing file changes and suggesti
 import json
 import os
 import subprocess
-from typing import Optional
+import weakref
+from typing import List, Optional
 from pathlib import Path
 
 from mcp.server.fastmcp import FastMCP
+from mcp.server.session import ServerSession
+from mcp.types import RootsListChangedNotification
+
+from git_analysis import (
+    DeadlineExceeded,
+    OWNERSHIP_DAYS,
+    WATCH_REFS,
+    affected_tests,
+    analyze_batch,
+    analyze_changes,
+    classify_branch,
+    classify_changes,
+    deadline,
+    governor,
+    on_behalf_of,
+    rank_reviewers,
+    read_commit_history,
+    read_diff_page,
+    read_file_versions,
+    tool_timeout,
+    watch_refs
+)
 
 # Initialize the FastMCP server
 mcp = FastMCP("pr-agent")
@@ -47,34 +70,100 @@ TYPE_MAPPING = {
 }
 
 
+# Roots reported by each client session, so the client is only asked once per session
+_session_roots: "weakref.WeakKeyDictionary[ServerSession, list]" = weakref.WeakKeyDictionary()
+
+
+async def get_session_roots() -> list:
+    """Get the roots of the current client session, asking the client until it has answered once."""
+    session = mcp.get_context().session
+    if session not in _session_roots:
+        # A failed request isn't remembered, so a client that couldn't answer is asked again
+        _session_roots[session] = (await session.list_roots()).roots
+    return _session_roots[session]
+
+
+async def handle_roots_list_changed(notification: RootsListChangedNotification) -> None:
+    """Forget cached roots when a client reports that its roots changed."""
+    # The notification doesn't say which session sent it, so every session asks again
+    _session_roots.clear()
+
+
+mcp._mcp_server.notification_handlers[RootsListChangedNotification] = handle_roots_list_changed
+
+
+def session_key() -> str:
+    """Identify the client session of the current request, so git work is shared fairly between sessions."""
+    try:
+        return f"session-{id(mcp.get_context().session):x}"
+    except Exception:
+        # Not called from a request
+        return "local"
+
+
+async def resolve_working_directory(working_directory: Optional[str]) -> Optional[str]:
+    """Return working_directory, or the session's first root when it isn't given."""
+    if working_directory is None:
+        try:
+            roots = await get_session_roots()
+            # Get the first root - Claude Code sets this to the CWD
+            root = roots[0]
+            # FileUrl object has a .path property that gives us the path directly
+            working_directory = root.uri.path
+        except Exception:
+            # If we can't get roots, fall back to current directory
+            pass
+    return working_directory
+
+
 @mcp.tool()
 async def analyze_file_changes(
-    base_branch: str = "main",
+    base_branch: Optional[str] = None,
     include_diff: bool = True,
     max_diff_lines: int = 500,
-    working_directory: Optional[str] = None
+    working_directory: Optional[str] = None,
+    paths: Optional[List[str]] = None,
+    exclude: Optional[List[str]] = None,
+    max_tokens: Optional[int] = None,
+    profile: Optional[str] = None,
+    semantic: bool = False,
+    digest_dependencies: bool = True,
+    render: Optional[str] = None,
+    timeout: Optional[float] = None
 ) -> str:
     """Get the full diff and list of changed files in the current git repository.
     
+    The composition field counts files and lines by extension, top-level directory and kind
+    of change (added, modified, deleted, renamed), often enough without reading the diff.
+    Files matching the repository's .pr-agent-ignore (gitignore syntax) are never diffed;
+    the omitted field lists them with their line counts.
+    
     Args:
-        base_branch: Base branch to compare against (default: main)
+        base_branch: Base branch to compare against (default: detected from origin/HEAD,
+            init.defaultBranch or an existing main/master/develop/trunk branch)
         include_diff: Include the full diff content (default: true)
-        max_diff_lines: Maximum number of diff lines to include (default: 500)
+        max_diff_lines: Maximum number of diff lines to include (default: 500); page through the rest with get_diff_page
         working_directory: Directory to run git commands in (default: current directory)
+        paths: Only include the diff of files matching these globs or directories (e.g. ["src/", "*.py"])
+        exclude: Leave out the diff of files matching these globs or directories (e.g. ["*.lock"])
+        max_tokens: Fit the diff into this many tokens, shared fairly between files, instead of
+            cutting it at max_diff_lines; the "elided" list says what was left out and how to fetch it
+        profile: "fast" to skip rename detection and binary/generated file contents on large
+            repositories, "full", or a profile configured in git config (default: the repository's
+            pr-agent.profile setting, else "full")
+        semantic: Also list the classes and functions added, removed, modified or moved in Python files
+        digest_dependencies: Summarize changed uv.lock, poetry.lock and pyproject.toml files as packages
+            added, removed and upgraded, leaving the lockfiles' hunks out of the diff (default: true)
+        render: How the diff is rendered: "default", "zero_context" (no context lines),
+            "function_context" (whole enclosing functions), "stat" (no patch) or "condensed"
+            (one "diff <path>" line per file instead of the a/b and index headers). Anything
+            but "default" adds a rendering report with the bytes and tokens it saves
+        timeout: Seconds to spend on git before returning partial results with timed_out set
+            (default: PR_AGENT_TIMEOUT_ANALYZE_FILE_CHANGES or PR_AGENT_TOOL_TIMEOUT, else 30)
     """
     try:
         # Try to get working directory from roots first
-        if working_directory is None:
-            try:
-                context = mcp.get_context()
-                roots_result = await context.session.list_roots()
-                # Get the first root - Claude Code sets this to the CWD
-                root = roots_result.roots[0]
-                # FileUrl object has a .path property that gives us the path directly
-                working_directory = root.uri.path
-            except Exception:
-                # If we can't get roots, fall back to current directory
-                pass
+        working_directory = await resolve_working_directory(working_directory)
         
         # Use provided working directory or current directory
         cwd = working_directory if working_directory else os.getcwd()
@@ -88,14 +177,13 @@ async def analyze_file_changes(
             "roots_check": None
         }
         
-        # Add roots debug info
+        # Add roots debug info (from the session's cached roots)
         try:
-            context = mcp.get_context()
-            roots_result = await context.session.list_roots()
+            roots = await get_session_roots()
             debug_info["roots_check"] = {
                 "found": True,
-                "count": len(roots_result.roots),
-                "roots": [str(root.uri) for root in roots_result.roots]
+                "count": len(roots),
+                "roots": [str(root.uri) for root in roots]
             }
         except Exception as e:
             debug_info["roots_check"] = {
@@ -103,71 +191,245 @@ async def analyze_file_changes(
                 "error": str(e)
             }
         
-        # Get list of changed files
-        files_result = subprocess.run(
-            ["git", "diff", "--name-status", f"{base_branch}...HEAD"],
-            capture_output=True,
-            text=True,
-            check=True,
-            cwd=cwd
-        )
+        if timeout is None:
+            timeout = tool_timeout("analyze_file_changes")
+        with deadline(timeout), on_behalf_of(session_key()):
+            analysis = await analyze_changes(
+                base_branch, cwd, include_diff, max_diff_lines, paths, exclude, max_tokens, profile, semantic,
+                digest_dependencies, render
+            )
+        if WATCH_REFS:
+            # Keep the analysis of this branch warm as commits land
+            await watch_refs(cwd, base_branch)
+        analysis["_debug"] = debug_info
         
-        # Get diff statistics
-        stat_result = subprocess.run(
-            ["git", "diff", "--stat", f"{base_branch}...HEAD"],
-            capture_output=True,
-            text=True,
-            cwd=cwd
-        )
+        return json.dumps(analysis, indent=2)
         
-        # Get the actual diff if requested
-        diff_content = ""
-        truncated = False
-        if include_diff:
-            diff_result = subprocess.run(
-                ["git", "diff", f"{base_branch}...HEAD"],
-                capture_output=True,
-                text=True,
-                cwd=cwd
-            )
-            diff_lines = diff_result.stdout.split('\n')
-            
-            # Check if we need to truncate
-            if len(diff_lines) > max_diff_lines:
-                diff_content = '\n'.join(diff_lines[:max_diff_lines])
-                diff_content += f"\n\n... Output truncated. Showing {max_diff_lines} of {len(diff_lines)} lines ..."
-                diff_content += "\n... Use max_diff_lines parameter to see more ..."
-                truncated = True
-            else:
-                diff_content = diff_result.stdout
+    except DeadlineExceeded as e:
+        return json.dumps({"error": str(e), "timed_out": True})
+    except subprocess.CalledProcessError as e:
+        return json.dumps({"error": f"Git error: {e.stderr}"})
+    except Exception as e:
+        return json.dumps({"error": str(e)})
+
+
+@mcp.tool()
+async def analyze_repositories(
+    working_directories: List[str],
+    base_branches: Optional[List[Optional[str]]] = None,
+    include_diff: bool = False,
+    max_diff_lines: int = 500,
+    max_bytes: int = 200000,
+    profile: Optional[str] = None,
+    timeout: Optional[float] = None
+) -> str:
+    """Analyze the changes in several repositories at once, like analyze_file_changes for each.
+    
+    Args:
+        working_directories: The repositories to analyze
+        base_branches: Base branch for each repository, in the same order (default: detected for each)
+        include_diff: Include each repository's diff (default: false)
+        max_diff_lines: Maximum number of diff lines per repository (default: 500)
+        max_bytes: Upper bound for the whole response; repositories over their share are cut (default: 200000)
+        profile: Diff profile for every repository (default: each repository's own setting)
+        timeout: Seconds to spend on git for the whole batch
+            (default: PR_AGENT_TIMEOUT_ANALYZE_REPOSITORIES or PR_AGENT_TOOL_TIMEOUT, else 30)
+    """
+    try:
+        if base_branches is not None and len(base_branches) != len(working_directories):
+            raise ValueError("base_branches must have one entry per working directory")
+        targets = list(zip(working_directories, base_branches or [None] * len(working_directories)))
+        if timeout is None:
+            timeout = tool_timeout("analyze_repositories")
+        with deadline(timeout), on_behalf_of(session_key()):
+            batch = await analyze_batch(targets, include_diff, max_diff_lines, max_bytes, profile)
+        # Not indented: max_bytes bounds the compact encoding
+        return json.dumps(batch)
         
-        # Get commit messages for context
-        commits_result = subprocess.run(
-            ["git", "log", "--oneline", f"{base_branch}..HEAD"],
-            capture_output=True,
-            text=True,
-            cwd=cwd
-        )
+    except Exception as e:
+        return json.dumps({"error": str(e)})
+
+
+@mcp.tool()
+async def get_diff_page(
+    handle: str,
+    offset: int = 0,
+    limit: int = 500,
+    unit: str = "lines",
+    paths: Optional[List[str]] = None,
+    exclude: Optional[List[str]] = None,
+    timeout: Optional[float] = None
+) -> str:
+    """Get the next part of a diff returned by analyze_file_changes without recomputing it.
+    
+    Args:
+        handle: The diff_handle returned by analyze_file_changes
+        offset: First line to return, or the byte offset when unit is "bytes" (default: 0)
+        limit: Number of lines, or maximum bytes when unit is "bytes" (default: 500)
+        unit: Page by "lines" or "bytes" (default: lines)
+        paths: Only include files matching these globs or directories
+        exclude: Leave out files matching these globs or directories
+        timeout: Seconds to spend on git (default: PR_AGENT_TIMEOUT_GET_DIFF_PAGE or PR_AGENT_TOOL_TIMEOUT, else 30)
+    """
+    try:
+        if timeout is None:
+            timeout = tool_timeout("get_diff_page")
+        with deadline(timeout), on_behalf_of(session_key()):
+            page = await read_diff_page(handle, offset, limit, unit, paths, exclude)
+        return json.dumps(page, indent=2)
         
-        analysis = {
-            "base_branch": base_branch,
-            "files_changed": files_result.stdout,
-            "statistics": stat_result.stdout,
-            "commits": commits_result.stdout,
-            "diff": diff_content if include_diff else "Diff not included (set include_diff=true to see full diff)",
-            "truncated": truncated,
-            "total_diff_lines": len(diff_lines) if include_diff else 0,
-            "_debug": debug_info
-        }
+    except DeadlineExceeded as e:
+        return json.dumps({"error": str(e), "timed_out": True})
+    except subprocess.CalledProcessError as e:
+        return json.dumps({"error": f"Git error: {e.stderr}"})
+    except Exception as e:
+        return json.dumps({"error": str(e)})
+
+
+@mcp.tool()
+async def get_file_versions(
+    path: str,
+    base_branch: Optional[str] = None,
+    working_directory: Optional[str] = None,
+    max_bytes: int = 20000,
+    timeout: Optional[float] = None
+) -> str:
+    """Get a changed file's contents before (at the merge-base) and after (at HEAD) the change.
+    
+    Args:
+        path: File path relative to the repository root
+        base_branch: Base branch to compare against (default: detected like analyze_file_changes)
+        working_directory: Directory to run git commands in (default: current directory)
+        max_bytes: Maximum bytes of each version to include (default: 20000)
+        timeout: Seconds to spend on git (default: PR_AGENT_TIMEOUT_GET_FILE_VERSIONS or PR_AGENT_TOOL_TIMEOUT, else 30)
+    """
+    try:
+        working_directory = await resolve_working_directory(working_directory)
+        cwd = working_directory if working_directory else os.getcwd()
+        if timeout is None:
+            timeout = tool_timeout("get_file_versions")
+        with deadline(timeout), on_behalf_of(session_key()):
+            versions = await read_file_versions(base_branch, cwd, path, max_bytes)
+        return json.dumps(versions, indent=2)
         
-        return json.dumps(analysis, indent=2)
+    except DeadlineExceeded as e:
+        return json.dumps({"error": str(e), "timed_out": True})
+    except subprocess.CalledProcessError as e:
+        return json.dumps({"error": f"Git error: {e.stderr}"})
+    except Exception as e:
+        return json.dumps({"error": str(e)})
+
+
+@mcp.tool()
+async def get_commit_history(
+    base_branch: Optional[str] = None,
+    working_directory: Optional[str] = None,
+    cursor: Optional[str] = None,
+    max_commits: int = 50,
+    timeout: Optional[float] = None
+) -> str:
+    """Get the branch's commits (newest first) with author, date and the lines added and deleted per file.
+    
+    Args:
+        base_branch: Base branch to compare against (default: detected like analyze_file_changes)
+        working_directory: Directory to run git commands in (default: current directory)
+        cursor: The next_cursor of a previous page, to continue where it ended
+        max_commits: Maximum number of commits to return (default: 50)
+        timeout: Seconds to spend on git (default: PR_AGENT_TIMEOUT_GET_COMMIT_HISTORY or PR_AGENT_TOOL_TIMEOUT, else 30)
+    """
+    try:
+        working_directory = await resolve_working_directory(working_directory)
+        cwd = working_directory if working_directory else os.getcwd()
+        if timeout is None:
+            timeout = tool_timeout("get_commit_history")
+        with deadline(timeout), on_behalf_of(session_key()):
+            history = await read_commit_history(base_branch, cwd, cursor, max_commits)
+        return json.dumps(history, indent=2)
+        
+    except DeadlineExceeded as e:
+        return json.dumps({"error": str(e), "timed_out": True})
+    except subprocess.CalledProcessError as e:
+        return json.dumps({"error": f"Git error: {e.stderr}"})
+    except Exception as e:
+        return json.dumps({"error": str(e)})
+
+
+@mcp.tool()
+async def suggest_reviewers(
+    base_branch: Optional[str] = None,
+    working_directory: Optional[str] = None,
+    max_reviewers: int = 5,
+    window_days: Optional[int] = None,
+    timeout: Optional[float] = None
+) -> str:
+    """Suggest reviewers: the people who changed the files of this branch most on the base branch.
+    
+    Args:
+        base_branch: Base branch to compare against and whose history is used (default: detected like analyze_file_changes)
+        working_directory: Directory to run git commands in (default: current directory)
+        max_reviewers: Maximum number of reviewers to return (default: 5)
+        window_days: Days of history to consider (default: PR_AGENT_OWNERSHIP_DAYS, else 365)
+        timeout: Seconds to spend on git (default: PR_AGENT_TIMEOUT_SUGGEST_REVIEWERS or PR_AGENT_TOOL_TIMEOUT, else 30)
+    """
+    try:
+        working_directory = await resolve_working_directory(working_directory)
+        cwd = working_directory if working_directory else os.getcwd()
+        if timeout is None:
+            timeout = tool_timeout("suggest_reviewers")
+        with deadline(timeout), on_behalf_of(session_key()):
+            reviewers = await rank_reviewers(base_branch, cwd, max_reviewers, window_days or OWNERSHIP_DAYS)
+        return json.dumps(reviewers, indent=2)
+        
+    except DeadlineExceeded as e:
+        return json.dumps({"error": str(e), "timed_out": True})
+    except subprocess.CalledProcessError as e:
+        return json.dumps({"error": f"Git error: {e.stderr}"})
+    except Exception as e:
+        return json.dumps({"error": str(e)})
+
+
+@mcp.tool()
+async def select_tests(
+    base_branch: Optional[str] = None,
+    working_directory: Optional[str] = None,
+    timeout: Optional[float] = None
+) -> str:
+    """Select the test files affected by the changes against the base branch, from the repository's import graph.
+    
+    A test is selected when it imports a changed Python file, directly or through other
+    modules. The import index is kept in the repository's git directory and only the
+    Python files that changed since it was last updated are parsed again. pytest_args
+    are the selected tests relative to the working directory.
+    
+    Args:
+        base_branch: Base branch to compare against (default: detected like analyze_file_changes)
+        working_directory: Directory to run git commands in (default: current directory)
+        timeout: Seconds to spend on git and parsing (default: PR_AGENT_TIMEOUT_SELECT_TESTS or
+            PR_AGENT_TOOL_TIMEOUT, else 30); a first build cut short carries on at the next call
+    """
+    try:
+        working_directory = await resolve_working_directory(working_directory)
+        cwd = working_directory if working_directory else os.getcwd()
+        if timeout is None:
+            timeout = tool_timeout("select_tests")
+        with deadline(timeout), on_behalf_of(session_key()):
+            selection = await affected_tests(base_branch, cwd)
+        return json.dumps(selection, indent=2)
         
+    except DeadlineExceeded as e:
+        return json.dumps({"error": str(e), "timed_out": True})
     except subprocess.CalledProcessError as e:
         return json.dumps({"error": f"Git error: {e.stderr}"})
     except Exception as e:
         return json.dumps({"error": str(e)})
 
 
+@mcp.tool()
+async def get_git_metrics() -> str:
+    """Get how busy the server's git work is: running and queued commands, wait times and merged requests."""
+    return json.dumps(governor().metrics(), indent=2)
+
+
 @mcp.tool()
 async def get_pr_templates() -> str:
     """List available PR templates with their content."""
@@ -184,18 +446,51 @@ async def get_pr_templates() -> str:
 
 
 @mcp.tool()
-async def suggest_template(changes_summary: str, change_type: str) -> str:
-    """Let Claude analyze the changes and suggest the most appropriate PR template.
+async def suggest_template(
+    changes_summary: str = "",
+    change_type: Optional[str] = None,
+    base_branch: Optional[str] = None,
+    working_directory: Optional[str] = None,
+    timeout: Optional[float] = None
+) -> str:
+    """Suggest the most appropriate PR template for the changes.
+    
+    Without a change_type, the branch's changes are classified locally from the changed
+    paths, line counts, conventional-commit prefixes and keywords, and the ranking with
+    confidences is returned, so the diff doesn't need to be read first.
     
     Args:
-        changes_summary: Your analysis of what the changes do
-        change_type: The type of change you've identified (bug, feature, docs, refactor, test, etc.)
+        changes_summary: Your analysis of what the changes do (optional; its keywords count towards the classification)
+        change_type: The type of change you've identified (bug, feature, docs, refactor, test, etc.);
+            leave it out to classify the changes locally
+        base_branch: Base branch to compare against when classifying (default: detected like analyze_file_changes)
+        working_directory: Directory to run git commands in (default: current directory)
+        timeout: Seconds to spend on git (default: PR_AGENT_TIMEOUT_SUGGEST_TEMPLATE or PR_AGENT_TOOL_TIMEOUT, else 30)
     """
     
     # Get available templates
     templates_response = await get_pr_templates()
     templates = json.loads(templates_response)
     
+    ranking = None
+    classification_error = None
+    if change_type is None or change_type.lower() not in TYPE_MAPPING:
+        try:
+            working_directory = await resolve_working_directory(working_directory)
+            cwd = working_directory if working_directory else os.getcwd()
+            if timeout is None:
+                timeout = tool_timeout("suggest_template")
+            with deadline(timeout), on_behalf_of(session_key()):
+                ranking = (await classify_branch(base_branch, cwd, changes_summary))["ranking"]
+        except Exception as e:
+            # Not a git repository, no base branch...: the summary is all there is
+            classification_error = str(e.stderr if isinstance(e, subprocess.CalledProcessError) else e)
+            ranking = classify_changes([], [], changes_summary)
+        for entry in ranking:
+            entry["template"] = TYPE_MAPPING[entry["type"]]
+        if change_type is None or ranking[0]["score"] > 0:
+            change_type = ranking[0]["type"]
+    
     # Find matching template
     template_file = TYPE_MAPPING.get(change_type.lower(), "feature.md")
     selected_template = next(
@@ -203,12 +498,23 @@ async def suggest_template(changes_summary: str, change_type: str) -> str:
         templates[0]  # Default to first template if no match
     )
     
+    if ranking is not None and ranking[0]["type"] == change_type:
+        reasons = "; ".join(ranking[0]["reasons"]) or "no clear signal, defaulting to a feature"
+        reasoning = f"Classified locally as a {change_type} change ({ranking[0]['confidence']:.0%} confidence): {reasons}."
+    else:
+        reasoning = f"Based on your analysis: '{changes_summary}', this appears to be a {change_type} change."
+    
     suggestion = {
         "recommended_template": selected_template,
-        "reasoning": f"Based on your analysis: '{changes_summary}', this appears to be a {change_type} change.",
+        "reasoning": reasoning,
         "template_content": selected_template["content"],
         "usage_hint": "Claude can help you fill out this template based on the specific changes in your PR."
     }
+    if ranking is not None:
+        suggestion["ranking"] = ranking
+        suggestion["confidence"] = ranking[0]["confidence"] if ranking[0]["type"] == change_type else None
+    if classification_error:
+        suggestion["classification_error"] = classification_error
     
     return json.dumps(suggestion, indent=2)
 
@@ -7,15 +7,23 @@ Run these tests to validate your implementation
 import json
 import pytest
 import asyncio
+import subprocess
 from pathlib import Path
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, AsyncMock
 
 # Import your implemented functions
 try:
     from server import (
         mcp,
         analyze_file_changes,
+        analyze_repositories,
+        get_commit_history,
+        get_diff_page,
+        get_file_versions,
+        get_git_metrics,
         get_pr_templates,
+        select_tests,
+        suggest_reviewers,
         suggest_template
     )
     IMPORTS_SUCCESSFUL = True
@@ -24,6 +32,124 @@ except ImportError as e:
     IMPORT_ERROR = str(e)
 
 
+class FakeStream:
+    """Stand-in for an asyncio subprocess pipe; with hang, it blocks at the end until closed."""
+    
+    def __init__(self, data=b"", hang=False):
+        self._data = data
+        self._closed = asyncio.Event()
+        if not hang:
+            self._closed.set()
+    
+    async def read(self, n=-1):
+        if not self._data:
+            await self._closed.wait()
+        if n < 0:
+            n = len(self._data)
+        chunk, self._data = self._data[:n], self._data[n:]
+        return chunk
+    
+    def close(self):
+        self._closed.set()
+
+
+class FakeGitProcess:
+    """Stand-in for an asyncio git subprocess."""
+    
+    def __init__(self, stdout="", stderr="", returncode=0, hang=False):
+        self.stdout = FakeStream(stdout.encode(), hang)
+        self.stderr = FakeStream(stderr.encode(), hang)
+        self.returncode = returncode
+    
+    def kill(self):
+        self.returncode = -9
+        self.stdout.close()
+        self.stderr.close()
+    
+    async def wait(self):
+        return self.returncode
+
+
+def fake_git(outputs=None, default="", hang=()):
+    """Patch git subprocesses; outputs maps an argument (e.g. "log") to stdout.
+    
+    Commands with an argument in hang never finish after writing their output.
+    The processes started are recorded as (command, process) in the patcher's processes.
+    """
+    outputs = {
+        "--show-toplevel": "/repo\n/repo/.git\n.git\n",
+        "rev-parse": "b" * 40 + "\n",
+        "merge-base": "a" * 40 + "\n",
+        "symbolic-ref": "refs/remotes/origin/main\n",
+        "for-each-ref": "refs/heads/main\n",
+        "config": "",
+        **(outputs or {})
+    }
+    
+    processes = []
+    
+    async def create(*command, **kwargs):
+        stdout = next((out for key, out in outputs.items() if key in command), default)
+        process = FakeGitProcess(stdout, hang=any(key in command for key in hang))
+        processes.append((command, process))
+        return process
+    
+    patcher = patch('asyncio.create_subprocess_exec', side_effect=create)
+    patcher.processes = processes
+    return patcher
+
+
+def git(repo, *args):
+    """Run git in repo for a test's setup or expectations; returns its output."""
+    return subprocess.run(["git", *args], cwd=repo, check=True, capture_output=True, text=True).stdout
+
+
+def init_repo(repo):
+    """Commit the files in repo as "initial" on "main", and check out a "feature" branch from it."""
+    git(repo, "init", "-q", "-b", "main")
+    git(repo, "config", "user.email", "dev@example.com")
+    git(repo, "config", "user.name", "Dev")
+    git(repo, "add", "-A")
+    git(repo, "commit", "-qm", "initial")
+    git(repo, "checkout", "-qb", "feature")
+
+
+@pytest.fixture(autouse=True)
+def empty_analysis_cache():
+    """Start every test with empty caches."""
+    if IMPORTS_SUCCESSFUL:
+        from git_analysis import (
+            analysis_cache, diff_baselines, diff_snapshots, forget_imports, forget_ownership, forget_repo_metadata
+        )
+        analysis_cache.clear()
+        diff_snapshots.clear()
+        diff_baselines.clear()
+        forget_repo_metadata()
+        forget_ownership()
+        forget_imports()
+
+
+# `git diff --raw --numstat -z` output for a single modified file
+RAW_DIFF = ":100644 100644 abc1234 def5678 M\0file1.py\0" "1\t1\tfile1.py\0"
+
+
+@pytest.fixture
+def git_repo(tmp_path):
+    """A git repository with a "feature" branch that changes a few files against "main"."""
+    (tmp_path / "app.py").write_text("a\nb\nc\n")
+    (tmp_path / "old.txt").write_text("rename me\n" * 5)
+    (tmp_path / "logo.png").write_bytes(b"\x00\x01")
+    init_repo(tmp_path)
+    (tmp_path / "app.py").write_text("a\nB\nc\nd\n")
+    (tmp_path / "docs").mkdir()
+    (tmp_path / "docs" / "guide.md").write_text("".join(f"line {i}\n" for i in range(120)))
+    (tmp_path / "logo.png").write_bytes(b"\x00\x02")
+    git(tmp_path, "mv", "old.txt", "docs/new.txt")
+    git(tmp_path, "add", "-A")
+    git(tmp_path, "commit", "-qm", "feat: add guide")
+    return tmp_path
+
+
 class TestImplementation:
     """Test that the required functions are implemented."""
     
@@ -43,9 +169,7 @@ class TestAnalyzeFileChanges:
     @pytest.mark.asyncio
     async def test_returns_json_string(self):
         """Test that analyze_file_changes returns a JSON string."""
-        with patch('subprocess.run') as mock_run:
-            mock_run.return_value = MagicMock(stdout="", stderr="")
-            
+        with fake_git():
             result = await analyze_file_changes()
             
             assert isinstance(result, str), "Should return a string"
@@ -56,9 +180,7 @@ class TestAnalyzeFileChanges:
     @pytest.mark.asyncio
     async def test_includes_required_fields(self):
         """Test that the result includes expected fields."""
-        with patch('subprocess.run') as mock_run:
-            mock_run.return_value = MagicMock(stdout="M\tfile1.py\n", stderr="")
-            
+        with fake_git(default=RAW_DIFF):
             result = await analyze_file_changes()
             data = json.loads(result)
             
@@ -75,18 +197,14 @@ class TestAnalyzeFileChanges:
     @pytest.mark.asyncio
     async def test_output_limiting(self):
         """Test that large diffs are properly truncated."""
-        with patch('subprocess.run') as mock_run:
-            # Create a mock diff with many lines
-            large_diff = "\n".join([f"+ line {i}" for i in range(1000)])
-            
-            # Set up mock responses
-            mock_run.side_effect = [
-                MagicMock(stdout="M\tfile1.py\n", stderr=""),  # files changed
-                MagicMock(stdout="1 file changed, 1000 insertions(+)", stderr=""),  # stats
-                MagicMock(stdout=large_diff, stderr=""),  # diff
-                MagicMock(stdout="abc123 Initial commit", stderr="")  # commits
-            ]
-            
+        # Create a mock diff with many lines
+        large_diff = "\n".join([f"+ line {i}" for i in range(1000)])
+        
+        # Set up mock responses
+        with fake_git({
+            "log": "abc123 Initial commit",  # commits
+            "diff": RAW_DIFF + "\0" + large_diff  # files changed, stats and diff
+        }):
             # Test with default limit (500 lines)
             result = await analyze_file_changes(include_diff=True)
             data = json.loads(result)
@@ -106,6 +224,1529 @@ class TestAnalyzeFileChanges:
                     assert "truncated" in data["diff"].lower() or "..." in data["diff"], \
                         "Should indicate diff was truncated"
 
+    
+    @pytest.mark.asyncio
+    async def test_reports_git_timings(self):
+        """Test that the wall time of each git command is reported."""
+        with fake_git(default=RAW_DIFF):
+            result = await analyze_file_changes()
+            data = json.loads(result)
+        
+        assert set(data["git_timings_ms"]) == {"refs", "diff", "commits", "dependencies"}
+    
+    @pytest.mark.asyncio
+    async def test_streaming_stops_at_line_budget(self, git_repo):
+        """Test that git is stopped at max_diff_lines and the total is estimated from numstat."""
+        result = await analyze_file_changes("main", max_diff_lines=20, working_directory=str(git_repo))
+        data = json.loads(result)
+        
+        assert data["truncated"] is True
+        assert data["total_diff_lines_exact"] is False
+        assert data["total_diff_lines"] > 20
+        assert "Showing 20 of ~" in data["diff"]
+        assert "docs/guide.md" in data["statistics"]
+    
+    @pytest.mark.asyncio
+    async def test_exact_total_when_not_truncated(self, git_repo):
+        """Test that the line count is exact when the whole patch fits."""
+        full = git(git_repo, "diff", "main...HEAD")
+        
+        result = await analyze_file_changes("main", max_diff_lines=1000, working_directory=str(git_repo))
+        data = json.loads(result)
+        
+        assert data["truncated"] is False
+        assert data["total_diff_lines_exact"] is True
+        assert data["total_diff_lines"] == len(full.split("\n"))
+        assert data["diff"] == full
+        assert all(ms >= 0 for ms in data["git_timings_ms"].values())
+
+
+@pytest.mark.skipif(not IMPORTS_SUCCESSFUL, reason="Imports failed")
+class TestGitRunner:
+    """Test the asyncio git runner."""
+    
+    @pytest.mark.asyncio
+    async def test_run_git(self, tmp_path):
+        """Test that git runs as a subprocess and reports its wall time."""
+        from git_analysis import run_git
+        
+        result = await run_git(["--version"], str(tmp_path))
+        
+        assert result.returncode == 0
+        assert result.stdout.startswith("git version")
+        assert result.elapsed > 0
+    
+    @pytest.mark.asyncio
+    async def test_run_git_check(self, tmp_path):
+        """Test that failing commands raise CalledProcessError when checked."""
+        from git_analysis import run_git
+        
+        with pytest.raises(subprocess.CalledProcessError):
+            await run_git(["rev-parse", "HEAD"], str(tmp_path), check=True)
+    
+
+@pytest.mark.skipif(not IMPORTS_SUCCESSFUL, reason="Imports failed")
+class TestDiffModel:
+    """Test the single-pass diff parser against git's own output."""
+    
+    def test_matches_git_name_status(self, git_repo):
+        """Test that the file list is identical to `git diff --name-status`."""
+        from git_analysis import diff_args, parse_diff
+        
+        diff = parse_diff(git(git_repo, *diff_args("main")))
+        
+        assert diff.name_status() == git(git_repo, "diff", "--name-status", "main...HEAD")
+    
+    def test_matches_git_stat(self, git_repo):
+        """Test that statistics match `git diff --stat` (binary files omit byte sizes)."""
+        from git_analysis import diff_args, parse_diff
+        
+        diff = parse_diff(git(git_repo, *diff_args("main")))
+        expected = git(git_repo, "diff", "--stat", "main...HEAD")
+        
+        ours = diff.stat().splitlines()
+        theirs = expected.splitlines()
+        
+        binary = [i for i, line in enumerate(theirs) if "| Bin" in line]
+        assert binary == [3]
+        assert theirs[3].startswith(ours[3])
+        assert ours[:3] + ours[4:] == theirs[:3] + theirs[4:]
+    
+    def test_matches_git_patch(self, git_repo):
+        """Test that the patch is identical to plain `git diff`."""
+        from git_analysis import diff_args, parse_diff
+        
+        diff = parse_diff(git(git_repo, *diff_args("main")))
+        
+        assert diff.patch == git(git_repo, "diff", "main...HEAD")
+    
+    def test_composition(self, git_repo):
+        """Test the counts by extension, top-level directory and kind of change."""
+        from git_analysis import diff_args, parse_diff
+        
+        composition = parse_diff(git(git_repo, *diff_args("main"))).composition()
+        
+        assert (composition["files"], composition["added"], composition["deleted"]) == (4, 122, 1)
+        assert list(composition["by_extension"]) == [".md", ".py", ".png", ".txt"]
+        assert composition["by_extension"][".png"] == {"files": 1, "added": 0, "deleted": 0, "binary": 1}
+        assert composition["by_directory"]["docs"] == {"files": 2, "added": 120, "deleted": 0, "binary": 0}
+        assert composition["by_directory"]["(root)"]["files"] == 2
+        assert {kind: counts["files"] for kind, counts in composition["by_change"].items()} == {
+            "modified": 2, "added": 1, "renamed": 1
+        }
+    
+    def test_without_patch(self, git_repo):
+        """Test parsing when the patch is not requested."""
+        from git_analysis import diff_args, parse_diff
+        
+        diff = parse_diff(git(git_repo, *diff_args("main", include_patch=False)))
+        
+        assert diff.patch == ""
+        assert [change.path for change in diff.files] == ["app.py", "docs/guide.md", "docs/new.txt", "logo.png"]
+        assert diff.files[2].old_path == "old.txt"
+        assert diff.files[3].binary
+    
+    def test_tab_in_path(self, git_repo):
+        """Test that a path containing a tab keeps its line counts and the patch that follows."""
+        from git_analysis import diff_args, parse_diff
+    
+        (git_repo / "we\tird.py").write_text("x = 1\ny = 2\n")
+        git(git_repo, "add", "-A")
+        git(git_repo, "commit", "-qm", "add tabbed file")
+    
+        diff = parse_diff(git(git_repo, *diff_args("main")))
+        change = next(change for change in diff.files if change.path == "we\tird.py")
+    
+        assert (change.added, change.deleted) == (2, 0)
+        assert diff.patch == git(git_repo, "diff", "main...HEAD")
+    
+    def test_chunk_boundaries(self, git_repo):
+        """Test that feeding the output one byte at a time gives the same model."""
+        from git_analysis import DiffStreamParser, diff_args, parse_diff
+        
+        output = git(git_repo, *diff_args("main")).encode()
+        parser = DiffStreamParser()
+        for i in range(len(output)):
+            parser.feed(output[i:i + 1])
+        
+        assert parser.close() == parse_diff(output)
+    
+    def test_line_budget(self, git_repo):
+        """Test that only the first lines are kept and the parser asks to stop."""
+        from git_analysis import DiffStreamParser, diff_args
+        
+        output = git(git_repo, *diff_args("main"))
+        parser = DiffStreamParser(max_patch_lines=10)
+        
+        assert parser.feed(output.encode()) is True
+        diff = parser.close()
+        
+        patch = output[output.index("diff --git"):]
+        assert diff.truncated
+        assert diff.patch == "\n".join(patch.split("\n")[:10])
+        assert len(diff.files) == 4
+
+
+@pytest.mark.skipif(not IMPORTS_SUCCESSFUL, reason="Imports failed")
+class TestAnalysisCache:
+    """Test caching of analyses by merge-base and HEAD."""
+    
+    @pytest.mark.asyncio
+    async def test_repeat_call_is_cached(self, git_repo):
+        """Test that a second call with unchanged refs skips the diff."""
+        first = json.loads(await analyze_file_changes("main", working_directory=str(git_repo)))
+        second = json.loads(await analyze_file_changes("main", working_directory=str(git_repo)))
+        
+        assert first["cached"] is False
+        assert second["cached"] is True
+        assert set(second["git_timings_ms"]) == {"refs"}
+        assert second["diff"] == first["diff"]
+        assert second["files_changed"] == first["files_changed"]
+    
+    @pytest.mark.asyncio
+    async def test_new_commit_invalidates(self, git_repo):
+        """Test that moving HEAD or changing parameters computes a new analysis."""
+        await analyze_file_changes("main", working_directory=str(git_repo))
+        other_limit = json.loads(await analyze_file_changes("main", max_diff_lines=10, working_directory=str(git_repo)))
+        assert other_limit["cached"] is False
+        
+        (git_repo / "app.py").write_text("changed\n")
+        git(git_repo, "commit", "-qam", "more")
+        after_commit = json.loads(await analyze_file_changes("main", working_directory=str(git_repo)))
+        assert after_commit["cached"] is False
+        assert "changed" in after_commit["diff"]
+    
+    def test_size_based_eviction(self):
+        """Test that the least recently used entries are evicted beyond max_bytes."""
+        from git_analysis import AnalysisCache
+        
+        cache = AnalysisCache(max_bytes=100)
+        cache.put(("a",), {"diff": "x" * 30})
+        cache.put(("b",), {"diff": "y" * 30})
+        cache.get(("a",))
+        cache.put(("c",), {"diff": "z" * 30})
+        
+        assert cache.get(("a",)) is not None
+        assert cache.get(("b",)) is None
+        assert cache.get(("c",)) is not None
+        assert cache.size <= 100
+    
+    def test_persists_under_git_dir(self, tmp_path):
+        """Test that persisted entries are read back by a new cache instance."""
+        from git_analysis import AnalysisCache
+        
+        AnalysisCache(persist=True).put(("repo", "base", "head"), {"diff": "d"}, str(tmp_path))
+        
+        assert list((tmp_path / "pr-agent-cache").glob("*.json"))
+        assert AnalysisCache(persist=True).get(("repo", "base", "head"), str(tmp_path)) == {"diff": "d"}
+        assert AnalysisCache(persist=False).get(("repo", "base", "head"), str(tmp_path)) is None
+
+
+@pytest.mark.skipif(not IMPORTS_SUCCESSFUL, reason="Imports failed")
+class TestDiffPaging:
+    """Test paging through a truncated diff with get_diff_page."""
+    
+    @staticmethod
+    def full_diff(repo):
+        return git(repo, "diff", "main...HEAD")
+    
+    @pytest.mark.asyncio
+    async def test_pages_continue_where_analysis_stopped(self, git_repo):
+        """Test that pages by line reassemble the full diff."""
+        data = json.loads(await analyze_file_changes("main", max_diff_lines=50, working_directory=str(git_repo)))
+        handle = data["diff_handle"]
+        assert f'get_diff_page(handle="{handle}", offset=50)' in data["diff"]
+        
+        lines = data["diff"].split("\n")[:50]
+        offset = 50
+        while offset is not None:
+            page = json.loads(await get_diff_page(handle, offset=offset, limit=40))
+            assert page["first_line"] == offset
+            lines.extend(page["content"].split("\n"))
+            offset = page["next_offset"]
+        
+        assert "\n".join(lines) == self.full_diff(git_repo)
+    
+    @pytest.mark.asyncio
+    async def test_pages_by_bytes(self, git_repo):
+        """Test that byte pages hold whole lines within the byte limit."""
+        data = json.loads(await analyze_file_changes("main", max_diff_lines=10, working_directory=str(git_repo)))
+        
+        contents = []
+        offset = 0
+        while offset is not None:
+            page = json.loads(await get_diff_page(data["diff_handle"], offset=offset, limit=200, unit="bytes"))
+            assert len(page["content"].encode()) <= 200
+            contents.append(page["content"])
+            offset = page["next_offset"]
+        
+        assert "\n".join(contents) == self.full_diff(git_repo)
+    
+    @pytest.mark.asyncio
+    async def test_unknown_or_expired_handle(self, git_repo):
+        """Test that expired snapshots report an error."""
+        from git_analysis import diff_snapshots
+        
+        data = json.loads(await analyze_file_changes("main", max_diff_lines=10, working_directory=str(git_repo)))
+        
+        diff_snapshots._snapshots[data["diff_handle"]].expires_at = 0
+        result = json.loads(await get_diff_page(data["diff_handle"]))
+        
+        assert "expired" in result["error"]
+        assert "error" in json.loads(await get_diff_page("diff-unknown"))
+    
+    @pytest.mark.asyncio
+    async def test_snapshots_are_unloaded_over_budget(self, git_repo, monkeypatch):
+        """Test that least recently used patches are dropped over max_bytes and read again when paged."""
+        from git_analysis import DiffProfile, diff_args, diff_snapshots
+        
+        renders = ("default", "zero_context")
+        # Room for either patch, but not for both
+        outputs = [git(git_repo, *diff_args("main", profile=DiffProfile(render=render))) for render in renders]
+        monkeypatch.setattr(diff_snapshots, "max_bytes", max(len(output.encode()) for output in outputs))
+        handles = []
+        for render in renders:
+            data = json.loads(await analyze_file_changes("main", working_directory=str(git_repo), render=render))
+            handles.append(data["diff_handle"])
+        first = json.loads(await get_diff_page(handles[0]))
+        await get_diff_page(handles[1])
+        
+        old, new = (diff_snapshots._snapshots[handle] for handle in handles)
+        assert old.patch is None and not old.files
+        assert diff_snapshots.size == new.size > 0
+        assert json.loads(await get_diff_page(handles[0])) == first
+        assert new.patch is None and diff_snapshots.size == old.size
+    
+    @pytest.mark.asyncio
+    async def test_oversized_snapshot_is_streamed(self, git_repo, monkeypatch):
+        """Test that a diff over max_bytes is never kept, and its pages are streamed from git."""
+        from git_analysis import diff_snapshots
+        
+        monkeypatch.setattr(diff_snapshots, "max_bytes", 1000)
+        data = json.loads(await analyze_file_changes("main", max_diff_lines=10, working_directory=str(git_repo)))
+        handle = data["diff_handle"]
+        
+        for unit, limit in (("lines", 40), ("bytes", 300)):
+            pages = []
+            offset = 0
+            while offset is not None:
+                pages.append(json.loads(await get_diff_page(handle, offset=offset, limit=limit, unit=unit)))
+                offset = pages[-1]["next_offset"]
+            assert "\n".join(page["content"] for page in pages) == self.full_diff(git_repo)
+            assert [page["total_lines_exact"] for page in pages] == [False] * (len(pages) - 1) + [True]
+            assert pages[-1]["total_bytes"] == len(self.full_diff(git_repo).encode())
+        
+        assert diff_snapshots._snapshots[handle].patch is None and diff_snapshots.size == 0
+        filtered = json.loads(await get_diff_page(handle, paths=["docs/"]))
+        assert "PR_AGENT_SNAPSHOT_MAX_BYTES" in filtered["error"]
+    
+    @pytest.mark.asyncio
+    async def test_size_ignores_snapshots_dropped_while_read(self, git_repo):
+        """Test that a patch read for a snapshot that expired in the meantime isn't counted."""
+        from git_analysis import diff_snapshots
+        
+        data = json.loads(await analyze_file_changes("main", max_diff_lines=10, working_directory=str(git_repo)))
+        snapshot = diff_snapshots._snapshots[data["diff_handle"]]
+        diff_snapshots.clear()
+        
+        await diff_snapshots._read(data["diff_handle"], snapshot)
+        
+        assert snapshot.patch is not None and diff_snapshots.size == 0
+
+
+@pytest.mark.skipif(not IMPORTS_SUCCESSFUL, reason="Imports failed")
+class TestDiffFilters:
+    """Test path and glob filtering of the diff."""
+    
+    @staticmethod
+    def file_diff(repo, *paths):
+        return git(repo, "diff", "main...HEAD", "--", *paths)
+    
+    @pytest.mark.asyncio
+    async def test_paths(self, git_repo):
+        """Test that only the requested files' patches are returned."""
+        data = json.loads(await analyze_file_changes("main", paths=["app.py"], working_directory=str(git_repo)))
+        
+        assert data["diff_files"] == ["app.py"]
+        assert data["diff"] == self.file_diff(git_repo, "app.py")
+        assert "docs/guide.md" in data["files_changed"]
+    
+    @pytest.mark.asyncio
+    async def test_globs_directories_and_exclude(self, git_repo):
+        """Test glob and directory patterns, renamed files and exclusions."""
+        data = json.loads(await analyze_file_changes(
+            "main", paths=["docs/", "*.png"], exclude=["*.md"], working_directory=str(git_repo)
+        ))
+        assert data["diff_files"] == ["docs/new.txt", "logo.png"]
+        
+        data = json.loads(await analyze_file_changes("main", paths=["old.txt"], working_directory=str(git_repo)))
+        assert data["diff_files"] == ["docs/new.txt"]
+    
+    @pytest.mark.asyncio
+    async def test_filtered_paging(self, git_repo):
+        """Test that a truncated filtered diff pages through the same files."""
+        data = json.loads(await analyze_file_changes(
+            "main", max_diff_lines=20, exclude=["app.py"], working_directory=str(git_repo)
+        ))
+        assert data["truncated"] is True
+        assert 'exclude=["app.py"]' in data["diff"]
+        
+        page = json.loads(await get_diff_page(data["diff_handle"], offset=20, limit=1000, exclude=["app.py"]))
+        full = "\n".join(data["diff"].split("\n")[:20] + [page["content"]])
+        
+        assert full == self.file_diff(git_repo, "docs", "old.txt", "logo.png")
+    
+    def test_hunk_index(self):
+        """Test that hunk offsets point at the @@ lines of each file."""
+        from git_analysis import FileChange, _index_files
+        
+        patch = (
+            b"diff --git a/a.py b/a.py\n--- a/a.py\n+++ b/a.py\n@@ -1 +1 @@\n-x\n+y\n@@ -9 +9 @@\n-p\n+q\n"
+            b"diff --git a/b.py b/b.py\n--- a/b.py\n+++ b/b.py\n@@ -1 +1 @@\n-m\n+n\n"
+        )
+        index = _index_files(patch, [FileChange("M", "a.py"), FileChange("M", "b.py")])
+        
+        assert [patch[h:h + 2] for h in index["a.py"].hunks] == [b"@@", b"@@"]
+        assert len(index["b.py"].hunks) == 1
+        assert patch[index["b.py"].start:index["b.py"].end].startswith(b"diff --git a/b.py")
+        assert index["b.py"].end == len(patch)
+
+
+@pytest.mark.skipif(not IMPORTS_SUCCESSFUL, reason="Imports failed")
+class TestTokenBudget:
+    """Test packing the diff into a token budget."""
+    
+    @pytest.mark.asyncio
+    async def test_large_file_does_not_starve_small_ones(self, git_repo):
+        """Test that small files are kept whole while the large one is summarized."""
+        data = json.loads(await analyze_file_changes("main", max_tokens=150, working_directory=str(git_repo)))
+        
+        assert "+B" in data["diff"]  # app.py is small and kept in full
+        assert "rename to docs/new.txt" in data["diff"]
+        assert data["truncated"] is True
+        assert [item["path"] for item in data["elided"]] == ["docs/guide.md"]
+        assert "paths=[\"docs/guide.md\"]" in data["elided"][0]["fetch"]
+        assert data["token_budget"]["used_tokens"] <= 150
+        assert data["token_budget"]["full_tokens"] > 150
+    
+    @pytest.mark.asyncio
+    async def test_budget_large_enough_for_everything(self, git_repo):
+        """Test that nothing is elided when the whole diff fits."""
+        full = git(git_repo, "diff", "main...HEAD")
+        
+        data = json.loads(await analyze_file_changes("main", max_tokens=100000, working_directory=str(git_repo)))
+        
+        assert data["elided"] == []
+        assert data["truncated"] is False
+        assert data["diff"] == full
+        assert data["total_diff_lines"] == len(full.split("\n"))
+
+
+@pytest.mark.skipif(not IMPORTS_SUCCESSFUL, reason="Imports failed")
+class TestSessionRoots:
+    """Test that client roots are cached per session."""
+    
+    @staticmethod
+    def client_with_roots(path):
+        root = MagicMock()
+        root.uri.path = str(path)
+        root.uri.__str__.return_value = f"file://{path}"
+        context = MagicMock()
+        context.session.list_roots = AsyncMock(return_value=MagicMock(roots=[root]))
+        return context
+    
+    @pytest.mark.asyncio
+    async def test_roots_requested_once_per_session(self, git_repo):
+        """Test that repeated calls, including the debug info, reuse the session's roots."""
+        context = self.client_with_roots(git_repo)
+        
+        with patch.object(mcp, "get_context", return_value=context):
+            first = json.loads(await analyze_file_changes("main"))
+            second = json.loads(await analyze_file_changes("main"))
+        
+        assert context.session.list_roots.await_count == 1
+        assert first["_debug"]["actual_cwd"] == str(git_repo)
+        assert second["_debug"]["roots_check"]["count"] == 1
+    
+    @pytest.mark.asyncio
+    async def test_failed_request_is_not_cached(self, git_repo):
+        """Test that a session whose roots couldn't be listed is asked again next time."""
+        context = self.client_with_roots(git_repo)
+        answer = context.session.list_roots.return_value
+        context.session.list_roots.side_effect = [RuntimeError("client busy"), answer]
+        
+        with patch.object(mcp, "get_context", return_value=context):
+            await analyze_file_changes("main")
+            data = json.loads(await analyze_file_changes("main"))
+        
+        assert context.session.list_roots.await_count == 2
+        assert data["_debug"]["actual_cwd"] == str(git_repo)
+    
+    @pytest.mark.asyncio
+    async def test_roots_list_changed_invalidates(self, git_repo):
+        """Test that a roots/list_changed notification makes the server ask again."""
+        from server import handle_roots_list_changed
+        from mcp.types import RootsListChangedNotification
+        
+        context = self.client_with_roots(git_repo)
+        with patch.object(mcp, "get_context", return_value=context):
+            await analyze_file_changes("main")
+            await handle_roots_list_changed(RootsListChangedNotification(method="notifications/roots/list_changed"))
+            await analyze_file_changes("main")
+        
+        assert context.session.list_roots.await_count == 2
+    
+    def test_handler_registered(self):
+        """Test that the notification handler is registered with the MCP server."""
+        from server import handle_roots_list_changed
+        from mcp.types import RootsListChangedNotification
+        
+        assert mcp._mcp_server.notification_handlers[RootsListChangedNotification] is handle_roots_list_changed
+
+
+@pytest.mark.skipif(not IMPORTS_SUCCESSFUL, reason="Imports failed")
+class TestBaseBranchDetection:
+    """Test detecting the base branch and caching repository metadata."""
+    
+    @pytest.mark.asyncio
+    async def test_detects_master(self, git_repo):
+        """Test that a master-based repository needs no base_branch."""
+        git(git_repo, "branch", "-m", "main", "master")
+        
+        data = json.loads(await analyze_file_changes(working_directory=str(git_repo)))
+        
+        assert data["base_branch"] == "master"
+        assert data["base_branch_detected"] is True
+        assert "app.py" in data["files_changed"]
+    
+    @pytest.mark.asyncio
+    async def test_prefers_origin_head(self, git_repo):
+        """Test that the branch origin/HEAD points to wins over the usual names."""
+        git(git_repo, "branch", "develop", "main")
+        head = git(git_repo, "rev-parse", "main").strip()
+        git(git_repo, "update-ref", "refs/remotes/origin/develop", head)
+        git(git_repo, "symbolic-ref", "refs/remotes/origin/HEAD", "refs/remotes/origin/develop")
+        
+        data = json.loads(await analyze_file_changes(working_directory=str(git_repo)))
+        
+        assert data["base_branch"] == "develop"
+    
+    @pytest.mark.asyncio
+    async def test_refs_reused_until_they_change(self, git_repo):
+        """Test that HEAD and the merge-base are only resolved again after a commit."""
+        from git_analysis import resolve_refs
+        
+        first = await resolve_refs("main", str(git_repo))
+        with patch("asyncio.create_subprocess_exec") as spawn:
+            again = await resolve_refs("main", str(git_repo))
+        assert spawn.call_count == 0
+        assert again.head == first.head
+        
+        (git_repo / "app.py").write_text("changed\n")
+        git(git_repo, "commit", "-qam", "more")
+        after = await resolve_refs("main", str(git_repo))
+        assert after.head != first.head
+        assert after.merge_base == first.merge_base
+
+
+@pytest.mark.skipif(not IMPORTS_SUCCESSFUL, reason="Imports failed")
+class TestDiffProfiles:
+    """Test the fast profile and profiles configured in git config."""
+    
+    def test_diff_args(self):
+        """Test the git arguments a profile adds."""
+        from git_analysis import DiffProfile, diff_args
+        
+        assert diff_args("main") == ["diff", "--raw", "--numstat", "-z", "-p", "main...HEAD"]
+        profile = DiffProfile("x", pathspec=("src/",), rename_limit=50, diff_filter="AM", attributes_file="/a")
+        assert diff_args("main", profile=profile) == [
+            "-c", "core.attributesFile=/a", "diff", "--raw", "--numstat", "-z", "-p",
+            "-l50", "--diff-filter=AM", "main...HEAD", "--", "src/"
+        ]
+        assert "--no-renames" in diff_args("main", profile=DiffProfile(rename_limit=0))
+    
+    @pytest.mark.asyncio
+    async def test_fast_profile(self, git_repo):
+        """Test that the fast profile skips rename detection and binary contents."""
+        git(git_repo, "config", "--add", "pr-agent.fast.binary", "*.md")
+        
+        data = json.loads(await analyze_file_changes(working_directory=str(git_repo), profile="fast"))
+        
+        assert data["profile"]["name"] == "fast"
+        assert data["profile"]["rename_limit"] == 0
+        assert "D\told.txt" in data["files_changed"]
+        assert "A\tdocs/new.txt" in data["files_changed"]
+        assert "Binary files /dev/null and b/docs/guide.md differ" in data["diff"]
+        assert "line 1" not in data["diff"]
+        assert (git_repo / ".git" / "pr-agent-attributes").read_text() == "*.md -diff\n"
+        
+        full = json.loads(await analyze_file_changes(working_directory=str(git_repo)))
+        assert full["profile"]["name"] == "full"
+        assert "R100\told.txt\tdocs/new.txt" in full["files_changed"]
+        assert "line 1" in full["diff"]
+    
+    @pytest.mark.asyncio
+    async def test_configured_profile(self, git_repo):
+        """Test a profile defined in git config and chosen by pr-agent.profile."""
+        git(git_repo, "config", "pr-agent.profile", "docs")
+        git(git_repo, "config", "pr-agent.docs.pathspec", "docs/")
+        git(git_repo, "config", "pr-agent.docs.diffFilter", "A")
+        
+        data = json.loads(await analyze_file_changes(working_directory=str(git_repo)))
+        
+        assert data["profile"]["name"] == "docs"
+        # The pathspec hides old.txt, so its rename shows up as an addition
+        assert data["files_changed"].split("\n")[:2] == ["A\tdocs/guide.md", "A\tdocs/new.txt"]
+        
+        page = json.loads(await get_diff_page(data["diff_handle"]))
+        assert page["content"].startswith("diff --git a/docs/guide.md")
+        assert "app.py" not in page["content"]
+    
+    @pytest.mark.asyncio
+    async def test_unknown_profile(self, git_repo):
+        """Test the error for a profile that is neither built in nor configured."""
+        data = json.loads(await analyze_file_changes(working_directory=str(git_repo), profile="nope"))
+        assert "Unknown diff profile 'nope'" in data["error"]
+        
+        git(git_repo, "config", "pr-agent.fast.renameLimit", "lots")
+        data = json.loads(await analyze_file_changes(working_directory=str(git_repo), profile="fast"))
+        assert "renameLimit must be a number" in data["error"]
+
+
+@pytest.mark.skipif(not IMPORTS_SUCCESSFUL, reason="Imports failed")
+class TestCatFilePool:
+    """Test reading objects through long-lived git cat-file processes."""
+    
+    @pytest.mark.asyncio
+    async def test_reads_objects(self, git_repo):
+        """Test contents, sizes and missing objects."""
+        from git_analysis import CatFilePool
+        
+        pool = CatFilePool(str(git_repo))
+        try:
+            app = await pool.read("feature:app.py")
+            assert app.type == "blob"
+            assert app.data == b"a\nB\nc\nd\n"
+            
+            info = await pool.info("main:old.txt")
+            assert info.size == 50
+            assert info.data is None
+            
+            assert await pool.read("main:docs/guide.md") is None
+            assert len(pool.processes) == 2
+        finally:
+            await pool.close()
+    
+    @pytest.mark.asyncio
+    async def test_concurrent_requests_share_processes(self, git_repo):
+        """Test that concurrent requests are answered in order by at most `size` processes."""
+        from git_analysis import CatFilePool
+        
+        pool = CatFilePool(str(git_repo), size=2)
+        try:
+            names = ["main:app.py", "feature:app.py", "main:old.txt", "feature:docs/new.txt"] * 5
+            objects = await asyncio.gather(*(pool.read(name) for name in names))
+            assert [obj.name for obj in objects] == names
+            assert objects[1].data == b"a\nB\nc\nd\n"
+            assert objects[3].data == objects[2].data
+            assert len(pool.processes) == 2
+        finally:
+            await pool.close()
+    
+    @pytest.mark.asyncio
+    async def test_restarts_dead_process(self, git_repo):
+        """Test that a request succeeds after its process died."""
+        from git_analysis import CatFilePool
+        
+        pool = CatFilePool(str(git_repo), size=1)
+        try:
+            await pool.read("main:app.py")
+            process = pool.processes[0]
+            process._process.kill()
+            await process._process.wait()
+            
+            app = await pool.read("main:app.py")
+            assert app.data == b"a\nb\nc\n"
+            assert process.restarts == 1
+        finally:
+            await pool.close()
+    
+    @pytest.mark.asyncio
+    async def test_retries_on_a_new_process_after_eof(self, git_repo):
+        """Test that the retry after a broken pipe doesn't go to the dead process, which isn't reaped yet."""
+        from git_analysis import CatFilePool
+        
+        pool = CatFilePool(str(git_repo), size=1)
+        try:
+            await pool.read("main:app.py")
+            process = pool.processes[0]
+            dead = process._process
+            dead.kill()
+            
+            app = await pool.read("main:app.py")
+            assert app.data == b"a\nb\nc\n"
+            assert process.restarts == 1 and process._process is not dead
+        finally:
+            await pool.close()
+    
+    @pytest.mark.asyncio
+    async def test_reaps_idle_processes(self, git_repo):
+        """Test that processes unused for idle_timeout are closed."""
+        from git_analysis import CatFilePool
+        
+        pool = CatFilePool(str(git_repo), idle_timeout=0.05)
+        try:
+            await pool.read("main:app.py")
+            process = pool.processes[0]._process
+            await asyncio.sleep(0.2)
+            assert pool.processes == []
+            assert await asyncio.wait_for(process.wait(), 5) is not None
+        finally:
+            await pool.close()
+    
+    @pytest.mark.asyncio
+    async def test_get_file_versions(self, git_repo):
+        """Test the tool returning both sides of a changed file."""
+        from git_analysis import cat_file_pool
+        
+        try:
+            data = json.loads(await get_file_versions("app.py", working_directory=str(git_repo)))
+            assert data["base"]["content"] == "a\nb\nc\n"
+            assert data["head"]["content"] == "a\nB\nc\nd\n"
+            
+            data = json.loads(await get_file_versions("docs/guide.md", working_directory=str(git_repo), max_bytes=10))
+            assert data["base"] == {"commit": data["base"]["commit"], "exists": False}
+            assert data["head"]["truncated"] is True
+            assert len(data["head"]["content"]) == 10
+            
+            data = json.loads(await get_file_versions("logo.png", working_directory=str(git_repo)))
+            assert data["head"]["binary"] is True
+        finally:
+            await cat_file_pool(str(git_repo)).close()
+
+
+@pytest.mark.skipif(not IMPORTS_SUCCESSFUL, reason="Imports failed")
+class TestDeadlines:
+    """Test tool deadlines and cancellation of git commands."""
+    
+    @pytest.mark.asyncio
+    async def test_partial_result_when_diff_times_out(self):
+        """Test that a hanging diff is killed and what it printed is returned."""
+        git = fake_git({"diff": RAW_DIFF}, hang=("diff",))
+        with git:
+            data = json.loads(await analyze_file_changes(working_directory="/repo", timeout=0.2))
+        
+        assert data["timed_out"] is True
+        assert data["files_changed"] == "M\tfile1.py\n"
+        assert "Timed out" in data["diff"]
+        assert all(process.returncode == -9 for command, process in git.processes if "diff" in command)
+        
+        # Partial results are not cached
+        with fake_git({"diff": RAW_DIFF}):
+            data = json.loads(await analyze_file_changes(working_directory="/repo", timeout=5))
+        assert data["timed_out"] is False
+        assert data["cached"] is False
+    
+    @pytest.mark.asyncio
+    async def test_error_when_refs_time_out(self):
+        """Test that a deadline passing before HEAD is resolved is reported as an error."""
+        with fake_git(hang=("merge-base",)):
+            data = json.loads(await analyze_file_changes(working_directory="/repo", timeout=0.2))
+        
+        assert data["timed_out"] is True
+        assert "deadline" in data["error"]
+    
+    @pytest.mark.asyncio
+    async def test_cancellation_kills_git(self):
+        """Test that cancelling the tool kills the git commands it started."""
+        from git_analysis import analyze_changes
+        
+        git = fake_git(hang=("diff",))
+        with git:
+            task = asyncio.ensure_future(analyze_changes("main", "/repo"))
+            for _ in range(100):
+                if any("diff" in command for command, _ in git.processes):
+                    break
+                await asyncio.sleep(0.01)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+        
+        diff = next(process for command, process in git.processes if "diff" in command)
+        assert diff.returncode == -9
+    
+    def test_per_tool_defaults(self, monkeypatch):
+        """Test that PR_AGENT_TIMEOUT_<TOOL> overrides the default deadline."""
+        from git_analysis import TOOL_TIMEOUT, tool_timeout
+        
+        monkeypatch.setenv("PR_AGENT_TIMEOUT_GET_DIFF_PAGE", "2.5")
+        assert tool_timeout("get_diff_page") == 2.5
+        assert tool_timeout("analyze_file_changes") == TOOL_TIMEOUT
+
+
+@pytest.mark.skipif(not IMPORTS_SUCCESSFUL, reason="Imports failed")
+class TestSemanticSummary:
+    """Test the summary of classes and functions changed in Python files."""
+    
+    BASE = (
+        "class Store:\n"
+        "    size = 1\n"
+        "\n"
+        "    def get(self, key):\n"
+        "        return key\n"
+        "\n"
+        "    def put(self, key):\n"
+        "        pass\n"
+        "\n"
+        "def helper(value):\n"
+        "    return value * 2\n"
+        "\n"
+        "def old():\n"
+        "    pass\n"
+    )
+    
+    def test_symbols(self):
+        """Test that positions and comments don't change a digest, and that a class excludes its methods."""
+        from git_analysis import python_symbols
+        
+        base = python_symbols(self.BASE.encode())["symbols"]
+        assert {name: symbol["kind"] for name, symbol in base.items()} == {
+            "Store": "class", "Store.get": "method", "Store.put": "method", "helper": "function", "old": "function"
+        }
+        
+        shifted = python_symbols(("# header\n\n" + self.BASE.replace("return key", "return key  # same")).encode())["symbols"]
+        assert {n: s["digest"] for n, s in shifted.items()} == {n: s["digest"] for n, s in base.items()}
+        assert shifted["Store"]["line"] == base["Store"]["line"] + 2
+        
+        edited = python_symbols(self.BASE.replace("return key", "return None").encode())["symbols"]
+        assert edited["Store"]["digest"] == base["Store"]["digest"]
+        assert edited["Store.get"]["digest"] != base["Store.get"]["digest"]
+        
+        assert "SyntaxError" in python_symbols(b"def broken(:\n")["error"]
+    
+    @pytest.mark.asyncio
+    async def test_summary_with_moves_and_memoization(self, tmp_path):
+        """Test added, removed, modified and moved symbols, and that blobs are parsed only once."""
+        from git_analysis import analyze_changes, symbol_parser
+        
+        (tmp_path / "store.py").write_text(self.BASE)
+        init_repo(tmp_path)
+        head = self.BASE.replace("return key", "return None").replace("def old():\n    pass\n", "def new():\n    pass\n")
+        (tmp_path / "store.py").write_text(head.replace("def helper(value):\n    return value * 2\n\n", ""))
+        (tmp_path / "utils.py").write_text("def helper(value):\n    return value * 2\n")
+        git(tmp_path, "add", "-A")
+        git(tmp_path, "commit", "-qm", "feat: move helper")
+        
+        try:
+            analysis = await analyze_changes("main", str(tmp_path), include_diff=False, semantic=True)
+            semantic = analysis["semantic"]
+            assert semantic["files"] == {
+                "store.py": {"added": ["new"], "removed": ["old"], "modified": ["Store.get"]}
+            }
+            assert semantic["moved"] == [{
+                "symbol": "helper",
+                "from": {"path": "store.py", "symbol": "helper"},
+                "to": {"path": "utils.py", "symbol": "helper"}
+            }]
+            assert (semantic["blobs_parsed"], semantic["blobs_memoized"]) == (3, 0)
+            
+            again = await analyze_changes("main", str(tmp_path), include_diff=False, semantic=True)
+            assert again["semantic"]["files"] == semantic["files"]
+            assert (again["semantic"]["blobs_parsed"], again["semantic"]["blobs_memoized"]) == (0, 3)
+        finally:
+            symbol_parser.shutdown()
+            symbol_parser.clear()
+
+
+@pytest.mark.skipif(not IMPORTS_SUCCESSFUL, reason="Imports failed")
+class TestDependencyDigest:
+    """Test the package-level summary of lockfile and pyproject.toml changes."""
+    
+    @staticmethod
+    def lockfile(packages):
+        return "version = 1\n" + "".join(
+            f'\n[[package]]\nname = "{name}"\nversion = "{version}"\nsource = {{ registry = "https://pypi.org/simple" }}\n'
+            for name, version in packages.items()
+        )
+    
+    @pytest.mark.asyncio
+    async def test_digests_lockfile_and_manifest(self, tmp_path):
+        """Test that package changes are listed and the lockfile's hunks are left out of the diff."""
+        from git_analysis import analyze_changes
+        
+        (tmp_path / "pyproject.toml").write_text('[project]\nname = "app"\ndependencies = ["httpx>=0.27", "Old_Lib"]\n')
+        (tmp_path / "uv.lock").write_text(self.lockfile({"httpx": "0.27.0", "old-lib": "1.0", "anyio": "4.10.0"}))
+        init_repo(tmp_path)
+        (tmp_path / "pyproject.toml").write_text(
+            '[project]\nname = "app"\ndependencies = ["httpx>=0.28", "mcp[cli]"]\n\n'
+            '[dependency-groups]\ndev = ["pytest"]\n'
+        )
+        (tmp_path / "uv.lock").write_text(self.lockfile(
+            {"httpx": "0.28.1", "anyio": "4.9.0", "mcp": "1.30.0", "pytest": "8.4.0"}
+        ))
+        git(tmp_path, "add", "-A")
+        git(tmp_path, "commit", "-qm", "build: upgrade httpx")
+        
+        analysis = await analyze_changes("main", str(tmp_path))
+        lock, manifest = sorted(analysis["dependencies"]["files"], key=lambda entry: entry["kind"])
+        assert lock["path"] == "uv.lock" and lock["added_lines"] > 0
+        assert [p["name"] for p in lock["added"]] == ["mcp", "pytest"]
+        assert lock["removed"] == [{"name": "old-lib", "version": "1.0"}]
+        assert lock["changed"] == [
+            {"name": "anyio", "from": "4.10.0", "to": "4.9.0", "direction": "downgrade"},
+            {"name": "httpx", "from": "0.27.0", "to": "0.28.1", "direction": "upgrade"}
+        ]
+        assert [r["name"] for r in manifest["added"]] == ["group:dev:pytest", "project:mcp"]
+        assert manifest["removed"] == [{"name": "project:old-lib", "version": "Old_Lib"}]
+        assert manifest["changed"] == [{"name": "project:httpx", "from": "httpx>=0.27", "to": "httpx>=0.28"}]
+        
+        assert analysis["dependencies"]["omitted_from_diff"] == ["uv.lock"]
+        assert "uv.lock" not in analysis["diff"] and "pyproject.toml" in analysis["diff"]
+        
+        raw = await analyze_changes("main", str(tmp_path), digest_dependencies=False)
+        assert "dependencies" not in raw and "+name = \"mcp\"" in raw["diff"]
+        # Only the lockfile's patch is left out; it is still listed and counted
+        assert "uv.lock" in analysis["files_changed"]
+        for name in ("files_changed", "statistics", "composition"):
+            assert analysis[name] == raw[name]
+
+
+@pytest.mark.skipif(not IMPORTS_SUCCESSFUL, reason="Imports failed")
+class TestIgnoreRules:
+    """Test that files matching .pr-agent-ignore are left out of the diff."""
+    
+    def test_gitignore_semantics(self):
+        """Test anchoring, directory-only patterns, "**" and re-inclusion with "!"."""
+        from git_analysis import IgnoreRules
+        
+        rules = IgnoreRules("# generated\n*.min.js\nsnapshots/*\n!snapshots/keep.snap\n/gen/**/*.pb.py\nbuild/\n")
+        
+        assert rules.ignored("web/app.min.js")
+        assert rules.ignored("snapshots/a.snap")
+        assert not rules.ignored("snapshots/keep.snap")
+        assert rules.ignored("gen/api/v1/user.pb.py") and rules.ignored("gen/user.pb.py")
+        assert not rules.ignored("src/gen/user.pb.py")
+        assert rules.ignored("build/out/main.o") and rules.ignored("tools/build/x")
+        assert not rules.ignored("build") and not rules.ignored("app.js")
+    
+    @pytest.mark.asyncio
+    async def test_ignored_files_are_omitted(self, git_repo):
+        """Test that ignored files have no patch but are summarized, and edits to the file take effect."""
+        import os
+        from git_analysis import analyze_changes
+        
+        ignore_file = git_repo / ".pr-agent-ignore"
+        ignore_file.write_text("docs/*\n!docs/new.txt\n")
+        
+        analysis = await analyze_changes("main", str(git_repo))
+        assert analysis["omitted"] == {
+            "rules": ".pr-agent-ignore",
+            "files": [{"path": "docs/guide.md", "added": 120, "deleted": 0}],
+            "total_files": 1,
+            "total_added": 120,
+            "total_deleted": 0
+        }
+        assert "docs/guide.md" not in analysis["diff"] and "docs/guide.md" not in analysis["files_changed"]
+        assert "docs/new.txt" in analysis["files_changed"] and "app.py" in analysis["diff"]
+        
+        ignore_file.write_text("*.py\n")
+        os.utime(ignore_file, ns=(0, 0))
+        analysis = await analyze_changes("main", str(git_repo))
+        assert [f["path"] for f in analysis["omitted"]["files"]] == ["app.py"]
+        assert "docs/guide.md" in analysis["diff"] and "+B" not in analysis["diff"]
+    
+    @pytest.mark.asyncio
+    async def test_many_ignored_files_keep_the_command_short(self, git_repo):
+        """Test that a large ignored tree is excluded by glob, and per-file excludes are capped."""
+        from git_analysis import IGNORE_MAX_PATHS, analyze_changes
+        
+        protos = git_repo / "generated" / "protos"
+        protos.mkdir(parents=True)
+        for i in range(3000):
+            (protos / f"message_{i}_pb2.py").write_text(f"VALUE = {i}\n")
+        git(git_repo, "add", "-A")
+        git(git_repo, "commit", "-qm", "build: regenerate protos")
+        
+        (git_repo / ".pr-agent-ignore").write_text("generated/\n")
+        analysis = await analyze_changes("main", str(git_repo))
+        assert analysis["omitted"]["total_files"] == 3000 and "not_excluded" not in analysis["omitted"]
+        exclude = analysis["profile"]["exclude"]
+        assert "**/generated/**" in exclude and not any(glob.startswith("generated/protos/") for glob in exclude)
+        assert "generated/" not in analysis["files_changed"] and "app.py" in analysis["diff"]
+        
+        # A re-include means the ignored files have to be named one by one
+        (git_repo / ".pr-agent-ignore").write_text("generated/protos/*\n!generated/protos/keep.py\n")
+        analysis = await analyze_changes("main", str(git_repo))
+        assert sum(glob.startswith("generated/protos/") for glob in analysis["profile"]["exclude"]) == IGNORE_MAX_PATHS
+        assert analysis["omitted"]["not_excluded"] == 3000 - IGNORE_MAX_PATHS
+
+
+@pytest.mark.skipif(not IMPORTS_SUCCESSFUL, reason="Imports failed")
+class TestDiffRenderings:
+    """Test the compact renderings of the diff and the savings they report."""
+    
+    @pytest.mark.asyncio
+    async def test_renderings_report_savings(self, git_repo):
+        """Test that each rendering shrinks the patch and reports its size against the default."""
+        default = json.loads(await analyze_file_changes("main", working_directory=str(git_repo)))
+        assert "rendering" not in default
+        
+        zero = json.loads(await analyze_file_changes("main", working_directory=str(git_repo), render="zero_context"))
+        assert "@@ -2 +2 @@ a\n-b\n+B\n@@" in zero["diff"]
+        # Separate hunk headers can cost more than the context they replace
+        assert zero["rendering"]["default_bytes"] == zero["rendering"]["bytes"] + zero["rendering"]["saved_bytes"]
+        
+        condensed = json.loads(await analyze_file_changes("main", working_directory=str(git_repo), render="condensed"))
+        assert condensed["diff"].startswith("diff app.py\n@@")
+        assert "diff old.txt => docs/new.txt" in condensed["diff"]
+        assert "index " not in condensed["diff"] and "+++ b/" not in condensed["diff"]
+        assert condensed["rendering"]["saved_tokens"] > 0
+        
+        page = json.loads(await get_diff_page(condensed["diff_handle"], limit=5))
+        assert page["content"].startswith("diff app.py\n@@")
+        
+        stat = json.loads(await analyze_file_changes("main", working_directory=str(git_repo), render="stat"))
+        assert stat["diff_handle"] is None and "app.py" in stat["statistics"]
+        assert stat["rendering"]["bytes"] == len(stat["statistics"].encode())
+    
+    @pytest.mark.asyncio
+    async def test_long_patches_are_measured_from_their_first_lines(self, git_repo):
+        """Test that only max_diff_lines of each patch are read, the rest estimated from numstat."""
+        from git_analysis import analyze_changes
+        
+        git(git_repo, "checkout", "-q", "main")
+        git(git_repo, "checkout", "-qb", "services")
+        for i in range(40):
+            (git_repo / f"service_{i:02}.py").write_text("".join(f"value_{n} = {n}\n" for n in range(30)))
+        git(git_repo, "add", "-A")
+        git(git_repo, "commit", "-qm", "Add services")
+        
+        for render in ("condensed", "zero_context", "stat"):
+            whole = (await analyze_changes("main", str(git_repo), max_diff_lines=5000, render=render))["rendering"]
+            capped = (await analyze_changes("main", str(git_repo), max_diff_lines=100, render=render))["rendering"]
+            assert whole["exact"] is True and capped["exact"] is False
+            for size in ("bytes", "default_bytes"):
+                assert abs(capped[size] - whole[size]) <= whole[size] // 10
+    
+    @pytest.mark.asyncio
+    async def test_measurement_timeout_spares_the_analysis(self, git_repo, monkeypatch):
+        """Test that a rendering that can't be measured doesn't time out or uncache the analysis."""
+        import git_analysis
+        
+        async def deadline_passed(*args):
+            raise git_analysis.DeadlineExceeded("The patch could not be measured before the deadline")
+        
+        monkeypatch.setattr(git_analysis, "_patch_window", deadline_passed)
+        first = await git_analysis.analyze_changes("main", str(git_repo), False, render="condensed")
+        assert first["timed_out"] is False and first["rendering"]["timed_out"] is True
+        second = await git_analysis.analyze_changes("main", str(git_repo), False, render="condensed")
+        assert second["cached"] is True and "rendering" not in second
+    
+    @pytest.mark.asyncio
+    async def test_unknown_rendering(self, git_repo):
+        """Test that an unknown rendering is an error naming the valid ones."""
+        data = json.loads(await analyze_file_changes("main", working_directory=str(git_repo), render="tiny"))
+        assert "condensed" in data["error"]
+
+
+@pytest.mark.skipif(not IMPORTS_SUCCESSFUL, reason="Imports failed")
+class TestTestSelection:
+    """Test the selection of tests from the import graph."""
+    
+    def test_nearest_module_wins(self):
+        """Test that an ambiguous import resolves to the file sharing the most directories with the importer."""
+        from git_analysis import ModuleTable
+        
+        table = ModuleTable(["other/utils.py", "pkg/utils.py", "pkg/tests/test_x.py"])
+        assert table.resolve("pkg/tests/test_x.py", "utils") == ["pkg/utils.py"]
+        assert table.resolve("main.py", "utils") == ["other/utils.py", "pkg/utils.py"]
+    
+    @pytest.mark.asyncio
+    async def test_selects_tests_importing_changes(self, tmp_path):
+        """Test direct and transitive importers, conftest.py, and incremental index updates."""
+        from git_analysis import AnalysisCache, forget_imports, symbol_parser
+        
+        def write(path, text):
+            (tmp_path / path).parent.mkdir(parents=True, exist_ok=True)
+            (tmp_path / path).write_text(text)
+        
+        write("pkg/__init__.py", "")
+        write("pkg/core.py", "VALUE = 1\n")
+        write("pkg/util.py", "from . import core\n")
+        write("pkg/io.py", "import json\n")
+        write("tests/test_util.py", "from pkg.util import core\n")
+        write("tests/test_io.py", "import pkg.io\n")
+        write("tests/helpers/conftest.py", "from pkg import core\n")
+        write("tests/helpers/test_fixtures.py", "")
+        init_repo(tmp_path)
+        write("pkg/core.py", "VALUE = 2\n")
+        write("README.md", "docs\n")
+        git(tmp_path, "add", "-A")
+        git(tmp_path, "commit", "-qm", "feat: change core")
+        
+        try:
+            data = json.loads(await select_tests("main", working_directory=str(tmp_path)))
+            assert [(t["path"], t["depth"]) for t in data["tests"]] == [
+                ("tests/helpers/test_fixtures.py", 2),
+                ("tests/test_util.py", 2)
+            ]
+            assert data["tests"][0]["changed"] == ["pkg/core.py"]
+            assert data["not_python"] == ["README.md"] and data["untested"] == []
+            assert data["index"]["update"] == "full" and data["index"]["parsed"] == 8
+            
+            write("pkg/io.py", "import json\nimport os\n")
+            git(tmp_path, "commit", "-qam", "fix: io")
+            # Pruning the persisted analyses leaves the index alone
+            AnalysisCache(max_bytes=0, persist=True).put(("repo",), {}, str(tmp_path / ".git"))
+            forget_imports()
+            data = json.loads(await select_tests("main", working_directory=str(tmp_path)))
+            assert "tests/test_io.py" in data["pytest_args"]
+            assert data["index"]["update"] == "incremental" and data["index"]["parsed"] == 1
+        finally:
+            symbol_parser.shutdown()
+    
+    @pytest.mark.asyncio
+    async def test_parser_failure_is_retried(self, git_repo, monkeypatch):
+        """Test that files a dead parser process didn't parse aren't indexed as importing nothing."""
+        import git_analysis
+        
+        (git_repo / "tests").mkdir()
+        (git_repo / "tests" / "test_app.py").write_text("import app\n")
+        git(git_repo, "add", "-A")
+        git(git_repo, "commit", "-qm", "test: app")
+        head = git(git_repo, "rev-parse", "HEAD").strip()
+        
+        async def failed(obj):
+            return {"error": git_analysis.PARSER_FAILED}
+        
+        try:
+            with monkeypatch.context() as patched:
+                patched.setattr(git_analysis.symbol_parser, "symbols", failed)
+                with pytest.raises(RuntimeError, match="tests/test_app.py"):
+                    await git_analysis.import_index(str(git_repo), head)
+            
+            git_analysis.forget_imports()
+            index, how, parsed = await git_analysis.import_index(str(git_repo), head)
+            assert (how, index.tip) == ("full", head)
+            assert index.files["tests/test_app.py"]["imports"] == ["app"]
+        finally:
+            git_analysis.symbol_parser.shutdown()
+
+
+@pytest.mark.skipif(not IMPORTS_SUCCESSFUL, reason="Imports failed")
+class TestCommitHistory:
+    """Test the structured commit history read from `git log --numstat -z`."""
+    
+    @staticmethod
+    def commit(repo, name, message):
+        (repo / name).write_text("one\ntwo\n")
+        git(repo, "add", "-A")
+        git(repo, "commit", "-qm", message)
+    
+    def test_parser_handles_any_chunking(self):
+        """Test that records split across chunks, renames and binary files are parsed."""
+        from git_analysis import CommitLogParser
+        
+        output = (
+            b"\x1e" + b"a" * 40 + b"\x1f" + b"b" * 40 + b"\x1fDev\x1fdev@example.com\x1f2024-01-02T03:04:05+00:00\x1ffix: a\tb\0"
+            b"\n3\t1\tsrc/app.py\0-\t-\tlogo.png\0" b"0\t0\t\0old.txt\0docs/new.txt\0"
+            b"\x1e" + b"b" * 40 + b"\x1f\x1fDev\x1fdev@example.com\x1f2024-01-01T00:00:00+00:00\x1finitial\0"
+        )
+        parser = CommitLogParser()
+        for i in range(len(output)):
+            parser.feed(output[i:i + 1])
+        
+        first, second = [commit.to_dict() for commit in parser.commits]
+        assert first["subject"] == "fix: a\tb"
+        assert first["parents"] == ["b" * 40]
+        assert first["files"] == [
+            {"path": "src/app.py", "added": 3, "deleted": 1},
+            {"path": "logo.png", "added": None, "deleted": None},
+            {"path": "docs/new.txt", "added": 0, "deleted": 0, "old_path": "old.txt"}
+        ]
+        assert (first["added"], first["deleted"]) == (3, 1)
+        assert second["parents"] == [] and second["files"] == []
+    
+    def test_parser_keeps_tabs_in_paths(self):
+        """Test that a path containing a tab isn't split into extra numstat fields."""
+        from git_analysis import CommitLogParser
+        
+        parser = CommitLogParser()
+        parser.feed(
+            b"\x1e" + b"a" * 40 + b"\x1f\x1fDev\x1fdev@example.com\x1f2024-01-02T03:04:05+00:00\x1fadd\0"
+            b"\n2\t0\twe\tird.py\0"
+        )
+        
+        assert parser.commits[0].to_dict()["files"] == [{"path": "we\tird.py", "added": 2, "deleted": 0}]
+    
+    @pytest.mark.asyncio
+    async def test_pages_with_cursor(self, git_repo):
+        """Test that pages follow each other and stay pinned to the first page's HEAD."""
+        self.commit(git_repo, "a.txt", "second")
+        self.commit(git_repo, "b.txt", "third")
+        
+        first = json.loads(await get_commit_history(working_directory=str(git_repo), max_commits=2))
+        assert [c["subject"] for c in first["commits"]] == ["third", "second"]
+        assert first["commits"][0]["files"] == [{"path": "b.txt", "added": 2, "deleted": 0}]
+        assert first["has_more"] is True
+        
+        self.commit(git_repo, "c.txt", "made in between")
+        second = json.loads(await get_commit_history(
+            working_directory=str(git_repo), cursor=first["next_cursor"], max_commits=2
+        ))
+        assert [c["subject"] for c in second["commits"]] == ["feat: add guide"]
+        assert {"path": "docs/new.txt", "added": 0, "deleted": 0, "old_path": "old.txt"} in second["commits"][0]["files"]
+        assert second["has_more"] is False
+        assert second["next_cursor"] is None
+    
+    @pytest.mark.asyncio
+    async def test_invalid_cursor(self, git_repo):
+        """Test that a cursor that isn't a commit and offset is rejected before running git."""
+        data = json.loads(await get_commit_history(working_directory=str(git_repo), cursor="--output=x:0"))
+        assert "Invalid cursor" in data["error"]
+
+
+@pytest.mark.skipif(not IMPORTS_SUCCESSFUL, reason="Imports failed")
+class TestOwnership:
+    """Test the code-ownership index and reviewer suggestions."""
+    
+    @staticmethod
+    def commit(repo, author, files, branch="main"):
+        git(repo, "checkout", "-q", branch)
+        for name, content in files.items():
+            (repo / name).parent.mkdir(parents=True, exist_ok=True)
+            (repo / name).write_text(content)
+        git(repo, "add", "-A")
+        git(repo, "-c", f"user.name={author}", "-c", f"user.email={author.lower()}@example.com", "commit", "-qm", "change")
+        git(repo, "checkout", "-q", "feature")
+    
+    @pytest.mark.asyncio
+    async def test_ranks_owners_of_changed_files(self, git_repo):
+        """Test that the people who changed the files most come first and branch authors are left out."""
+        self.commit(git_repo, "Alice", {"app.py": "alice\n" * 50})
+        self.commit(git_repo, "Bob", {"app.py": "alice\n" * 50 + "bob\n", "docs/other.md": "bob\n"})
+        
+        data = json.loads(await suggest_reviewers(working_directory=str(git_repo)))
+        reviewers = {r["name"]: r for r in data["reviewers"]}
+        
+        assert list(reviewers) == ["Bob", "Alice"]
+        assert reviewers["Alice"]["files"] == ["app.py"]
+        # app.py is mostly Alice's; the new file under docs/ falls back to the directory's owner
+        assert reviewers["Bob"]["files"] == ["app.py", "docs/guide.md"]
+        assert 1 < reviewers["Bob"]["score"] < 1.5
+        assert data["branch_authors"] == ["dev@example.com"]
+        assert data["index"]["update"] == "full"
+    
+    @pytest.mark.asyncio
+    async def test_incremental_and_persistent(self, git_repo):
+        """Test that new commits are added to the stored index and a rewrite rebuilds it."""
+        from git_analysis import AnalysisCache, forget_ownership, ownership_index
+        
+        index, how = await ownership_index(str(git_repo), "main")
+        assert (how, index.commits) == ("full", 1)
+        
+        self.commit(git_repo, "Carol", {"app.py": "carol\n"})
+        index, how = await ownership_index(str(git_repo), "main")
+        assert (how, index.commits) == ("incremental", 2)
+        assert "carol@example.com" in index.weights["app.py"]
+        
+        # Pruning the persisted analyses leaves the index alone
+        AnalysisCache(max_bytes=0, persist=True).put(("repo",), {}, str(git_repo / ".git"))
+        forget_ownership()
+        index, how = await ownership_index(str(git_repo), "main")
+        assert (how, index.commits) == ("unchanged", 2)
+        
+        git(git_repo, "branch", "-f", "main", "main~1")
+        index, how = await ownership_index(str(git_repo), "main")
+        assert (how, index.commits) == ("full", 1)
+
+
+@pytest.mark.skipif(not IMPORTS_SUCCESSFUL, reason="Imports failed")
+class TestBatchAnalysis:
+    """Test analyzing several repositories in one call."""
+    
+    @pytest.fixture
+    def repos(self, git_repo, tmp_path_factory):
+        import shutil
+        
+        other = tmp_path_factory.mktemp("other") / "repo"
+        shutil.copytree(git_repo, other)
+        (other / "app.py").write_text("changed\n" * 300)
+        return [str(git_repo), str(other), str(tmp_path_factory.mktemp("not-a-repo"))]
+    
+    @pytest.mark.asyncio
+    async def test_errors_are_kept_per_repository(self, repos):
+        """Test that one failing repository doesn't fail the batch."""
+        data = json.loads(await analyze_repositories(repos, ["main", "main", None]))
+        
+        assert (data["succeeded"], data["failed"]) == (2, 1)
+        first, second, broken = data["repositories"]
+        assert first["working_directory"] == repos[0]
+        assert "docs/guide.md" in first["files_changed"]
+        assert first["files_changed"] == second["files_changed"]
+        assert "Git error" in broken["error"]
+        assert data["truncated_to_fit"] is False
+    
+    @pytest.mark.asyncio
+    async def test_payload_is_bounded(self, repos):
+        """Test that the repositories share max_bytes and the largest diffs are cut."""
+        unbounded = json.loads(await analyze_repositories(repos[:2], include_diff=True))
+        result = await analyze_repositories(repos[:2], include_diff=True, max_bytes=6000)
+        data = json.loads(result)
+        
+        assert len(json.dumps(unbounded)) > 6000
+        assert len(result.encode("utf-8")) <= 6000
+        assert data["truncated_to_fit"] is True
+        assert all("cut to fit" in repo["diff"] for repo in data["repositories"])
+        assert data["repositories"][0]["files_changed"] == unbounded["repositories"][0]["files_changed"]
+    
+    @pytest.mark.asyncio
+    async def test_structured_fields_are_cut_too(self, git_repo, tmp_path):
+        """Test that max_bytes holds when the composition, not the text fields, is what's large."""
+        from git_analysis import analyze_changes
+        
+        for i in range(400):
+            directory = git_repo / f"service_{i}"
+            directory.mkdir()
+            (directory / f"config.ext{i}").write_text(f"value = {i}\n")
+        git(git_repo, "add", "-A")
+        git(git_repo, "commit", "-qm", "Add services")
+        
+        repos = [str(git_repo), str(tmp_path / "missing" / ("x" * 200))]
+        before = json.loads(json.dumps(await analyze_changes("main", str(git_repo), False)))
+        unbounded = json.loads(await analyze_repositories(repos, ["main", "main"]))
+        assert len(json.dumps(unbounded)) > 50000
+        
+        for max_bytes in (20000, 3000):
+            result = await analyze_repositories(repos, ["main", "main"], max_bytes=max_bytes)
+            data = json.loads(result)
+            assert len(result.encode("utf-8")) <= max_bytes
+            assert data["truncated_to_fit"] is True and data["failed"] == 1
+            repo = data["repositories"][0]
+            assert "cut to fit" in repo["files_changed"]
+            if max_bytes == 20000:
+                # The totals and the largest groups are kept
+                composition = repo["composition"]
+                assert composition["cut_to_fit"] is True and composition["files"] == 404
+                assert list(composition["by_extension"])[0] == ".md"
+            else:
+                assert not repo.get("composition", {}).get("by_directory")
+        
+        # The cut copies leave the cached analysis as it was
+        after = await analyze_changes("main", str(git_repo), False)
+        assert after["cached"] is True
+        assert after["composition"] == before["composition"] and after["files_changed"] == before["files_changed"]
+    
+    @pytest.mark.asyncio
+    async def test_mismatched_base_branches(self, repos):
+        """Test that base_branches must line up with the working directories."""
+        data = json.loads(await analyze_repositories(repos, ["main"]))
+        assert "one entry per working directory" in data["error"]
+
+
+@pytest.mark.skipif(not IMPORTS_SUCCESSFUL, reason="Imports failed")
+class TestGitGovernor:
+    """Test the limits, fair queuing and request merging of the git governor."""
+    
+    @staticmethod
+    async def acquire(governor, repo, requester, order):
+        from git_analysis import on_behalf_of
+        
+        with on_behalf_of(requester):
+            await governor.acquire(repo)
+        order.append(requester)
+    
+    @pytest.mark.asyncio
+    async def test_global_and_per_repo_limits(self):
+        """Test that a busy repository doesn't hold up commands for another one."""
+        from git_analysis import GitGovernor
+        
+        governor = GitGovernor(limit=2, per_repo=1)
+        order = []
+        await governor.acquire("a")
+        waiting = asyncio.ensure_future(self.acquire(governor, "a", "s1", order))
+        await self.acquire(governor, "b", "s2", order)
+        await asyncio.sleep(0)
+        
+        assert order == ["s2"]
+        assert governor.metrics()["queue_depth"] == 1
+        assert governor.metrics()["running_by_repository"] == {"a": 1, "b": 1}
+        
+        governor.release("a")
+        await waiting
+        assert order == ["s2", "s1"]
+        assert governor.metrics()["commands_queued"] == 1
+        assert governor.metrics()["wait_ms"]["max"] > 0
+    
+    @pytest.mark.asyncio
+    async def test_round_robin_across_requesters(self):
+        """Test that one session's burst doesn't starve another session."""
+        from git_analysis import GitGovernor
+        
+        governor = GitGovernor(limit=1, per_repo=1)
+        order = []
+        await governor.acquire("repo")
+        tasks = [asyncio.ensure_future(self.acquire(governor, "repo", "burst", order)) for _ in range(3)]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.ensure_future(self.acquire(governor, "repo", "other", order)))
+        await asyncio.sleep(0)
+        assert governor.metrics()["queue_depth_by_requester"] == {"burst": 3, "other": 1}
+        
+        for _ in tasks:
+            governor.release("repo")
+            await asyncio.sleep(0)
+        
+        assert order == ["burst", "other", "burst", "burst"]
+    
+    @pytest.mark.asyncio
+    async def test_cancelled_waiter_leaves_queue(self):
+        """Test that a cancelled command gives up its place in the queue."""
+        from git_analysis import GitGovernor
+        
+        governor = GitGovernor(limit=1, per_repo=1)
+        await governor.acquire("repo")
+        waiting = asyncio.ensure_future(governor.acquire("repo"))
+        await asyncio.sleep(0)
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        
+        assert governor.metrics()["queue_depth"] == 0
+        governor.release("repo")
+        assert governor.running == 0
+    
+    @pytest.mark.asyncio
+    async def test_identical_requests_share_git(self):
+        """Test that concurrent identical analyses run git once."""
+        from git_analysis import analyze_changes, governor
+        
+        git = fake_git({"diff": RAW_DIFF})
+        with git:
+            first, second = await asyncio.gather(
+                analyze_changes("main", "/repo"), analyze_changes("main", "/repo")
+            )
+        
+        assert first["files_changed"] == second["files_changed"]
+        # One diff for the analysis, one listing the dependency files
+        assert len([command for command, _ in git.processes if "diff" in command]) == 2
+        assert governor().metrics()["requests_merged"] == 1
+        
+        data = json.loads(await get_git_metrics())
+        assert data["queue_depth"] == 0
+        assert data["commands_started"] >= 1
+
+
+@pytest.mark.skipif(not IMPORTS_SUCCESSFUL, reason="Imports failed")
+class TestIncrementalAnalysis:
+    """Test that an analysis is updated from the previous one when HEAD advances."""
+    
+    @staticmethod
+    async def full(repo, **options):
+        from git_analysis import analysis_cache, analyze_changes, diff_baselines
+        
+        analysis_cache.clear()
+        diff_baselines.clear()
+        return await analyze_changes("main", str(repo), **options)
+    
+    @staticmethod
+    def comparable(analysis):
+        ignored = ("computation", "incremental_from", "cached", "git_timings_ms")
+        return {name: value for name, value in analysis.items() if name not in ignored}
+    
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("max_diff_lines", [500, 12])
+    async def test_matches_full_analysis(self, git_repo, max_diff_lines):
+        """Test that an incremental update gives the same result as a full recomputation."""
+        from git_analysis import analyze_changes
+        
+        first = await analyze_changes("main", str(git_repo), max_diff_lines=max_diff_lines)
+        assert first["computation"] == "full"
+        
+        (git_repo / "app.py").write_text("a\nB\nc\nd\ne\n")
+        (git_repo / "zz.txt").write_text("new\n")
+        git(git_repo, "mv", "docs/new.txt", "docs/moved.txt")
+        git(git_repo, "rm", "-q", "logo.png")
+        git(git_repo, "add", "-A")
+        git(git_repo, "commit", "-qm", "fix: follow-up")
+        
+        second = await analyze_changes("main", str(git_repo), max_diff_lines=max_diff_lines)
+        assert second["computation"] == "incremental"
+        assert second["incremental_from"] == git(git_repo, "rev-parse", "HEAD~1").strip()
+        assert "docs/moved.txt" in second["files_changed"]
+        assert self.comparable(second) == self.comparable(await self.full(git_repo, max_diff_lines=max_diff_lines))
+    
+    @pytest.mark.asyncio
+    async def test_new_merge_base_is_full(self, git_repo):
+        """Test that merging the base branch in recomputes the whole diff."""
+        from git_analysis import analyze_changes
+        
+        await analyze_changes("main", str(git_repo))
+        git(git_repo, "checkout", "-q", "main")
+        (git_repo / "base.txt").write_text("base\n")
+        git(git_repo, "add", "-A")
+        git(git_repo, "commit", "-qm", "base")
+        git(git_repo, "checkout", "-q", "feature")
+        git(git_repo, "merge", "-q", "--no-edit", "main")
+        
+        analysis = await analyze_changes("main", str(git_repo))
+        assert analysis["computation"] == "full"
+        assert "base.txt" not in analysis["files_changed"]
+
+
+@pytest.mark.skipif(not IMPORTS_SUCCESSFUL, reason="Imports failed")
+class TestRefWatcher:
+    """Test that the ref watcher warms the analysis cache when HEAD moves."""
+    
+    @staticmethod
+    def commit(repo, message):
+        (repo / "app.py").write_text((repo / "app.py").read_text() + message + "\n")
+        git(repo, "commit", "-qam", message)
+    
+    @staticmethod
+    async def settled(watcher, warmed):
+        for _ in range(100):
+            if watcher.warmed >= warmed:
+                return
+            await asyncio.sleep(0.05)
+        raise AssertionError(f"not warmed: {watcher.last_error}")
+    
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("use_inotify", [True, False])
+    async def test_commit_warms_cache(self, git_repo, use_inotify):
+        """Test that analyzing after a commit is a cache hit, with inotify or polling."""
+        from git_analysis import analyze_changes, stop_ref_watchers, watch_refs
+        
+        watcher = await watch_refs(str(git_repo), "main", interval=0.05, debounce=0.05, use_inotify=use_inotify)
+        try:
+            assert await watch_refs(str(git_repo), "main") is watcher
+            await self.settled(watcher, 1)
+            self.commit(git_repo, "second")
+            await self.settled(watcher, 2)
+            
+            analysis = await analyze_changes("main", str(git_repo))
+            assert analysis["cached"] is True
+            assert "second" in analysis["commits"]
+            assert watcher.events >= 1
+        finally:
+            stop_ref_watchers()
+    
+    @pytest.mark.asyncio
+    async def test_unresolvable_base_is_reported(self, git_repo):
+        """Test that a failing warm-up is kept in last_error instead of stopping the watcher."""
+        from git_analysis import RefWatcher
+        
+        watcher = RefWatcher(str(git_repo), "no-such-branch", debounce=0.01, use_inotify=False)
+        await watcher.start()
+        try:
+            for _ in range(100):
+                if watcher.last_error:
+                    break
+                await asyncio.sleep(0.02)
+            assert watcher.last_error
+            assert watcher.warmed == 0
+        finally:
+            watcher.stop()
+
 
 @pytest.mark.skipif(not IMPORTS_SUCCESSFUL, reason="Imports failed")
 class TestGetPRTemplates:
@@ -187,6 +1828,83 @@ class TestSuggestTemplate:
             assert isinstance(suggestion, dict), "Should return structured error for starter code"
 
 
+@pytest.mark.skipif(not IMPORTS_SUCCESSFUL, reason="Imports failed")
+class TestChangeClassifier:
+    """Test the local change-type classifier behind suggest_template."""
+    
+    @staticmethod
+    def change(status, path, added=10, deleted=0):
+        from git_analysis import FileChange
+        return FileChange(status, path, added=added, deleted=deleted)
+    
+    def test_paths(self):
+        """Test that documentation and test paths decide when nothing else does."""
+        from git_analysis import classify_changes
+        
+        docs = classify_changes([self.change("M", "README.md"), self.change("A", "docs/guide.rst")], [])
+        assert docs[0]["type"] == "docs"
+        assert docs[0]["confidence"] == 1.0
+        
+        tests = classify_changes([self.change("M", "tests/test_api.py"), self.change("M", "web/app.spec.ts")], [])
+        assert tests[0]["type"] == "test"
+    
+    def test_security_paths_match_whole_words(self):
+        """Test that security words in a path count only as whole words, not inside others."""
+        from git_analysis import path_change_type
+        
+        for path in ("src/auth/session.py", "api/AuthService.java", "config/secrets.yaml", "lib/crypto_utils.py"):
+            assert path_change_type(path) == "security", path
+        for path in ("src/author.py", "clients/oauth_client.py", "hr/secretary.py", "docs_builder/authority.py"):
+            assert path_change_type(path) is None, path
+    
+    def test_commit_prefixes_and_keywords(self):
+        """Test that conventional-commit prefixes and keywords outweigh a small code change."""
+        from git_analysis import classify_changes
+        
+        ranking = classify_changes(
+            [self.change("M", "src/cache.py", 3, 2)],
+            ["fix(cache): crash on empty key", "fix!: wrong expiry"],
+            "Fixes a crash"
+        )
+        assert ranking[0]["type"] == "bug"
+        assert "2 of 2 commits start with fix:" in ranking[0]["reasons"]
+        assert ranking[0]["confidence"] > 0.7
+    
+    def test_numstat_shape(self):
+        """Test that new code files read as a feature and moved code as a refactor."""
+        from git_analysis import classify_changes
+        
+        assert classify_changes([self.change("A", "src/new.py", 200)], [])[0]["type"] == "feature"
+        moved = [self.change("R100", f"lib/{name}.py", 0, 5) for name in "abc"]
+        assert classify_changes(moved, [])[0]["type"] == "refactor"
+        
+        nothing = classify_changes([], [])
+        assert nothing[0]["type"] == "feature"
+        assert nothing[0]["confidence"] == 0.0
+    
+    @pytest.mark.asyncio
+    async def test_suggest_without_change_type(self, git_repo):
+        """Test that suggest_template ranks the branch's changes when no change_type is given."""
+        result = json.loads(await suggest_template(working_directory=str(git_repo)))
+        
+        ranking = result["ranking"]
+        assert [entry["confidence"] for entry in ranking] == sorted((e["confidence"] for e in ranking), reverse=True)
+        assert result["recommended_template"]["filename"] == ranking[0]["template"]
+        assert result["confidence"] == ranking[0]["confidence"]
+        assert "Classified locally" in result["reasoning"]
+    
+    @pytest.mark.asyncio
+    async def test_explicit_change_type_wins(self, git_repo):
+        """Test that a known change_type is used as given, without running git."""
+        git = fake_git()
+        with git:
+            result = json.loads(await suggest_template("Speeds up parsing", "performance", working_directory=str(git_repo)))
+        
+        assert result["recommended_template"]["filename"] == "performance.md"
+        assert "ranking" not in result
+        assert git.processes == []
+
+
 @pytest.mark.skipif(not IMPORTS_SUCCESSFUL, reason="Imports failed")
 class TestToolRegistration:
     """Test that tools are properly registered with FastMCP."""